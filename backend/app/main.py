@@ -1,12 +1,14 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
+import asyncio
 import logging
 import os
-from pathlib import Path
 
-from app.routers import chat
+from app.routers import chat, uploads
+from app.services import claude_service, firebase_service, persistence_queue, summary_service
+from app.utils import image_utils
+from app.utils.upload_limits import BodySizeLimitMiddleware
 
 # Load environment variables
 load_dotenv()
@@ -29,6 +31,14 @@ app = FastAPI(
     version="1.0.0",
 )
 
+# Reject oversized uploads before the multipart parser spools them. The
+# allowance on top of the image limit covers the form fields and boundaries.
+# Added before CORS so CORS wraps it and the 413s carry CORS headers.
+app.add_middleware(
+    BodySizeLimitMiddleware,
+    limits={"/api/chat/upload": image_utils.MAX_UPLOAD_BYTES + 64 * 1024},
+)
+
 # Configure CORS - Fix to allow Firebase hosting domains
 origins = [
     "https://clron-2.web.app",
@@ -50,10 +60,21 @@ app.add_middleware(
 # Include routers
 app.include_router(chat.router)
 
-# Set up static file serving for uploaded images
-uploads_dir = Path(__file__).parent.parent / "uploads"
-uploads_dir.mkdir(exist_ok=True)
-app.mount("/uploads", StaticFiles(directory=str(uploads_dir)), name="uploads")
+# Serve uploaded images with immutable caching, ETags and Range support
+app.include_router(uploads.router)
+
+@app.on_event("startup")
+async def startup():
+    # Keep the ID token certificates warm so verification never fetches them inline
+    app.state.cert_refresh_task = asyncio.create_task(firebase_service.keep_public_keys_warm())
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.cert_refresh_task.cancel()
+    await persistence_queue.shutdown()
+    await summary_service.shutdown()
+    await claude_service.close()
+    image_utils.shutdown_image_pool()
 
 @app.get("/health")
 async def health_check():
@@ -13,11 +13,18 @@ class ChatRequest(BaseModel):
     message: str
     image_data: Optional[str] = None
     image_type: Optional[str] = None
+    image_id: Optional[str] = None
     chat_id: Optional[str] = None
     system_prompt: Optional[str] = None
+    # "fast" or "quality"; matched against the model routing rules
+    routing_hint: Optional[str] = None
 
 class ChatResponse(BaseModel):
     content: str
     chat_id: Optional[str] = None
     image_url: Optional[str] = None
+    thumbnail_url: Optional[str] = None
+    image_id: Optional[str] = None
+    model: Optional[str] = None
+    usage: Optional[Dict[str, int]] = None
     error: Optional[str] = None
\ No newline at end of file
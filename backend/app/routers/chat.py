@@ -1,18 +1,22 @@
 from fastapi import APIRouter, Depends, HTTPException, Header, UploadFile, File, Form, Request
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from typing import Optional, AsyncGenerator
 import logging
-import base64
 import json
 import asyncio
+import os
 
 from app.models.chat import ChatRequest, ChatResponse
-from app.services import claude_service, firebase_service
-from app.utils.image_utils import compress_image
+from app.services import admission, claude_service, context_service, firebase_service, image_store, model_router, persistence_queue, resilience, response_cache
+from app.utils import image_utils
 
 router = APIRouter(prefix="/api", tags=["chat"])
 logger = logging.getLogger(__name__)
 
+# Firebase UIDs allowed to read the runtime counters at /api/stats
+STATS_ADMIN_UIDS = {uid.strip() for uid in os.environ.get("STATS_ADMIN_UIDS", "").split(",") if uid.strip()}
+
 async def get_user_id(authorization: Optional[str] = Header(None)):
     """Get user ID from Firebase token"""
     if not authorization:
@@ -23,7 +27,7 @@ async def get_user_id(authorization: Optional[str] = Header(None)):
         if " " in authorization:
             scheme, token = authorization.split(" ", 1)
             if scheme.lower() == "bearer":
-                decoded_token = firebase_service.verify_token(token)
+                decoded_token = await firebase_service.verify_token_async(token)
                 if decoded_token:
                     return decoded_token.get("uid")
         
@@ -32,17 +36,141 @@ async def get_user_id(authorization: Optional[str] = Header(None)):
         logger.error(f"Error getting user ID: {str(e)}")
         return "anonymous"
 
+async def require_admin(user_id: str = Depends(get_user_id)):
+    """Only let signed-in users listed in STATS_ADMIN_UIDS through"""
+    if user_id == "anonymous":
+        raise HTTPException(status_code=401, detail="Authentication required")
+    if user_id not in STATS_ADMIN_UIDS:
+        raise HTTPException(status_code=403, detail="Not allowed")
+    return user_id
+
+def _check_rate(user_id, http_request):
+    """Shed the request with 429 when the caller is over their rate"""
+    # Anonymous callers are told apart by address, the forwarded one behind a proxy
+    key = user_id
+    if user_id == "anonymous":
+        peer = http_request.client.host if http_request.client else None
+        key = f"anonymous:{admission.client_address(http_request.headers.get('x-forwarded-for'), peer)}"
+    try:
+        admission.check_rate(key)
+    except admission.AdmissionRejected as rejected:
+        logger.warning(f"Rate limited {key}, retry after {rejected.retry_after}s")
+        raise HTTPException(status_code=429, detail=rejected.reason, headers={"Retry-After": str(rejected.retry_after)})
+
+async def _acquire_slot():
+    """Wait for a Claude slot, or shed the request with 429 when the server is saturated"""
+    try:
+        return await admission.acquire()
+    except admission.AdmissionRejected as rejected:
+        raise HTTPException(status_code=429, detail=rejected.reason, headers={"Retry-After": str(rejected.retry_after)})
+
+def _claude_error(claude_response):
+    """Map an error from claude_service to an HTTP error; overload becomes 503 with Retry-After"""
+    status_code = claude_response.get("status_code", 500)
+    headers = {"Retry-After": str(claude_response["retry_after"])} if claude_response.get("retry_after") else None
+    return HTTPException(status_code=status_code, detail=claude_response["error"], headers=headers)
+
+def _resolve_chat_id(user_id, chat_id):
+    """Return (chat_id, is_new_chat), minting an ID for new conversations of signed-in users"""
+    if chat_id or user_id == "anonymous":
+        return chat_id, False
+    return firebase_service.new_chat_id(), True
+
+def _save_truncated_turn(user_id, chat_id, is_new_chat, user_content, image_url, thumbnail_url, partial_content):
+    """
+    Save a turn whose response stream was cut short by a client disconnect
+    
+    Runs in the cancellation path, so the turn is queued without waiting.
+    Nothing is saved if the client left before the first token: Claude
+    rejects empty assistant messages, so the chat could not be continued.
+    """
+    if user_id == "anonymous":
+        return
+    if not partial_content:
+        logger.info(f"Client left before the first token, not saving the turn for chat_id: {chat_id}")
+        return
+    
+    user_message = {
+        "content": user_content,
+        "role": "user",
+        "image_url": image_url,
+        "thumbnail_url": thumbnail_url
+    }
+    assistant_message = {
+        "content": partial_content,
+        "role": "assistant",
+        "truncated": True
+    }
+    persistence_queue.enqueue_turn_nowait(user_id, chat_id, user_message, assistant_message, is_new_chat)
+    logger.info(f"Queued truncated response for chat_id: {chat_id}")
+
+async def _prepare_image(user_id, image_source):
+    """
+    Normalization stage shared by all chat endpoints
+    
+    Downscales and re-encodes the image (raw bytes or the spooled file
+    of an upload) in the image process pool and stores
+    the normalized bytes for signed-in users. The bytes stay raw all the way
+    to claude_service, which base64-encodes them once for the payload.
+    Returns (image_bytes, image_type, image_url).
+    """
+    try:
+        image_bytes, image_type, bytes_saved = await image_utils.normalize_image_async(image_source)
+    except image_utils.ImageQueueFullError as busy_error:
+        logger.warning(f"Image pool busy: {str(busy_error)}")
+        raise HTTPException(status_code=503, detail="Image processing is busy, try again shortly", headers={"Retry-After": "1"})
+    except image_utils.ImagePoolUnavailableError as pool_error:
+        logger.error(f"Image pool unavailable: {str(pool_error)}")
+        raise HTTPException(status_code=503, detail="Image processing is unavailable, try again shortly", headers={"Retry-After": "5"})
+    except asyncio.TimeoutError:
+        logger.error("Image processing timed out")
+        raise HTTPException(status_code=504, detail="Image processing timed out")
+    
+    logger.info(f"Image normalization saved {bytes_saved} bytes")
+    
+    # Upload to Firebase Storage if authenticated
+    image_url = None
+    if user_id != "anonymous":
+        image_url = await firebase_service.upload_image_async(
+            user_id=user_id,
+            image_data=image_bytes,
+            image_type=image_type
+        )
+        logger.info(f"Image uploaded: {image_url}")
+    
+    return image_bytes, image_type, image_url
+
+def _keep_image_handle(user_id, chat_id, image_bytes, image_type, image_url):
+    """Keep a processed image so later turns of the chat can send just its ID"""
+    if user_id == "anonymous":
+        return None
+    return image_store.put(user_id, chat_id, image_bytes, image_type, image_url)
+
+async def _get_image_handle(user_id, chat_id, image_id):
+    """Resolve an image ID from an earlier turn, or fail with 404"""
+    handle = None
+    if user_id != "anonymous" and chat_id:
+        handle = await image_store.get(user_id, chat_id, image_id)
+    if not handle:
+        raise HTTPException(status_code=404, detail="Unknown image_id, send the image again")
+    return handle
+
 @router.post("/chat", response_model=ChatResponse)
 async def chat(
     request: ChatRequest,
+    http_request: Request,
     user_id: str = Depends(get_user_id)
 ):
     """Handle chat requests with text and optional image"""
     try:
         logger.info(f"Received chat request from user {user_id}")
+        _check_rate(user_id, http_request)
+        
+        # Assign the chat ID up front so it never depends on the save
+        chat_id, is_new_chat = _resolve_chat_id(user_id, request.chat_id)
         
         # First, check if Claude service is available
-        if not claude_service.client:
+        if not claude_service.async_client:
             logger.error("Claude API client is not initialized")
             raise HTTPException(status_code=503, detail="Claude API service is unavailable")
         
@@ -50,31 +178,34 @@ async def chat(
         image_url = None
         image_data = None
         image_type = None
+        image_id = None
         
-        if request.image_data:
+        if request.image_id and not request.image_data:
+            # Reuse an image processed earlier in this chat
+            image_data, image_type, image_url = await _get_image_handle(user_id, request.chat_id, request.image_id)
+            image_id = request.image_id
+        elif request.image_data:
             logger.info("Processing image data")
             
             try:
-                # Compress image if needed
-                image_data, image_type = compress_image(request.image_data)
-                
-                # Upload to Firebase Storage if authenticated
-                if user_id != "anonymous":
-                    image_url = firebase_service.upload_image(
-                        user_id=user_id,
-                        image_data=base64.b64decode(image_data),
-                        image_type=image_type
-                    )
-                    logger.info(f"Image uploaded: {image_url}")
+                image_bytes, _ = image_utils.parse_data_url(request.image_data)
+                image_data, image_type, image_url = await _prepare_image(user_id, image_bytes)
+                image_id = _keep_image_handle(user_id, chat_id, image_data, image_type, image_url)
+            except HTTPException:
+                raise
             except Exception as img_error:
                 logger.error(f"Image processing error: {str(img_error)}")
                 # Continue without the image rather than failing the request
         
+        # None when the thumbnail could not be made
+        thumbnail_url = await firebase_service.get_thumbnail_url_async(image_url)
+        
         # Get chat history if this is a continuation
         chat_history = []
+        summary = None
         if request.chat_id and user_id != "anonymous":
             try:
-                chat_history = firebase_service.get_chat_history(user_id, request.chat_id)
+                summary, chat_history = await context_service.get_context_async(user_id, request.chat_id)
                 logger.info(f"Retrieved {len(chat_history)} messages from chat history")
             except Exception as hist_error:
                 logger.error(f"Failed to get chat history: {str(hist_error)}")
@@ -82,41 +213,42 @@ async def chat(
         
         # Call Claude API
         logger.info("Calling Claude API...")
-        claude_response = claude_service.send_message(
-            message=request.message,
-            image_data=image_data,
-            image_type=image_type,
-            chat_history=chat_history,
-            system_prompt=request.system_prompt
-        )
+        slot = await _acquire_slot()
+        try:
+            claude_response = await claude_service.send_message_async(
+                message=request.message,
+                image_data=image_data,
+                image_type=image_type,
+                chat_history=chat_history,
+                system_prompt=request.system_prompt,
+                summary=summary,
+                routing_hint=request.routing_hint,
+                image_id=image_id
+            )
+        finally:
+            slot.release()
         
         if "error" in claude_response:
             logger.error(f"Claude API error: {claude_response['error']}")
-            raise HTTPException(status_code=500, detail=claude_response["error"])
+            raise _claude_error(claude_response)
         
         # Save messages to Firestore if authenticated
-        chat_id = request.chat_id
         if user_id != "anonymous":
             try:
-                # Save user message
                 user_message = {
                     "content": request.message,
                     "role": "user",
-                    "chat_id": chat_id,
-                    "image_url": image_url
+                    "image_url": image_url,
+                    "thumbnail_url": thumbnail_url
                 }
-                
-                chat_id = firebase_service.save_chat_message(user_id, user_message)
-                
-                # Save assistant response
                 assistant_message = {
                     "content": claude_response["content"],
-                    "role": "assistant",
-                    "chat_id": chat_id
+                    "role": "assistant"
                 }
                 
-                firebase_service.save_chat_message(user_id, assistant_message)
-                logger.info(f"Saved messages to Firestore with chat_id: {chat_id}")
+                # Write the turn in the background so the response isn't held up
+                await persistence_queue.enqueue_turn(user_id, chat_id, user_message, assistant_message, is_new_chat)
+                logger.info(f"Queued messages for Firestore with chat_id: {chat_id}")
             except Exception as save_error:
                 logger.error(f"Failed to save messages: {str(save_error)}")
                 # Continue rather than failing the request
@@ -125,7 +257,11 @@ async def chat(
         return ChatResponse(
             content=claude_response["content"],
             chat_id=chat_id,
-            image_url=image_url
+            image_url=image_url,
+            thumbnail_url=thumbnail_url,
+            image_id=image_id,
+            model=claude_response.get("model"),
+            usage=claude_response.get("usage")
         )
     
     except HTTPException:
@@ -137,90 +273,98 @@ async def chat(
 
 @router.post("/chat/upload", response_model=ChatResponse)
 async def upload_image(
+    http_request: Request,
     image: UploadFile = File(...),
     message: str = Form(""),
     chat_id: Optional[str] = Form(None),
     system_prompt: Optional[str] = Form(None),
+    routing_hint: Optional[str] = Form(None),
     user_id: str = Depends(get_user_id)
 ):
     """Handle chat requests with file upload"""
     try:
         logger.info(f"Received image upload from user {user_id}")
+        _check_rate(user_id, http_request)
+        
+        # Assign the chat ID up front so it never depends on the save
+        history_chat_id = chat_id
+        chat_id, is_new_chat = _resolve_chat_id(user_id, chat_id)
         
         # First, check if Claude service is available
-        if not claude_service.client:
+        if not claude_service.async_client:
             logger.error("Claude API client is not initialized")
             raise HTTPException(status_code=503, detail="Claude API service is unavailable")
         
-        # Read and process the uploaded image
-        image_bytes = await image.read()
-        image_type = image.content_type
-        
-        # Validate image
-        if not image_type or not image_type.startswith('image/'):
+        # Check the upload Starlette has spooled; the type comes from the magic bytes
+        try:
+            image_file, image_type = await image_utils.check_upload(image)
+        except image_utils.ImageTooLargeError as size_error:
+            raise HTTPException(status_code=413, detail=str(size_error))
+        except image_utils.UnsupportedImageError:
             raise HTTPException(status_code=400, detail="Invalid image format")
         
-        # Compress the image
-        image_data_base64 = base64.b64encode(image_bytes).decode('utf-8')
+        # Normalize the image and store it
+        try:
+            image_data, image_type, image_url = await _prepare_image(user_id, image_file)
+            image_id = _keep_image_handle(user_id, chat_id, image_data, image_type, image_url)
+        except HTTPException:
+            raise
+        except Exception as img_error:
+            logger.error(f"Image processing error: {str(img_error)}")
+            raise HTTPException(status_code=400, detail="Invalid image format")
+        finally:
+            image_file.close()
         
-        # Upload to Firebase Storage if authenticated
-        image_url = None
-        if user_id != "anonymous":
-            try:
-                image_url = firebase_service.upload_image(
-                    user_id=user_id,
-                    image_data=image_bytes,
-                    image_type=image_type
-                )
-                logger.info(f"Image uploaded: {image_url}")
-            except Exception as img_error:
-                logger.error(f"Image processing error: {str(img_error)}")
-                # Continue without storing the image
+        # None when the thumbnail could not be made
+        thumbnail_url = await firebase_service.get_thumbnail_url_async(image_url)
         
         # Get chat history if this is a continuation
         chat_history = []
-        if chat_id and user_id != "anonymous":
+        summary = None
+        if history_chat_id and user_id != "anonymous":
             try:
-                chat_history = firebase_service.get_chat_history(user_id, chat_id)
+                summary, chat_history = await context_service.get_context_async(user_id, history_chat_id)
                 logger.info(f"Retrieved {len(chat_history)} messages from chat history")
             except Exception as hist_error:
                 logger.error(f"Failed to get chat history: {str(hist_error)}")
         
         # Call Claude API
-        claude_response = claude_service.send_message(
-            message=message,
-            image_data=image_data_base64,
-            image_type=image_type,
-            chat_history=chat_history,
-            system_prompt=system_prompt
-        )
+        slot = await _acquire_slot()
+        try:
+            claude_response = await claude_service.send_message_async(
+                message=message,
+                image_data=image_data,
+                image_type=image_type,
+                chat_history=chat_history,
+                system_prompt=system_prompt,
+                summary=summary,
+                routing_hint=routing_hint,
+                image_id=image_id
+            )
+        finally:
+            slot.release()
         
         if "error" in claude_response:
             logger.error(f"Claude API error: {claude_response['error']}")
-            raise HTTPException(status_code=500, detail=claude_response["error"])
+            raise _claude_error(claude_response)
         
         # Save messages to Firestore if authenticated
         if user_id != "anonymous":
             try:
-                # Save user message
                 user_message = {
                     "content": message,
                     "role": "user",
-                    "chat_id": chat_id,
-                    "image_url": image_url
+                    "image_url": image_url,
+                    "thumbnail_url": thumbnail_url
                 }
-                
-                chat_id = firebase_service.save_chat_message(user_id, user_message)
-                
-                # Save assistant response
                 assistant_message = {
                     "content": claude_response["content"],
-                    "role": "assistant",
-                    "chat_id": chat_id
+                    "role": "assistant"
                 }
                 
-                firebase_service.save_chat_message(user_id, assistant_message)
-                logger.info(f"Saved messages to Firestore with chat_id: {chat_id}")
+                # Write the turn in the background so the response isn't held up
+                await persistence_queue.enqueue_turn(user_id, chat_id, user_message, assistant_message, is_new_chat)
+                logger.info(f"Queued messages for Firestore with chat_id: {chat_id}")
             except Exception as save_error:
                 logger.error(f"Failed to save messages: {str(save_error)}")
         
@@ -228,7 +372,11 @@ async def upload_image(
         return ChatResponse(
             content=claude_response["content"],
             chat_id=chat_id,
-            image_url=image_url
+            image_url=image_url,
+            thumbnail_url=thumbnail_url,
+            image_id=image_id,
+            model=claude_response.get("model"),
+            usage=claude_response.get("usage")
         )
     
     except HTTPException:
@@ -238,13 +386,20 @@ async def upload_image(
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 @router.get("/chats")
-async def get_chats(user_id: str = Depends(get_user_id)):
-    """Get list of user's chats"""
+async def get_chats(
+    cursor: Optional[str] = None,
+    limit: int = 20,
+    user_id: str = Depends(get_user_id)
+):
+    """Get a page of the user's chats, newest first"""
     if user_id == "anonymous":
         raise HTTPException(status_code=401, detail="Authentication required")
     
-    chats = firebase_service.get_chat_history(user_id)
-    return {"chats": chats}
+    # Firestore calls block, so they run off the event loop
+    chats, next_cursor = await asyncio.to_thread(
+        firebase_service.get_chat_list, user_id, limit=min(max(limit, 1), 100), cursor=cursor
+    )
+    return {"chats": chats, "next_cursor": next_cursor}
 
 @router.get("/chats/{chat_id}")
 async def get_chat(chat_id: str, user_id: str = Depends(get_user_id)):
@@ -252,20 +407,43 @@ async def get_chat(chat_id: str, user_id: str = Depends(get_user_id)):
     if user_id == "anonymous":
         raise HTTPException(status_code=401, detail="Authentication required")
     
-    messages = firebase_service.get_chat_history(user_id, chat_id)
+    messages = await asyncio.to_thread(firebase_service.get_chat_history, user_id, chat_id)
     return {"messages": messages}
 
+@router.get("/stats")
+async def get_stats(user_id: str = Depends(require_admin)):
+    """Get runtime counters for the chat service"""
+    return {
+        "streams": claude_service.get_stream_stats(),
+        "usage": claude_service.get_usage_stats(),
+        "single_flight": claude_service.get_single_flight_stats(),
+        "admission": admission.get_admission_stats(),
+        "resilience": resilience.get_resilience_stats(),
+        "routing": model_router.get_routing_stats(),
+        "history_cache": firebase_service.get_history_cache_stats(),
+        "persistence": persistence_queue.get_persist_stats(),
+        "token_cache": firebase_service.get_token_cache_stats(),
+        "image_pool": image_utils.get_image_pool_stats(),
+        "image_handles": image_store.get_image_store_stats(),
+        "response_cache": response_cache.get_response_cache_stats()
+    }
+
 @router.post("/chat/stream")
 async def chat_stream(
     request: ChatRequest,
+    http_request: Request,
     user_id: str = Depends(get_user_id)
 ):
     """Handle streaming chat requests with text and optional image"""
     try:
         logger.info(f"Received streaming chat request from user {user_id}")
+        _check_rate(user_id, http_request)
+        
+        # Assign the chat ID up front so the metadata event can carry it
+        chat_id, is_new_chat = _resolve_chat_id(user_id, request.chat_id)
         
         # First, check if Claude service is available
-        if not claude_service.client:
+        if not claude_service.async_client:
             logger.error("Claude API client is not initialized")
             raise HTTPException(status_code=503, detail="Claude API service is unavailable")
         
@@ -273,80 +451,127 @@ async def chat_stream(
         image_url = None
         image_data = None
         image_type = None
+        image_id = None
         
-        if request.image_data:
+        if request.image_id and not request.image_data:
+            # Reuse an image processed earlier in this chat
+            image_data, image_type, image_url = await _get_image_handle(user_id, request.chat_id, request.image_id)
+            image_id = request.image_id
+        elif request.image_data:
             logger.info("Processing image data")
             try:
-                # Compress image if needed
-                image_data, image_type = compress_image(request.image_data)
-                
-                # Upload to Firebase Storage if authenticated
-                if user_id != "anonymous":
-                    image_url = firebase_service.upload_image(
-                        user_id=user_id,
-                        image_data=base64.b64decode(image_data),
-                        image_type=image_type
-                    )
-                    logger.info(f"Image uploaded: {image_url}")
+                image_bytes, _ = image_utils.parse_data_url(request.image_data)
+                image_data, image_type, image_url = await _prepare_image(user_id, image_bytes)
+                image_id = _keep_image_handle(user_id, chat_id, image_data, image_type, image_url)
+            except HTTPException:
+                raise
             except Exception as img_error:
                 logger.error(f"Image processing error: {str(img_error)}")
         
+        # None when the thumbnail could not be made
+        thumbnail_url = await firebase_service.get_thumbnail_url_async(image_url)
+        
         # Get chat history if this is a continuation
         chat_history = []
+        summary = None
         if request.chat_id and user_id != "anonymous":
             try:
-                chat_history = firebase_service.get_chat_history(user_id, request.chat_id)
+                summary, chat_history = await context_service.get_context_async(user_id, request.chat_id)
                 logger.info(f"Retrieved {len(chat_history)} messages from chat history")
             except Exception as hist_error:
                 logger.error(f"Failed to get chat history: {str(hist_error)}")
         
+        # The slot is held until the stream ends
+        slot = await _acquire_slot()
+        
         # Call Claude API with streaming
+        stream = claude_service.stream_message(
+            message=request.message,
+            image_data=image_data,
+            image_type=image_type,
+            chat_history=chat_history,
+            system_prompt=request.system_prompt,
+            summary=summary,
+            routing_hint=request.routing_hint,
+            image_id=image_id
+        )
+        
+        # Wait for the first token before answering, so a failed or
+        # overloaded upstream is an HTTP error (503 with Retry-After) rather
+        # than an error inside a 200 stream
+        try:
+            first_chunk = await anext(stream, None)
+        except BaseException as stream_error:
+            await stream.aclose()
+            slot.release()
+            if isinstance(stream_error, resilience.UpstreamUnavailable):
+                raise _claude_error({"error": str(stream_error), "status_code": 503, "retry_after": stream_error.retry_after})
+            if isinstance(stream_error, Exception):
+                logger.error(f"Claude API error: {str(stream_error)}")
+                raise _claude_error({"error": str(stream_error)})
+            raise
+        
         async def stream_response():
             # First yield chat ID and image URL
             metadata = {
                 "type": "metadata",
-                "chat_id": request.chat_id,
-                "image_url": image_url
+                "chat_id": chat_id,
+                "image_url": image_url,
+                "thumbnail_url": thumbnail_url,
+                "image_id": image_id
             }
             yield f"data: {json.dumps(metadata)}\n\n"
             
             # Initialize accumulating message content
             accumulated_content = ""
+            completed = False
             
-            async for chunk in claude_service.stream_message(
-                message=request.message,
-                image_data=image_data,
-                image_type=image_type,
-                chat_history=chat_history,
-                system_prompt=request.system_prompt
-            ):
-                # Send the chunk
-                yield f"data: {json.dumps({'type': 'content', 'content': chunk})}\n\n"
-                accumulated_content += chunk
+            try:
+                chunk = first_chunk
+                while chunk is not None:
+                    # Send the chunk
+                    yield f"data: {json.dumps({'type': 'content', 'content': chunk})}\n\n"
+                    accumulated_content += chunk
+                    
+                    # Stop pulling tokens as soon as the client goes away
+                    if await http_request.is_disconnected():
+                        logger.info(f"Client disconnected, cancelling stream for user {user_id}")
+                        break
+                    chunk = await anext(stream, None)
+                else:
+                    completed = True
+            except Exception as stream_error:
+                # Too late for an HTTP error; the partial reply is saved as interrupted
+                logger.error(f"Claude stream failed after the first token: {str(stream_error)}")
+                yield f"data: {json.dumps({'type': 'error', 'error': 'The response was interrupted, please try again'})}\n\n"
+            finally:
+                if not completed:
+                    # Persist whatever was generated before the disconnect or failure
+                    _save_truncated_turn(user_id, chat_id, is_new_chat, request.message, image_url, thumbnail_url, accumulated_content)
+                # Closing the generator cancels the upstream Anthropic stream
+                await stream.aclose()
+                slot.release()
+            
+            if not completed:
+                return
             
             # Save messages to Firestore if authenticated
-            chat_id = request.chat_id
             if user_id != "anonymous":
                 try:
-                    # Save user message
                     user_message = {
                         "content": request.message,
                         "role": "user",
-                        "chat_id": chat_id,
-                        "image_url": image_url
+                        "image_url": image_url,
+                        "thumbnail_url": thumbnail_url
                     }
-                    
-                    chat_id = firebase_service.save_chat_message(user_id, user_message)
-                    
-                    # Save assistant response
                     assistant_message = {
                         "content": accumulated_content,
-                        "role": "assistant",
-                        "chat_id": chat_id
+                        "role": "assistant"
                     }
                     
-                    firebase_service.save_chat_message(user_id, assistant_message)
-                    logger.info(f"Saved messages to Firestore with chat_id: {chat_id}")
+                    # Write the turn in the background so the response isn't held up
+                    await persistence_queue.enqueue_turn(user_id, chat_id, user_message, assistant_message, is_new_chat)
+                    logger.info(f"Queued messages for Firestore with chat_id: {chat_id}")
                     
                     # Send the final chat ID
                     final_data = {
@@ -360,9 +585,15 @@ async def chat_stream(
             # End the stream
             yield "data: [DONE]\n\n"
             
+        async def close_stream():
+            await stream.aclose()
+            slot.release()
+        
         return StreamingResponse(
             stream_response(),
-            media_type="text/event-stream"
+            media_type="text/event-stream",
+            # Frees the slot and the upstream stream if the response never got to run
+            background=BackgroundTask(close_stream)
         )
         
     except HTTPException:
@@ -0,0 +1,165 @@
+from fastapi import APIRouter, HTTPException, Request
+from starlette.responses import Response
+from typing import Optional, Tuple
+import os
+import re
+import stat
+import logging
+
+import anyio
+
+from app.services.mock_storage import UPLOADS_DIR
+
+router = APIRouter(prefix="/uploads", tags=["uploads"])
+logger = logging.getLogger(__name__)
+
+# Content-addressed files never change, so clients may cache them forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+MUTABLE_CACHE_CONTROL = "public, max-age=3600"
+
+CHUNK_SIZE = 64 * 1024
+
+CONTENT_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+}
+
+# <sha256>.<ext> or <sha256>.thumb.<ext>
+_CONTENT_ADDRESSED = re.compile(r"^([0-9a-f]{64}(?:\.thumb)?)\.[a-z]+$")
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+class ImageFileResponse(Response):
+    """
+    File response that sends a byte range of a file
+    
+    Uses the ASGI pathsend/zerocopy extensions when the server offers them
+    so the kernel copies the file straight to the socket, and falls back to
+    reading the file in chunks otherwise.
+    """
+    
+    def __init__(self, path: str, start: int, end: int, status_code: int, headers: dict, head: bool = False):
+        super().__init__(status_code=status_code, headers=headers)
+        self.path = path
+        self.start = start
+        self.end = end
+        self.head = head
+    
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        
+        count = self.end - self.start + 1
+        extensions = scope.get("extensions") or {}
+        if self.head or count <= 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        elif "http.response.pathsend" in extensions and self.start == 0 and self.status_code == 200:
+            await send({"type": "http.response.pathsend", "path": self.path})
+        elif "http.response.zerocopy" in extensions:
+            with open(self.path, "rb") as file:
+                await send({
+                    "type": "http.response.zerocopy",
+                    "file": file,
+                    "offset": self.start,
+                    "count": count,
+                    "more_body": False
+                })
+        else:
+            async with await anyio.open_file(self.path, mode="rb") as file:
+                await file.seek(self.start)
+                remaining = count
+                while remaining > 0:
+                    chunk = await file.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+                if remaining > 0:
+                    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+def _parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single "bytes=" range into inclusive (start, end)
+    
+    Returns None for headers we don't handle (e.g. multiple ranges), which
+    means the whole file is sent. Raises ValueError for unsatisfiable ranges.
+    """
+    match = _RANGE.match(range_header.strip())
+    if not match:
+        return None
+    
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(0, size - length), size - 1
+    
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+def _etag_matches(header: Optional[str], etag: str) -> bool:
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in [tag.strip().removeprefix("W/") for tag in header.split(",")]
+
+@router.api_route("/{file_path:path}", methods=["GET", "HEAD"])
+async def serve_upload(file_path: str, request: Request):
+    """Serve an uploaded image with immutable caching, ETags and Range support"""
+    uploads_root = os.path.realpath(UPLOADS_DIR)
+    full_path = os.path.realpath(os.path.join(uploads_root, file_path))
+    if os.path.commonpath([uploads_root, full_path]) != uploads_root:
+        raise HTTPException(status_code=404, detail="Not found")
+    
+    try:
+        stat_result = await anyio.to_thread.run_sync(os.stat, full_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Not found")
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise HTTPException(status_code=404, detail="Not found")
+    
+    size = stat_result.st_size
+    name = os.path.basename(full_path)
+    content_addressed = _CONTENT_ADDRESSED.match(name)
+    if content_addressed:
+        # The name is the hash of the content, which makes it a strong validator
+        etag = f'"{content_addressed.group(1)}"'
+        cache_control = IMMUTABLE_CACHE_CONTROL
+    else:
+        etag = f'"{stat_result.st_mtime_ns:x}-{size:x}"'
+        cache_control = MUTABLE_CACHE_CONTROL
+    
+    headers = {
+        "etag": etag,
+        "cache-control": cache_control,
+        "accept-ranges": "bytes",
+        "content-type": CONTENT_TYPES.get(os.path.splitext(name)[1].lower(), "application/octet-stream"),
+    }
+    
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={k: v for k, v in headers.items() if k != "content-type"})
+    
+    start, end, status_code = 0, size - 1, 200
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() == etag):
+        try:
+            byte_range = _parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={"content-range": f"bytes */{size}", **headers})
+        if byte_range:
+            start, end = byte_range
+            status_code = 206
+            headers["content-range"] = f"bytes {start}-{end}/{size}"
+    
+    headers["content-length"] = str(end - start + 1)
+    return ImageFileResponse(full_path, start, end, status_code, headers, head=request.method == "HEAD")
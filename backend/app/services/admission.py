@@ -0,0 +1,185 @@
+import os
+import math
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Dict, Optional
+
+from app.utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Per-user token bucket: sustained requests per second and burst size
+ADMISSION_USER_RATE = float(os.environ.get("ADMISSION_USER_RATE", "0.5"))
+ADMISSION_USER_BURST = float(os.environ.get("ADMISSION_USER_BURST", "10"))
+ADMISSION_MAX_USERS = int(os.environ.get("ADMISSION_MAX_USERS", "10000"))
+
+# Claude calls in flight in this worker, and requests allowed to wait for a slot
+ADMISSION_MAX_INFLIGHT = int(os.environ.get("ADMISSION_MAX_INFLIGHT", "64"))
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", "128"))
+# Longest a request waits for a slot before it is shed
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "10"))
+
+# Reverse proxies in front of the app that append to X-Forwarded-For (1 on
+# Railway). Anonymous callers are rate limited by the address the outermost
+# trusted proxy saw; 0 uses the socket peer and ignores the header.
+ADMISSION_TRUSTED_PROXIES = int(os.environ.get("ADMISSION_TRUSTED_PROXIES", "0"))
+
+class AdmissionRejected(Exception):
+    """Raised when a request is shed; retry_after is a hint in seconds"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+# user key -> (tokens, last refill time). Idle buckets refill completely, so
+# dropping them once they have been idle that long changes nothing.
+_buckets = TTLCache(
+    maxsize=ADMISSION_MAX_USERS,
+    ttl=ADMISSION_USER_BURST / ADMISSION_USER_RATE if ADMISSION_USER_RATE > 0 else None
+)
+
+def client_address(forwarded_for: Optional[str], peer: Optional[str]) -> str:
+    """
+    The address to rate limit an anonymous caller by
+
+    Each trusted proxy appends the address it received the request from, so
+    the entry ADMISSION_TRUSTED_PROXIES places from the end is the client;
+    entries further left are whatever the client sent and can't be trusted.
+    """
+    if ADMISSION_TRUSTED_PROXIES > 0 and forwarded_for:
+        hops = [hop.strip() for hop in forwarded_for.split(",") if hop.strip()]
+        if len(hops) >= ADMISSION_TRUSTED_PROXIES:
+            return hops[-ADMISSION_TRUSTED_PROXIES]
+    return peer or ""
+
+_inflight = 0
+_waiters: "deque[asyncio.Future]" = deque()
+# Moving average of how long a slot is held, used for Retry-After hints
+_hold_time = 5.0
+_wait_times: "deque[float]" = deque(maxlen=1000)
+
+admission_stats = {
+    "admitted": 0,
+    "queued": 0,
+    "rate_limited": 0,
+    "queue_full": 0,
+    "timed_out": 0,
+    "max_queue_depth": 0,
+    "total_wait_seconds": 0.0,
+    "max_wait_seconds": 0.0,
+}
+
+def check_rate(key: str):
+    """Take a token from the caller's bucket or raise AdmissionRejected"""
+    if ADMISSION_USER_RATE <= 0:
+        return
+
+    now = time.monotonic()
+    tokens, last = _buckets.get(key, (ADMISSION_USER_BURST, now))
+    tokens = min(ADMISSION_USER_BURST, tokens + (now - last) * ADMISSION_USER_RATE)
+    if tokens < 1:
+        _buckets.set(key, (tokens, now))
+        admission_stats["rate_limited"] += 1
+        raise AdmissionRejected("Too many requests", (1 - tokens) / ADMISSION_USER_RATE)
+    _buckets.set(key, (tokens - 1, now))
+
+def _queue_retry_after() -> float:
+    """Rough time until a slot frees up for a request joining the back of the queue"""
+    return _hold_time * (len(_waiters) + 1) / ADMISSION_MAX_INFLIGHT
+
+def _release_slot():
+    """Hand a freed slot straight to the oldest waiter that is still waiting"""
+    global _inflight
+    while _waiters:
+        waiter = _waiters.popleft()
+        if not waiter.done():
+            waiter.set_result(None)
+            return
+    _inflight -= 1
+
+class Slot:
+    """An admitted Claude call; release() is idempotent"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(self):
+        global _hold_time
+        if self.released:
+            return
+        self.released = True
+        _hold_time = 0.9 * _hold_time + 0.1 * (time.monotonic() - self.started)
+        _release_slot()
+
+def _record_wait(waited: float):
+    _wait_times.append(waited)
+    admission_stats["total_wait_seconds"] += waited
+    admission_stats["max_wait_seconds"] = max(admission_stats["max_wait_seconds"], waited)
+
+async def acquire() -> Slot:
+    """
+    Wait for an in-flight slot
+
+    Waiters are served first come, first served. A request is shed with
+    AdmissionRejected when the wait queue is full or its deadline passes.
+    """
+    global _inflight
+    if _inflight < ADMISSION_MAX_INFLIGHT and not _waiters:
+        _inflight += 1
+        admission_stats["admitted"] += 1
+        _record_wait(0.0)
+        return Slot()
+
+    if len(_waiters) >= ADMISSION_MAX_QUEUE:
+        admission_stats["queue_full"] += 1
+        raise AdmissionRejected("Server is busy", _queue_retry_after())
+
+    waiter = asyncio.get_running_loop().create_future()
+    _waiters.append(waiter)
+    admission_stats["queued"] += 1
+    admission_stats["max_queue_depth"] = max(admission_stats["max_queue_depth"], len(_waiters))
+    started = time.monotonic()
+    try:
+        await asyncio.wait({waiter}, timeout=ADMISSION_QUEUE_TIMEOUT)
+    except asyncio.CancelledError:
+        # A slot handed over just as the caller went away goes to the next waiter
+        if waiter.done():
+            _release_slot()
+        else:
+            waiter.cancel()
+            _waiters.remove(waiter)
+        raise
+
+    _record_wait(time.monotonic() - started)
+    if not waiter.done():
+        waiter.cancel()
+        _waiters.remove(waiter)
+        admission_stats["timed_out"] += 1
+        logger.warning(f"Request shed after waiting {ADMISSION_QUEUE_TIMEOUT}s for a Claude slot")
+        raise AdmissionRejected("Server is busy", _queue_retry_after())
+
+    admission_stats["admitted"] += 1
+    return Slot()
+
+def _percentile(values, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def get_admission_stats() -> Dict[str, Any]:
+    """Return admission counters, current queue depth and recent wait times"""
+    return {
+        **admission_stats,
+        "inflight": _inflight,
+        "max_inflight": ADMISSION_MAX_INFLIGHT,
+        "queue_depth": len(_waiters),
+        "max_queue": ADMISSION_MAX_QUEUE,
+        "wait_p50_seconds": _percentile(_wait_times, 0.5),
+        "wait_p95_seconds": _percentile(_wait_times, 0.95),
+        "tracked_users": len(_buckets),
+    }
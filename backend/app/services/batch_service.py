@@ -0,0 +1,421 @@
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import anthropic
+
+from app.services import claude_service, firebase_service, resilience
+from app.utils import image_utils
+from app.utils.ids import ulid
+
+logger = logging.getLogger(__name__)
+
+# Where job state and results are kept; a job is resumed from its directory
+BATCH_JOBS_DIR = os.environ.get("BATCH_JOBS_DIR", "batch_jobs")
+# Requests and payload bytes per Message Batch (the API allows 100k / 256MB)
+BATCH_MAX_REQUESTS = int(os.environ.get("BATCH_MAX_REQUESTS", "10000"))
+BATCH_MAX_BYTES = int(os.environ.get("BATCH_MAX_BYTES", str(128 * 1024 * 1024)))
+# Status polling starts at the interval and backs off to the maximum
+BATCH_POLL_INTERVAL = float(os.environ.get("BATCH_POLL_INTERVAL", "30"))
+BATCH_POLL_MAX_INTERVAL = float(os.environ.get("BATCH_POLL_MAX_INTERVAL", "300"))
+# How far apart (in seconds, allowing for clock skew) a batch's creation and
+# a lost create request may be for the batch to be taken as its result
+BATCH_RECONCILE_WINDOW = float(os.environ.get("BATCH_RECONCILE_WINDOW", "600"))
+
+CUSTOM_ID_PATTERN = re.compile(r"^[a-zA-Z0-9_-]{1,64}$")
+
+class BatchJobError(Exception):
+    """Raised for invalid workloads and jobs that can't be found or run"""
+
+def _job_dir(job_id: str, jobs_dir: Optional[str] = None) -> str:
+    return os.path.join(jobs_dir or BATCH_JOBS_DIR, job_id)
+
+def _save_job(job: Dict[str, Any]):
+    """Write job state atomically so an interrupted write never loses it"""
+    path = os.path.join(job["dir"], "job.json")
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump({key: value for key, value in job.items() if key != "dir"}, f, indent=2)
+    os.replace(temp_path, path)
+
+def load_job(job_id: str, jobs_dir: Optional[str] = None) -> Dict[str, Any]:
+    """Read a job's state from disk"""
+    directory = _job_dir(job_id, jobs_dir)
+    try:
+        with open(os.path.join(directory, "job.json")) as f:
+            job = json.load(f)
+    except FileNotFoundError:
+        raise BatchJobError(f"No batch job {job_id} in {jobs_dir or BATCH_JOBS_DIR}")
+    job["dir"] = directory
+    return job
+
+def list_jobs(jobs_dir: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Return the state of every job, newest first"""
+    jobs_dir = jobs_dir or BATCH_JOBS_DIR
+    if not os.path.isdir(jobs_dir):
+        return []
+    return [load_job(job_id, jobs_dir) for job_id in sorted(os.listdir(jobs_dir), reverse=True)
+            if os.path.exists(os.path.join(jobs_dir, job_id, "job.json"))]
+
+def _read_workload(path: str) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """Yield (line number, item) for each non-blank line of a JSONL workload"""
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            if line.strip():
+                yield line_number, json.loads(line)
+
+def _custom_id(line_number: int, item: Dict[str, Any]) -> str:
+    return str(item.get("custom_id") or f"line-{line_number}")
+
+def _validate_workload(path: str) -> int:
+    """
+    Check a workload before anything is submitted
+
+    Each line is a JSON object with a "message" and optionally custom_id,
+    system_prompt, routing_hint, chat_history, and an image given either as
+    image_path (a local file) or as user_id + image_id (a stored upload).
+    Returns the number of requests.
+    """
+    seen = set()
+    count = 0
+    try:
+        for line_number, item in _read_workload(path):
+            if not isinstance(item, dict) or not isinstance(item.get("message"), str):
+                raise BatchJobError(f"Line {line_number}: expected an object with a message")
+            custom_id = _custom_id(line_number, item)
+            if not CUSTOM_ID_PATTERN.match(custom_id):
+                raise BatchJobError(f"Line {line_number}: custom_id must be 1-64 letters, digits, - or _")
+            if custom_id in seen:
+                raise BatchJobError(f"Line {line_number}: duplicate custom_id {custom_id}")
+            seen.add(custom_id)
+            count += 1
+    except json.JSONDecodeError as e:
+        raise BatchJobError(f"Invalid JSON in workload: {str(e)}")
+    if not count:
+        raise BatchJobError("Workload is empty")
+    return count
+
+def create_job(input_path: str, jobs_dir: Optional[str] = None) -> Dict[str, Any]:
+    """Validate a JSONL workload and record a new job for it; nothing is sent yet"""
+    input_path = os.path.abspath(input_path)
+    total = _validate_workload(input_path)
+
+    job_id = f"job_{ulid()}"
+    directory = _job_dir(job_id, jobs_dir)
+    os.makedirs(directory)
+    job = {
+        "job_id": job_id,
+        "input": input_path,
+        "total": total,
+        "created_at": time.time(),
+        "status": "created",
+        # One entry per Message Batch: the input lines it covers and its state
+        "chunks": [],
+        "dir": directory,
+    }
+    _save_job(job)
+    logger.info(f"Created batch job {job_id} for {total} requests")
+    return job
+
+async def _load_image(item: Dict[str, Any]) -> Tuple[Optional[bytes], Optional[str]]:
+    """Read and normalize the image a workload item refers to, if any"""
+    if item.get("image_path"):
+        with open(item["image_path"], "rb") as f:
+            image_bytes = f.read()
+    elif item.get("user_id") and item.get("image_id"):
+        stored = await firebase_service.read_image_async(item["user_id"], item["image_id"])
+        if not stored:
+            raise BatchJobError(f"Stored image {item['image_id']} not found")
+        # Stored uploads are already normalized
+        return stored[0], stored[1]
+    else:
+        return None, None
+
+    image_bytes, image_type, _ = await image_utils.normalize_image_async(image_bytes)
+    return image_bytes, image_type
+
+async def _build_batch_request(line_number: int, item: Dict[str, Any]) -> Dict[str, Any]:
+    image_data, image_type = await _load_image(item)
+    params = claude_service.build_request(
+        message=item["message"],
+        image_data=image_data,
+        image_type=image_type,
+        chat_history=item.get("chat_history"),
+        system_prompt=item.get("system_prompt"),
+        routing_hint=item.get("routing_hint")
+    )
+    return {"custom_id": _custom_id(line_number, item), "params": params}
+
+async def _submit_remaining(job: Dict[str, Any]):
+    """
+    Send the lines not yet covered by a Message Batch, one batch at a time
+
+    Each batch is recorded in the job as soon as it is created, so a resumed
+    job carries on after the last recorded batch once any creation left
+    unconfirmed by an interruption has been settled.
+    """
+    if job.get("submitting"):
+        await _reconcile_submission(job)
+
+    submitted = sum(chunk["count"] for chunk in job["chunks"])
+    if submitted >= job["total"]:
+        return
+
+    requests: List[Dict[str, Any]] = []
+    size = 0
+    start = submitted
+    index = 0
+    for line_number, item in _read_workload(job["input"]):
+        index += 1
+        if index <= submitted:
+            continue
+        request = await _build_batch_request(line_number, item)
+        request_size = len(json.dumps(request))
+        if requests and (len(requests) >= BATCH_MAX_REQUESTS or size + request_size > BATCH_MAX_BYTES):
+            await _create_batch(job, start, requests)
+            start += len(requests)
+            requests, size = [], 0
+        requests.append(request)
+        size += request_size
+    if requests:
+        await _create_batch(job, start, requests)
+
+def _add_chunk(job: Dict[str, Any], start: int, count: int, batch):
+    """Record a created batch as the job's next chunk"""
+    job["chunks"].append({
+        "index": len(job["chunks"]),
+        "start": start,
+        "count": count,
+        "batch_id": batch.id,
+        "status": batch.processing_status,
+        "request_counts": batch.request_counts.model_dump(),
+    })
+    job.pop("submitting", None)
+    job["status"] = "running"
+    _save_job(job)
+
+async def _create_batch(job: Dict[str, Any], start: int, requests: List[Dict[str, Any]]):
+    """
+    Create one Message Batch and record it in the job
+
+    Creating a batch is not idempotent: a request that timed out may still
+    have created a (billed) batch. So it is only sent again when the API
+    answered that it was turned away (429 or 529). The attempt is recorded
+    before it is sent and stays in the job when the outcome is unknown, so
+    a resume settles it with _reconcile_submission before sending anything.
+    """
+    job["submitting"] = {"start": start, "count": len(requests), "attempted_at": time.time()}
+    _save_job(job)
+    attempt = 0
+    while True:
+        try:
+            batch = await claude_service.async_client.messages.batches.create(requests=requests)
+            break
+        except anthropic.APIStatusError as e:
+            if e.status_code in (429, 529):
+                # Turned away before anything was created, so sending it again is safe
+                try:
+                    delay = resilience.next_delay(e, attempt)
+                except Exception as final:
+                    job.pop("submitting")
+                    _save_job(job)
+                    raise BatchJobError(f"Claude API is too busy to create the batch: {str(final)}")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            if e.status_code < 500:
+                # Rejected outright, nothing was created
+                job.pop("submitting")
+                _save_job(job)
+                raise BatchJobError(f"Batch rejected by the API: {str(e)}")
+            raise BatchJobError(f"Batch creation failed and may still have gone through; resume to check: {str(e)}")
+        except Exception as e:
+            raise BatchJobError(f"Batch creation failed and may still have gone through; resume to check: {str(e)}")
+    _add_chunk(job, start, len(requests), batch)
+    logger.info(f"Job {job['job_id']}: submitted {len(requests)} requests as {batch.id}")
+
+def _chunk_custom_ids(job: Dict[str, Any], start: int, count: int) -> List[str]:
+    """custom_ids of the workload lines a chunk covers, in order"""
+    ids = []
+    for index, (line_number, item) in enumerate(_read_workload(job["input"])):
+        if index >= start + count:
+            break
+        if index >= start:
+            ids.append(_custom_id(line_number, item))
+    return ids
+
+async def _batch_custom_ids(batch) -> List[str]:
+    """
+    custom_ids of the requests in a batch
+
+    The API only gives them out with the results, so a batch that is still
+    running is polled until it has ended.
+    """
+    interval = BATCH_POLL_INTERVAL
+    while batch.processing_status != "ended":
+        logger.info(f"Waiting for {batch.id} to end to see which requests it holds")
+        await asyncio.sleep(interval)
+        interval = min(BATCH_POLL_MAX_INTERVAL, interval * 2)
+        batch = await resilience.call(lambda: claude_service.async_client.messages.batches.retrieve(batch.id))
+    decoder = await resilience.call(lambda: claude_service.async_client.messages.batches.results(batch.id))
+    return [item.custom_id async for item in decoder]
+
+async def _reconcile_submission(job: Dict[str, Any]):
+    """
+    Settle a batch creation whose outcome is unknown
+
+    Batches are listed newest first. One created within
+    BATCH_RECONCILE_WINDOW of the attempt, holding as many requests, not
+    belonging to any job in the jobs directory and whose custom_ids are the
+    ones that were sent is taken to be the lost one and adopted; if there is
+    none the requests are sent again.
+    """
+    pending = job["submitting"]
+    known = {chunk["batch_id"] for other in list_jobs(os.path.dirname(job["dir"])) for chunk in other["chunks"]}
+    earliest = pending["attempted_at"] - BATCH_RECONCILE_WINDOW
+    latest = pending["attempted_at"] + BATCH_RECONCILE_WINDOW
+    expected = None
+    try:
+        async for batch in claude_service.async_client.messages.batches.list(limit=100):
+            created_at = batch.created_at.timestamp()
+            if created_at < earliest:
+                break
+            if created_at > latest or batch.id in known:
+                continue
+            if sum(batch.request_counts.model_dump().values()) != pending["count"]:
+                continue
+            # Another job with as many requests may have submitted at the same time
+            if expected is None:
+                expected = sorted(_chunk_custom_ids(job, pending["start"], pending["count"]))
+            if sorted(await _batch_custom_ids(batch)) != expected:
+                continue
+            _add_chunk(job, pending["start"], pending["count"], batch)
+            logger.info(f"Job {job['job_id']}: found batch {batch.id} from an unconfirmed submission")
+            return
+    except anthropic.APIError as e:
+        raise BatchJobError(f"Could not list batches to check an unconfirmed submission: {str(e)}")
+
+    job.pop("submitting")
+    _save_job(job)
+    logger.info(f"Job {job['job_id']}: unconfirmed submission created no batch, sending it again")
+
+def _result_record(item) -> Dict[str, Any]:
+    """Flatten one batch result into the line written to the results file"""
+    result = item.result
+    record = {"custom_id": item.custom_id, "status": result.type}
+    if result.type == "succeeded":
+        message = result.message
+        record["content"] = message.content[0].text if message.content else ""
+        record["model"] = message.model
+        record["stop_reason"] = message.stop_reason
+        record["usage"] = message.usage.model_dump(exclude_none=True)
+    elif result.type == "errored":
+        record["error"] = result.error.error.model_dump()
+    return record
+
+async def _download_results(job: Dict[str, Any], chunk: Dict[str, Any]):
+    """Stream a finished batch's results to disk, line by line"""
+    path = os.path.join(job["dir"], f"results-{chunk['index']:04d}.jsonl")
+    temp_path = f"{path}.part"
+    decoder = await resilience.call(lambda: claude_service.async_client.messages.batches.results(chunk["batch_id"]))
+    with open(temp_path, "w") as f:
+        async for item in decoder:
+            f.write(json.dumps(_result_record(item)) + "\n")
+    # A download cut short is simply fetched again on resume
+    os.replace(temp_path, path)
+    chunk["status"] = "downloaded"
+    chunk["results"] = os.path.basename(path)
+    _save_job(job)
+    logger.info(f"Job {job['job_id']}: wrote results of {chunk['batch_id']}")
+
+async def refresh_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Poll every unfinished batch of a job and download the results of finished ones"""
+    for chunk in job["chunks"]:
+        if chunk["status"] == "downloaded":
+            continue
+        if chunk["status"] != "ended":
+            batch = await resilience.call(lambda: claude_service.async_client.messages.batches.retrieve(chunk["batch_id"]))
+            chunk["status"] = batch.processing_status
+            chunk["request_counts"] = batch.request_counts.model_dump()
+            _save_job(job)
+        if chunk["status"] == "ended":
+            await _download_results(job, chunk)
+
+    submitted = sum(chunk["count"] for chunk in job["chunks"])
+    if (submitted >= job["total"] or job["status"] == "canceled") and \
+            all(chunk["status"] == "downloaded" for chunk in job["chunks"]):
+        _merge_results(job)
+    return job
+
+def _merge_results(job: Dict[str, Any]):
+    """Concatenate the per-batch result files into results.jsonl and finish the job"""
+    path = os.path.join(job["dir"], "results.jsonl")
+    temp_path = f"{path}.part"
+    with open(temp_path, "w") as out:
+        for chunk in job["chunks"]:
+            with open(os.path.join(job["dir"], chunk["results"])) as f:
+                for line in f:
+                    out.write(line)
+    os.replace(temp_path, path)
+    if job["status"] != "canceled":
+        job["status"] = "completed"
+    job["results"] = path
+    job["completed_at"] = time.time()
+    _save_job(job)
+    logger.info(f"Job {job['job_id']} completed, results in {path}")
+
+async def run_job(job: Dict[str, Any], wait: bool = True) -> Dict[str, Any]:
+    """
+    Drive a job as far as it can go: submit what hasn't been submitted, then
+    poll until every batch has ended and its results are on disk
+
+    Safe to call again on an interrupted job; finished steps are skipped.
+    With wait=False it returns after one round of polling.
+    """
+    if not claude_service.async_client:
+        raise BatchJobError("Claude API client is not initialized")
+    if job.get("completed_at"):
+        return job
+
+    # A canceled job only collects what its batches got done
+    if job["status"] != "canceled":
+        await _submit_remaining(job)
+    interval = BATCH_POLL_INTERVAL
+    while True:
+        await refresh_job(job)
+        if job.get("completed_at") or not wait:
+            return job
+        logger.info(f"Job {job['job_id']}: {summarize_job(job)['request_counts']}")
+        await asyncio.sleep(interval)
+        interval = min(BATCH_POLL_MAX_INTERVAL, interval * 2)
+
+async def cancel_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Stop submitting and ask Anthropic to cancel every batch that is still running"""
+    for chunk in job["chunks"]:
+        if chunk["status"] == "in_progress":
+            batch = await resilience.call(lambda: claude_service.async_client.messages.batches.cancel(chunk["batch_id"]))
+            chunk["status"] = batch.processing_status
+    job["status"] = "canceled"
+    _save_job(job)
+    return job
+
+def summarize_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Job progress with request counts summed over its batches"""
+    counts: Dict[str, int] = {}
+    for chunk in job["chunks"]:
+        for key, value in chunk.get("request_counts", {}).items():
+            counts[key] = counts.get(key, 0) + value
+    return {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "total": job["total"],
+        "submitted": sum(chunk["count"] for chunk in job["chunks"]),
+        "batches": len(job["chunks"]),
+        "unconfirmed_submission": "submitting" in job,
+        "request_counts": counts,
+        "results": job.get("results"),
+    }
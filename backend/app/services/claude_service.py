@@ -1,168 +1,613 @@
 import os
+import time
+import base64
+import asyncio
 import logging
 import anthropic
-from typing import List, Dict, Any, Optional, AsyncGenerator
+import httpx
+from typing import List, Dict, Any, Optional, AsyncGenerator, Union
+
+from app.services import model_router, resilience, response_cache
+from app.utils.tokens import estimate_content_tokens, estimate_tokens
 
 logger = logging.getLogger(__name__)
 
-# Initialize Anthropic client
+DEFAULT_SYSTEM_PROMPT = "You are Claude, a helpful AI assistant. Respond in a helpful, accurate, and engaging way."
+DEFAULT_TEMPERATURE = 0.7
+
+# Connection pool settings for the shared async HTTP client
+MAX_CONNECTIONS = int(os.environ.get("ANTHROPIC_MAX_CONNECTIONS", "500"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("ANTHROPIC_MAX_KEEPALIVE_CONNECTIONS", "100"))
+REQUEST_TIMEOUT = float(os.environ.get("ANTHROPIC_TIMEOUT", "600"))
+
+# Maximum number of tokens buffered per stream before the upstream read pauses
+STREAM_QUEUE_SIZE = int(os.environ.get("CLAUDE_STREAM_QUEUE_SIZE", "64"))
+
+# Identical requests in flight at the same time share one upstream call
+SINGLE_FLIGHT_ENABLED = os.environ.get("CLAUDE_SINGLE_FLIGHT", "true").lower() == "true"
+
+# Counters for streams aborted because the consumer went away, and the
+# (estimated) output tokens those streams had produced before they were cancelled
+stream_stats = {
+    "cancelled_streams": 0,
+    "tokens_before_cancel": 0,
+}
+
+# Requests that joined an identical call already in flight
+single_flight_stats = {
+    "coalesced_requests": 0,
+    "coalesced_streams": 0,
+}
+
+# Prompt caching: prefixes shorter than this are not worth a cache write
+PROMPT_CACHE_ENABLED = os.environ.get("CLAUDE_PROMPT_CACHE", "true").lower() == "true"
+PROMPT_CACHE_MIN_TOKENS = int(os.environ.get("CLAUDE_PROMPT_CACHE_MIN_TOKENS", "1024"))
+
+# Cheap model used for background summarization of older turns
+SUMMARY_MODEL = os.environ.get("CLAUDE_SUMMARY_MODEL", "claude-3-haiku-20240307")
+SUMMARY_MAX_TOKENS = int(os.environ.get("CLAUDE_SUMMARY_MAX_TOKENS", "1024"))
+SUMMARY_PREAMBLE = "Summary of the earlier part of this conversation:"
+SUMMARY_SYSTEM_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an AI assistant. "
+    "Merge the existing summary with the new messages into one concise summary. Keep facts, "
+    "decisions, names, open questions and user preferences; drop pleasantries. "
+    "Reply with the summary only."
+)
+
+# Cumulative token usage across all requests in this worker
+usage_stats = {
+    "requests": 0,
+    "input_tokens": 0,
+    "output_tokens": 0,
+    "cache_read_input_tokens": 0,
+    "cache_creation_input_tokens": 0,
+}
+
+# Initialize the Anthropic client
 try:
     api_key = os.environ.get("ANTHROPIC_API_KEY")
     if not api_key:
         logger.error("ANTHROPIC_API_KEY environment variable not set")
-        client = None
+        async_client = None
     else:
         # Simple initialization without any proxy parameters
         logger.info(f"Attempting to initialize Anthropic client with API key: {api_key[:8]}...")
-        client = anthropic.Anthropic(api_key=api_key)
+
+        # Async client sharing one pooled HTTP client across all requests in this worker
+        # Retries are left to the resilience layer. ANTHROPIC_BASE_URL points
+        # the client at a local fake server for testing.
+        async_client = anthropic.AsyncAnthropic(
+            api_key=api_key,
+            timeout=REQUEST_TIMEOUT,
+            max_retries=0,
+            http_client=anthropic.DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=MAX_CONNECTIONS,
+                    max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                ),
+                timeout=REQUEST_TIMEOUT,
+            ),
+        )
         logger.info("Anthropic client initialized successfully")
 except Exception as e:
     logger.error(f"Failed to initialize Anthropic client: {str(e)}")
-    client = None
+    async_client = None
 
-def send_message(
-    message: str, 
-    image_data: Optional[str] = None, 
+def get_stream_stats() -> Dict[str, int]:
+    """Return a snapshot of the stream cancellation counters"""
+    return dict(stream_stats)
+
+def get_single_flight_stats() -> Dict[str, int]:
+    """Return coalescing counters and the number of calls currently in flight"""
+    return {
+        **single_flight_stats,
+        "inflight_requests": len(_inflight_calls),
+        "inflight_streams": len(_stream_flights),
+    }
+
+def get_usage_stats() -> Dict[str, int]:
+    """Return a snapshot of the cumulative token usage counters"""
+    return dict(usage_stats)
+
+def _record_usage(usage) -> Dict[str, int]:
+    """Extract token counts (including prompt cache reads/writes) from a response usage object"""
+    counts = {
+        "input_tokens": getattr(usage, "input_tokens", 0) or 0,
+        "output_tokens": getattr(usage, "output_tokens", 0) or 0,
+        "cache_read_input_tokens": getattr(usage, "cache_read_input_tokens", 0) or 0,
+        "cache_creation_input_tokens": getattr(usage, "cache_creation_input_tokens", 0) or 0,
+    }
+    usage_stats["requests"] += 1
+    for key, value in counts.items():
+        usage_stats[key] += value
+    
+    logger.info(
+        f"Claude usage: input={counts['input_tokens']} output={counts['output_tokens']} "
+        f"cache_read={counts['cache_read_input_tokens']} cache_write={counts['cache_creation_input_tokens']}"
+    )
+    return counts
+
+async def close():
+    """Close the shared async HTTP client"""
+    if async_client:
+        await async_client.close()
+    response_cache.close()
+
+def _build_messages(
+    message: str,
+    image_data: Optional[Union[str, bytes]] = None,
+    image_type: Optional[str] = None,
+    chat_history: Optional[List[Dict[str, Any]]] = None
+) -> List[Dict[str, Any]]:
+    """
+    Build the messages array for a Claude request
+    
+    image_data may be raw image bytes or an already base64-encoded string.
+    Raw bytes are base64-encoded here, the only place in the request path.
+    """
+    # Create content array
+    content = []
+    
+    # Add text message if provided
+    if message:
+        content.append({"type": "text", "text": message})
+    
+    # Add image if provided
+    if image_data and image_type:
+        if not isinstance(image_data, str):
+            image_data = base64.b64encode(image_data).decode("ascii")
+        content.append({
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": image_type,
+                "data": image_data
+            }
+        })
+    
+    # Prepare messages array
+    messages = []
+    
+    # Add chat history if provided
+    if chat_history:
+        for msg in chat_history:
+            messages.append({
+                "role": msg.get("role", "user"),
+                "content": msg.get("content", "")
+            })
+    
+    # Add current message
+    messages.append({
+        "role": "user",
+        "content": content
+    })
+    
+    return messages
+
+def _build_system(system_prompt: str, messages: List[Dict[str, Any]], summary: Optional[str] = None) -> Any:
+    """
+    Build the system parameter and place prompt cache breakpoints
+    
+    A breakpoint goes on the system prompt and on the last message of the
+    chat history, so the system prompt plus everything before the current
+    turn is served from the prompt cache on the next request. Breakpoints are
+    only added once the cached prefix is long enough to be cached at all.
+    
+    A rolling summary of older turns, if any, is sent as a second system
+    block after the (cacheable) system prompt.
+    """
+    summary_text = f"{SUMMARY_PREAMBLE}\n{summary}" if summary else None
+    if not PROMPT_CACHE_ENABLED:
+        return f"{system_prompt}\n\n{summary_text}" if summary_text else system_prompt
+    
+    prefix_tokens = estimate_tokens(system_prompt)
+    system = [{"type": "text", "text": system_prompt}]
+    if prefix_tokens >= PROMPT_CACHE_MIN_TOKENS:
+        system[0]["cache_control"] = {"type": "ephemeral"}
+    
+    if summary_text:
+        prefix_tokens += estimate_tokens(summary_text)
+        system.append({"type": "text", "text": summary_text})
+    
+    # Everything except the current user turn is the stable prefix
+    history = messages[:-1]
+    for msg in history:
+        prefix_tokens += estimate_content_tokens(msg["content"])
+    
+    if history and prefix_tokens >= PROMPT_CACHE_MIN_TOKENS:
+        # Mark the last non-empty history message as the end of the cached prefix
+        for msg in reversed(history):
+            content = msg["content"]
+            if isinstance(content, str):
+                if not content:
+                    continue
+                msg["content"] = [{"type": "text", "text": content, "cache_control": {"type": "ephemeral"}}]
+            elif content:
+                content[-1] = {**content[-1], "cache_control": {"type": "ephemeral"}}
+            else:
+                continue
+            break
+    
+    return system
+
+def _route(
+    system: Any,
+    messages: List[Dict[str, Any]],
+    image_data: Optional[Union[str, bytes]],
+    routing_hint: Optional[str],
+    streaming: bool
+) -> Dict[str, Any]:
+    """Pick the model and max_tokens for a request"""
+    return model_router.route(system, messages, has_image=bool(image_data), hint=routing_hint, streaming=streaming)
+
+def _request_key(
+    system: Any,
+    messages: List[Dict[str, Any]],
+    route: Dict[str, Any],
+    image_data: Optional[Union[str, bytes]],
+    image_id: Optional[str]
+) -> Optional[str]:
+    """
+    Key a request on everything that shapes the answer, for caching and coalescing
+    
+    The image is keyed by image_id, its content hash from image_store. A
+    request with an image but no image_id gets None and is neither cached
+    nor coalesced.
+    """
+    if image_data and not image_id:
+        return None
+    return response_cache.make_key(route["model"], system, messages, DEFAULT_TEMPERATURE, route["max_tokens"], image_id)
+
+def build_request(
+    message: str,
+    image_data: Optional[Union[str, bytes]] = None,
     image_type: Optional[str] = None,
     chat_history: Optional[List[Dict[str, Any]]] = None,
-    system_prompt: Optional[str] = None
+    system_prompt: Optional[str] = None,
+    summary: Optional[str] = None,
+    routing_hint: Optional[str] = None
 ) -> Dict[str, Any]:
+    """Messages API parameters for a request, built and routed as the chat endpoints do"""
+    messages = _build_messages(message, image_data, image_type, chat_history)
+    system = _build_system(system_prompt or DEFAULT_SYSTEM_PROMPT, messages, summary)
+    route = _route(system, messages, image_data, routing_hint, streaming=False)
+    return {
+        "model": route["model"],
+        "max_tokens": route["max_tokens"],
+        "system": system,
+        "messages": messages,
+        "temperature": DEFAULT_TEMPERATURE,
+    }
+
+_inflight_calls: Dict[str, "asyncio.Task"] = {}
+_stream_flights: Dict[str, "_StreamFlight"] = {}
+
+def _forget_flight(registry: Dict[str, Any], key: str, flight: Any):
+    """Drop a finished call from the in-flight registry unless a newer one took its place"""
+    if registry.get(key) is flight:
+        del registry[key]
+
+class _StreamFlight:
     """
-    Send a message to Claude API with optional image and chat history
+    One upstream stream shared by every consumer of an identical request
+    
+    Chunks are kept for the life of the stream so consumers that join late
+    can replay the prefix before following the live tail. If the upstream
+    call fails, every consumer gets its error after the chunks sent so far.
     """
-    if not client:
-        logger.error("Anthropic client not initialized")
-        return {"error": "Service unavailable"}
     
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[Exception] = None
+        self.task: Optional[asyncio.Task] = None
+        # Number of chunks each consumer has taken
+        self.positions: Dict[object, int] = {}
+        self.changed = asyncio.Condition()
+    
+    async def publish(self, text: str):
+        """Append a chunk, waiting while the slowest consumer is too far behind"""
+        async with self.changed:
+            self.chunks.append(text)
+            self.changed.notify_all()
+            await self.changed.wait_for(
+                lambda: not self.positions or len(self.chunks) - min(self.positions.values()) < STREAM_QUEUE_SIZE
+            )
+    
+    async def finish(self, error: Optional[Exception] = None):
+        async with self.changed:
+            self.done = True
+            self.error = error
+            self.changed.notify_all()
+    
+    async def subscribe(self, subscriber: object) -> AsyncGenerator[str, None]:
+        """Yield every chunk from the start, then new chunks as they arrive; raise the upstream error, if any, at the end"""
+        self.positions[subscriber] = 0
+        try:
+            while True:
+                async with self.changed:
+                    position = self.positions[subscriber]
+                    await self.changed.wait_for(lambda: position < len(self.chunks) or self.done)
+                    if position >= len(self.chunks):
+                        if self.error:
+                            raise self.error
+                        return
+                    self.positions[subscriber] = position + 1
+                    self.changed.notify_all()
+                yield self.chunks[position]
+        finally:
+            del self.positions[subscriber]
+            # Let a producer waiting on this consumer move on
+            async with self.changed:
+                self.changed.notify_all()
+
+async def _create_message(
+    system: Any,
+    messages: List[Dict[str, Any]],
+    cache_key: Optional[str],
+    route: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Make one non-streaming request and cache a complete answer"""
+    logger.info(f"Sending async request to Claude API with {len(messages)} messages")
+    
+    async def attempt():
+        # Timed per attempt so routing sees the model's latency, not backoff or hedge waits
+        started = time.monotonic()
+        response = await async_client.messages.create(
+            model=route["model"],
+            system=system,
+            messages=messages,
+            max_tokens=route["max_tokens"],
+            temperature=DEFAULT_TEMPERATURE
+        )
+        model_router.record_latency(route["model"], time.monotonic() - started)
+        return response
+    
+    # Make the request to Anthropic API over the shared connection pool,
+    # retried (and hedged when enabled) by the resilience layer
     try:
-        # Create content array
-        content = []
-        
-        # Add text message if provided
-        if message:
-            content.append({"type": "text", "text": message})
+        response = await resilience.call(attempt, hedge=True)
+    except Exception:
+        model_router.record_error(route["model"])
+        raise
+    
+    # Process and return the response
+    result = {
+        "content": response.content[0].text if response.content else "",
+        "model": response.model,
+        "id": response.id,
+        "usage": _record_usage(response.usage)
+    }
+    if response.stop_reason == "end_turn":
+        await response_cache.set(cache_key, result)
+    return result
+
+async def _produce_stream(
+    flight: _StreamFlight,
+    system: Any,
+    messages: List[Dict[str, Any]],
+    cache_key: Optional[str],
+    route: Dict[str, Any]
+):
+    """
+    Pump one upstream stream into a shared flight
+    
+    A stream that fails before its first token is retried like any other
+    call; once tokens have been sent to consumers it can't be restarted.
+    A failure is handed to the consumers instead of being sent as text.
+    """
+    logger.info(f"Streaming request to Claude API with {len(messages)} messages")
+    attempt = 0
+    try:
+        while True:
+            probe = resilience.before_call(attempt)
+            started = time.monotonic()
+            try:
+                # Make the streaming request to Anthropic API
+                async with async_client.messages.stream(
+                    model=route["model"],
+                    system=system,
+                    messages=messages,
+                    max_tokens=route["max_tokens"],
+                    temperature=DEFAULT_TEMPERATURE
+                ) as stream:
+                    async for text in stream.text_stream:
+                        if not flight.chunks:
+                            model_router.record_ttft(route["model"], time.monotonic() - started)
+                        await flight.publish(text)
+                    final_message = await stream.get_final_message()
+            except Exception as e:
+                model_router.record_error(route["model"])
+                if flight.chunks:
+                    resilience.breaker.record_failure()
+                    raise
+                delay = resilience.next_delay(e, attempt)
+            else:
+                break
+            finally:
+                if probe:
+                    resilience.breaker.release_probe()
+            await asyncio.sleep(delay)
+            attempt += 1
         
-        # Add image if provided
-        if image_data and image_type:
-            content.append({
-                "type": "image",
-                "source": {
-                    "type": "base64",
-                    "media_type": image_type,
-                    "data": image_data
-                }
+        resilience.record_success()
+        _record_usage(final_message.usage)
+        if final_message.stop_reason == "end_turn":
+            await response_cache.set(cache_key, {
+                "content": "".join(flight.chunks),
+                "model": final_message.model,
+                "id": final_message.id
             })
-        
-        # Prepare messages array
-        messages = []
-        
-        # Add chat history if provided
-        if chat_history:
-            for msg in chat_history:
-                messages.append({
-                    "role": msg.get("role", "user"),
-                    "content": msg.get("content", "")
-                })
-        
-        # Add current message
-        messages.append({
-            "role": "user",
-            "content": content
-        })
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Error in stream_message: {str(e)}")
+        await flight.finish(e)
+        return
+    await flight.finish()
+
+async def send_message_async(
+    message: str, 
+    image_data: Optional[Union[str, bytes]] = None, 
+    image_type: Optional[str] = None,
+    chat_history: Optional[List[Dict[str, Any]]] = None,
+    system_prompt: Optional[str] = None,
+    summary: Optional[str] = None,
+    routing_hint: Optional[str] = None,
+    image_id: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Send a message to Claude API without blocking the event loop
+    """
+    if not async_client:
+        logger.error("Anthropic async client not initialized")
+        return {"error": "Service unavailable"}
+    
+    try:
+        messages = _build_messages(message, image_data, image_type, chat_history)
         
         # Default system prompt if none provided
         if not system_prompt:
-            system_prompt = "You are Claude, a helpful AI assistant. Respond in a helpful, accurate, and engaging way."
+            system_prompt = DEFAULT_SYSTEM_PROMPT
+        system = _build_system(system_prompt, messages, summary)
         
-        logger.info(f"Sending request to Claude API with {len(messages)} messages")
+        route = _route(system, messages, image_data, routing_hint, streaming=False)
+        cache_key = _request_key(system, messages, route, image_data, image_id)
+        cached = await response_cache.get(cache_key)
+        if cached:
+            logger.info("Answered from the response cache")
+            return {**cached, "usage": None, "cached": True}
         
-        # Make the request to Anthropic API
-        response = client.messages.create(
-            model="claude-3-sonnet-20240229",
-            system=system_prompt,
-            messages=messages,
-            max_tokens=4096,
-            temperature=0.7
-        )
+        if not SINGLE_FLIGHT_ENABLED or cache_key is None:
+            return await _create_message(system, messages, cache_key, route)
         
-        # Process and return the response
-        return {
-            "content": response.content[0].text if response.content else "",
-            "model": response.model,
-            "id": response.id
-        }
+        # Identical requests already in flight are joined instead of sent again
+        call = _inflight_calls.get(cache_key)
+        if call is None:
+            call = asyncio.create_task(_create_message(system, messages, cache_key, route))
+            _inflight_calls[cache_key] = call
+            call.add_done_callback(lambda task: _forget_flight(_inflight_calls, cache_key, task))
+            # Shielded so a caller going away doesn't cancel the call for the others
+            return await asyncio.shield(call)
         
+        single_flight_stats["coalesced_requests"] += 1
+        logger.info("Joined an identical in-flight request")
+        result = await asyncio.shield(call)
+        # The tokens were paid for by the request that made the call
+        return {**result, "usage": None, "coalesced": True}
+        
+    except resilience.UpstreamUnavailable as e:
+        logger.error(f"Claude API unavailable in send_message_async: {str(e)}")
+        return {"error": str(e), "status_code": 503, "retry_after": e.retry_after}
     except Exception as e:
-        logger.error(f"Error in send_message: {str(e)}")
+        logger.error(f"Error in send_message_async: {str(e)}")
         return {"error": str(e)}
 
 async def stream_message(
     message: str, 
-    image_data: Optional[str] = None, 
+    image_data: Optional[Union[str, bytes]] = None, 
     image_type: Optional[str] = None,
     chat_history: Optional[List[Dict[str, Any]]] = None,
-    system_prompt: Optional[str] = None
+    system_prompt: Optional[str] = None,
+    summary: Optional[str] = None,
+    routing_hint: Optional[str] = None,
+    image_id: Optional[str] = None
 ) -> AsyncGenerator[str, None]:
     """
     Stream a message from Claude API with optional image and chat history
+    
+    Tokens are pumped from the upstream stream into a shared buffer by a
+    background task. When the slowest consumer falls behind by
+    STREAM_QUEUE_SIZE chunks the producer stops reading from the socket
+    until it catches up. Identical concurrent requests share one upstream
+    stream; late joiners get the buffered prefix and then the live tail.
+    
+    Failures are raised, resilience.UpstreamUnavailable when Claude is
+    overloaded, so callers can tell them apart from the reply.
     """
-    if not client:
-        yield "Error: Claude service not available"
+    if not async_client:
+        raise resilience.UpstreamUnavailable("Claude service not available", 1)
+    
+    messages = _build_messages(message, image_data, image_type, chat_history)
+    
+    # Default system prompt if none provided
+    if not system_prompt:
+        system_prompt = DEFAULT_SYSTEM_PROMPT
+    system = _build_system(system_prompt, messages, summary)
+    
+    # A cached answer is replayed as a fast synthetic stream
+    route = _route(system, messages, image_data, routing_hint, streaming=True)
+    cache_key = _request_key(system, messages, route, image_data, image_id)
+    cached = await response_cache.get(cache_key)
+    if cached:
+        logger.info("Streaming answer from the response cache")
+        for chunk in response_cache.replay_chunks(cached["content"]):
+            yield chunk
         return
     
+    # Identical streams already in flight are joined instead of started again
+    coalesce = SINGLE_FLIGHT_ENABLED and cache_key is not None
+    flight = _stream_flights.get(cache_key) if coalesce else None
+    if flight is None:
+        flight = _StreamFlight()
+        flight.task = asyncio.create_task(_produce_stream(flight, system, messages, cache_key, route))
+        if coalesce:
+            _stream_flights[cache_key] = flight
+            flight.task.add_done_callback(lambda task: _forget_flight(_stream_flights, cache_key, flight))
+    else:
+        single_flight_stats["coalesced_streams"] += 1
+        logger.info(f"Joined an in-flight stream at chunk {len(flight.chunks)}")
+    
+    chunks = flight.subscribe(object())
     try:
-        # Create content array
-        content = []
-        
-        # Add text message if provided
-        if message:
-            content.append({"type": "text", "text": message})
-        
-        # Add image if provided
-        if image_data and image_type:
-            content.append({
-                "type": "image",
-                "source": {
-                    "type": "base64",
-                    "media_type": image_type,
-                    "data": image_data
-                }
-            })
-        
-        # Prepare messages array
-        messages = []
-        
-        # Add chat history if provided
-        if chat_history:
-            for msg in chat_history:
-                messages.append({
-                    "role": msg.get("role", "user"),
-                    "content": msg.get("content", "")
-                })
-        
-        # Add current message
-        messages.append({
-            "role": "user",
-            "content": content
-        })
-        
-        # Default system prompt if none provided
-        if not system_prompt:
-            system_prompt = "You are Claude, a helpful AI assistant. Respond in a helpful, accurate, and engaging way."
-        
-        logger.info(f"Streaming request to Claude API with {len(messages)} messages")
-        
-        # Make the streaming request to Anthropic API
-        with client.messages.stream(
-            model="claude-3-sonnet-20240229",
-            system=system_prompt,
-            messages=messages,
-            max_tokens=4096,
-            temperature=0.7
-        ) as stream:
-            for text in stream.text_stream:
-                yield text
-                
+        async for text in chunks:
+            yield text
+    finally:
+        await chunks.aclose()
+        # Stop reading from upstream once the last consumer went away early
+        if not flight.positions and not flight.done:
+            _forget_flight(_stream_flights, cache_key, flight)
+            flight.task.cancel()
+            emitted_tokens = sum(len(text) for text in flight.chunks) // 4
+            stream_stats["cancelled_streams"] += 1
+            stream_stats["tokens_before_cancel"] += emitted_tokens
+            logger.info(f"Cancelled Claude stream after ~{emitted_tokens} output tokens")
+            try:
+                await flight.task
+            except asyncio.CancelledError:
+                pass
+
+async def summarize_conversation(
+    messages: List[Dict[str, Any]],
+    previous_summary: Optional[str] = None
+) -> Optional[str]:
+    """
+    Fold messages into a rolling conversation summary using the summary model
+    """
+    if not async_client:
+        logger.error("Anthropic async client not initialized")
+        return None
+    
+    transcript = "\n\n".join(
+        f"{msg.get('role', 'user')}: {msg.get('content', '')}" for msg in messages
+    )
+    prompt = (
+        f"Existing summary:\n{previous_summary or '(none)'}\n\n"
+        f"New messages:\n{transcript}"
+    )
+    
+    try:
+        response = await resilience.call(
+            lambda: async_client.messages.create(
+                model=SUMMARY_MODEL,
+                system=SUMMARY_SYSTEM_PROMPT,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=SUMMARY_MAX_TOKENS,
+                temperature=0
+            )
+        )
+        _record_usage(response.usage)
+        return response.content[0].text if response.content else None
     except Exception as e:
-        logger.error(f"Error in stream_message: {str(e)}")
-        yield f"Error: {str(e)}"
\ No newline at end of file
+        logger.error(f"Error in summarize_conversation: {str(e)}")
+        return None
@@ -0,0 +1,112 @@
+import os
+import asyncio
+import logging
+from typing import List, Dict, Any, Optional, Tuple
+
+from app.services import firebase_service
+from app.utils.tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Input tokens reserved for chat history on each Claude call
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "8000"))
+
+# How many of the newest messages to fetch before trimming
+CONTEXT_FETCH_LIMIT = int(os.environ.get("CONTEXT_FETCH_LIMIT", "50"))
+
+# The newest messages are always sent verbatim; older ones are compacted
+CONTEXT_RECENT_MESSAGES = int(os.environ.get("CONTEXT_RECENT_MESSAGES", "4"))
+CONTEXT_COMPACT_MAX_TOKENS = int(os.environ.get("CONTEXT_COMPACT_MAX_TOKENS", "300"))
+
+TRUNCATION_MARKER = " [...]"
+# Appended to replies whose stream was cut short by a client disconnect
+INTERRUPTED_MARKER = "\n\n[This reply was interrupted before it finished]"
+
+def _compact(content: str, max_tokens: int) -> str:
+    """Cut content down to roughly max_tokens tokens"""
+    if estimate_tokens(content) <= max_tokens:
+        return content
+    # Assume ~4 characters per token when cutting
+    return content[:max_tokens * 4].rstrip() + TRUNCATION_MARKER
+
+def fit_to_budget(messages: List[Dict[str, Any]], budget: int = None) -> List[Dict[str, Any]]:
+    """
+    Trim chat history (oldest first) to fit within a token budget
+    
+    The newest messages are kept verbatim, older messages are compacted to
+    CONTEXT_COMPACT_MAX_TOKENS, and once the budget is used up everything
+    older is dropped.
+    """
+    if budget is None:
+        budget = CONTEXT_TOKEN_BUDGET
+    
+    kept = []
+    used = 0
+    for index, msg in enumerate(reversed(messages)):
+        content = msg.get("content", "")
+        if index >= CONTEXT_RECENT_MESSAGES:
+            content = _compact(content, CONTEXT_COMPACT_MAX_TOKENS)
+        
+        tokens = estimate_tokens(content)
+        if used + tokens > budget:
+            break
+        
+        used += tokens
+        kept.append({**msg, "content": content})
+    
+    kept.reverse()
+    
+    # Claude requires the conversation to start with a user turn
+    while kept and kept[0].get("role") != "user":
+        kept.pop(0)
+    
+    if len(kept) < len(messages):
+        logger.info(f"Trimmed chat history from {len(messages)} to {len(kept)} messages (~{used} tokens)")
+    
+    return kept
+
+def _sendable(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Mark interrupted replies and drop turns Claude would reject
+    
+    Empty assistant messages (saved when a stream was cut before its first
+    token) are dropped together with the user message they answer, so the
+    roles keep alternating.
+    """
+    kept = []
+    for msg in messages:
+        if msg.get("role") == "assistant" and not msg.get("content"):
+            if kept and kept[-1].get("role") == "user":
+                kept.pop()
+            continue
+        if msg.get("truncated"):
+            msg = {**msg, "content": msg["content"] + INTERRUPTED_MARKER}
+        kept.append(msg)
+    return kept
+
+def get_context(user_id, chat_id, budget: int = None) -> Tuple[Optional[str], List[Dict[str, Any]]]:
+    """
+    Get the rolling summary of a chat and its newest messages trimmed to the
+    context token budget
+    
+    Messages already covered by the summary are left out, and so are
+    turns whose reply is empty.
+    """
+    current = firebase_service.get_chat_summary(user_id, chat_id)
+    messages = firebase_service.get_recent_messages(user_id, chat_id, limit=CONTEXT_FETCH_LIMIT)
+    
+    summary = None
+    if current:
+        summary = current["summary"]
+        summary_until = current["summary_until"]
+        if summary_until is not None:
+            messages = [
+                msg for msg in messages
+                if msg.get("timestamp") is None or msg["timestamp"] > summary_until
+            ]
+    
+    return summary, fit_to_budget(_sendable(messages), budget)
+
+async def get_context_async(user_id, chat_id, budget: int = None) -> Tuple[Optional[str], List[Dict[str, Any]]]:
+    """Run get_context in a worker thread, since a cache miss reads Firestore"""
+    return await asyncio.to_thread(get_context, user_id, chat_id, budget)
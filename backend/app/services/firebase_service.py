@@ -1,19 +1,54 @@
 import os
 import json
+import base64
+import time
 import logging
-import time  
+import asyncio
+import hashlib
+import threading
+from datetime import datetime, timedelta, timezone
 import firebase_admin
 from firebase_admin import credentials, firestore, auth
+from google.cloud.firestore_v1.field_path import FieldPath
 from pathlib import Path
 
 # Import the mock storage implementation
-from app.services.mock_storage import upload_image as mock_upload_image
+from app.services.mock_storage import upload_image_async as mock_upload_image_async
+from app.services.mock_storage import stored_thumbnail_url as mock_stored_thumbnail_url
+from app.services.mock_storage import read_image as mock_read_image
+from app.utils.cache import TTLCache
+from app.utils.ids import ulid
 
 logger = logging.getLogger(__name__)
 
 # Set to True to use local storage instead of Firebase Storage
 USE_MOCK_STORAGE = True
 
+# Write-through cache of the newest messages per (user_id, chat_id). Entries are
+# {"messages": [...], "complete": bool}; complete means the entry holds every
+# message of the chat, not just the newest HISTORY_CACHE_MESSAGES.
+HISTORY_CACHE_SIZE = int(os.environ.get("HISTORY_CACHE_SIZE", "1024"))
+HISTORY_CACHE_TTL = float(os.environ.get("HISTORY_CACHE_TTL", "300"))
+HISTORY_CACHE_MESSAGES = int(os.environ.get("HISTORY_CACHE_MESSAGES", "50"))
+history_cache = TTLCache(maxsize=HISTORY_CACHE_SIZE, ttl=HISTORY_CACHE_TTL)
+# Rolling summaries per (user_id, chat_id), cached alongside the history;
+# False means the chat has no summary yet
+summary_cache = TTLCache(maxsize=HISTORY_CACHE_SIZE, ttl=HISTORY_CACHE_TTL)
+
+# Turns queued for Firestore but not yet committed, per (user_id, chat_id) and
+# keyed by message ID, so a history read on a cache miss still sees them
+_pending_messages = {}
+_pending_lock = threading.Lock()
+
+# Cache of verified ID tokens keyed by SHA-256 of the token. Valid tokens are
+# kept until shortly before their exp claim; invalid ones are remembered as
+# False for TOKEN_NEGATIVE_TTL seconds.
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_EXPIRY_LEEWAY = int(os.environ.get("TOKEN_EXPIRY_LEEWAY", "30"))
+TOKEN_NEGATIVE_TTL = float(os.environ.get("TOKEN_NEGATIVE_TTL", "60"))
+TOKEN_CERT_REFRESH_INTERVAL = float(os.environ.get("TOKEN_CERT_REFRESH_INTERVAL", "3600"))
+token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE)
+
 # Initialize Firebase Admin SDK
 try:
     cred = None
@@ -53,56 +88,199 @@ except Exception as e:
     logger.error(f"Failed to initialize Firebase: {str(e)}")
     db = None
 
-def verify_token(id_token):
-    """Verify Firebase Auth token"""
+async def verify_token_async(id_token):
+    """
+    Verify a Firebase Auth token, serving repeat tokens from the token cache
+    
+    Verification runs in a worker thread since it may fetch Google's public
+    certificates. Only invalid and expired tokens are cached as failures.
+    """
+    if not id_token:
+        return None
+    
+    key = hashlib.sha256(id_token.encode("utf-8")).hexdigest()
+    cached = token_cache.get(key)
+    if cached is not None:
+        return cached or None
+    
     try:
-        if not id_token:
-            return None
-        decoded_token = auth.verify_id_token(id_token)
-        return decoded_token
+        decoded_token = await asyncio.to_thread(auth.verify_id_token, id_token)
+    except (auth.InvalidIdTokenError, auth.ExpiredIdTokenError) as e:
+        logger.error(f"Token verification failed: {str(e)}")
+        token_cache.set(key, False, ttl=TOKEN_NEGATIVE_TTL)
+        return None
     except Exception as e:
+        # Not the token's fault (e.g. the certificates could not be fetched),
+        # so the next request tries again
         logger.error(f"Token verification failed: {str(e)}")
         return None
+    
+    ttl = decoded_token.get("exp", 0) - time.time() - TOKEN_EXPIRY_LEEWAY
+    if ttl > 0:
+        token_cache.set(key, decoded_token, ttl=ttl)
+    return decoded_token
 
-def save_chat_message(user_id, message_data):
-    """Save a chat message to Firestore"""
-    if not db:
-        logger.warning("Firestore not initialized, skipping save_chat_message")
-        return None
+def prewarm_public_keys():
+    """
+    Fetch the certificates used to verify ID tokens into the verifier's HTTP cache
+    
+    Relies on firebase_admin internals, so failures are only logged.
+    """
+    if not firebase_admin._apps:
+        return
     
     try:
-        # Add timestamp
-        message_data["timestamp"] = firestore.SERVER_TIMESTAMP
-        
-        # Generate a chat ID if it's a new conversation
-        chat_id = message_data.get("chat_id")
-        if not chat_id:
-            chat_id = f"chat_{int(time.time())}"
-            message_data["chat_id"] = chat_id
-        
-        # Save to Firestore
-        chat_ref = db.collection(f"users/{user_id}/chats").document(chat_id)
-        messages_ref = chat_ref.collection("messages").document()
+        from google.oauth2 import id_token as google_id_token
         
-        # Add the message
-        messages_ref.set(message_data)
-        
-        # Update the chat document with latest info
-        chat_ref.set({
-            "updated_at": firestore.SERVER_TIMESTAMP,
-            "title": message_data.get("title", "New Chat"),
-            "last_message": message_data.get("content", "")[:50] + "..."
-        }, merge=True)
-        
-        return chat_id
+        verifier = auth._get_client(None)._token_verifier
+        google_id_token._fetch_certs(verifier.request, verifier.id_token_verifier.cert_url)
+        logger.info("Pre-warmed Firebase token certificates")
     except Exception as e:
-        logger.error(f"Error saving chat message: {str(e)}")
+        logger.warning(f"Could not pre-warm Firebase token certificates: {str(e)}")
+
+async def keep_public_keys_warm():
+    """Refresh the token certificates periodically so they never expire on the request path"""
+    while True:
+        await asyncio.to_thread(prewarm_public_keys)
+        await asyncio.sleep(TOKEN_CERT_REFRESH_INTERVAL)
+
+def get_token_cache_stats():
+    """Return hit/miss/eviction counters of the token cache"""
+    return token_cache.stats()
+
+def new_chat_id():
+    """
+    Generate an ID for a new conversation
+    
+    IDs are ULIDs, so they are unique across concurrent requests and sort by
+    creation time.
+    """
+    return f"chat_{ulid()}"
+
+def prepare_chat_turn(user_id, chat_id, user_message, assistant_message, is_new_chat=False):
+    """
+    Stamp the messages of a turn, give them document IDs and add them to the
+    history cache
+    
+    Server timestamps are identical for every write in a batch, so the two
+    messages get explicit timestamps one microsecond apart to keep their order.
+    The IDs are fixed here so a retried commit overwrites the same documents
+    instead of adding the turn twice. Until forget_pending_turn is called the
+    turn is also merged into history read from Firestore.
+    Returns (message_ids, user_message, assistant_message).
+    """
+    now = datetime.now(timezone.utc)
+    user_message = {**user_message, "chat_id": chat_id, "timestamp": now}
+    assistant_message = {
+        **assistant_message,
+        "chat_id": chat_id,
+        "timestamp": now + timedelta(microseconds=1)
+    }
+    message_ids = (f"msg_{ulid()}", f"msg_{ulid()}")
+    
+    with _pending_lock:
+        pending = _pending_messages.setdefault((user_id, chat_id), {})
+        pending[message_ids[0]] = user_message
+        pending[message_ids[1]] = assistant_message
+    
+    _cache_append(user_id, chat_id, user_message, is_new_chat)
+    _cache_append(user_id, chat_id, assistant_message)
+    
+    return message_ids, user_message, assistant_message
+
+def commit_chat_turn(user_id, chat_id, message_ids, user_message, assistant_message):
+    """
+    Write a prepared turn and the chat metadata in one Firestore batch
+    
+    Raises on failure so callers can retry; retrying is safe since the
+    message documents have fixed IDs.
+    """
+    if not db:
+        logger.warning("Firestore not initialized, skipping commit_chat_turn")
+        return
+    
+    chat_ref = db.collection(f"users/{user_id}/chats").document(chat_id)
+    messages_ref = chat_ref.collection("messages")
+    
+    batch = db.batch()
+    batch.set(messages_ref.document(message_ids[0]), user_message)
+    batch.set(messages_ref.document(message_ids[1]), assistant_message)
+    batch.set(chat_ref, {
+        "updated_at": firestore.SERVER_TIMESTAMP,
+        "title": user_message.get("title", "New Chat"),
+        "last_message": assistant_message.get("content", "")[:50] + "..."
+    }, merge=True)
+    batch.commit()
+
+def forget_pending_turn(user_id, chat_id, message_ids):
+    """Stop merging a turn into history reads once it was committed or given up on"""
+    key = (user_id, chat_id)
+    with _pending_lock:
+        pending = _pending_messages.get(key, {})
+        for message_id in message_ids:
+            pending.pop(message_id, None)
+        if not pending:
+            _pending_messages.pop(key, None)
+
+def _merge_pending(user_id, chat_id, message_ids, messages):
+    """Add queued messages missing from a Firestore read, keeping timestamp order"""
+    with _pending_lock:
+        pending = dict(_pending_messages.get((user_id, chat_id), {}))
+    missing = [message for message_id, message in pending.items() if message_id not in message_ids]
+    if not missing:
+        return messages
+    return sorted(messages + missing, key=lambda message: message["timestamp"])
+
+def _cache_append(user_id, chat_id, message_data, is_new_chat=False):
+    """Append a just-saved message to the history cache"""
+    # The server timestamp sentinel is only resolved by Firestore, use local time instead
+    cached_message = dict(message_data)
+    if not isinstance(cached_message.get("timestamp"), datetime):
+        cached_message["timestamp"] = datetime.now(timezone.utc)
+    
+    key = (user_id, chat_id)
+    entry = history_cache.peek(key)
+    if entry is None:
+        # Only a brand new chat is known to be complete without a Firestore read
+        if is_new_chat:
+            history_cache.set(key, {"messages": [cached_message], "complete": True})
+        return
+    
+    messages = entry["messages"] + [cached_message]
+    complete = entry["complete"]
+    if len(messages) > HISTORY_CACHE_MESSAGES:
+        messages = messages[-HISTORY_CACHE_MESSAGES:]
+        complete = False
+    history_cache.set(key, {"messages": messages, "complete": complete})
+
+def invalidate_history_cache(user_id, chat_id=None):
+    """Drop cached history and summaries for one chat, or for all chats of a user"""
+    if chat_id:
+        history_cache.pop((user_id, chat_id))
+        summary_cache.pop((user_id, chat_id))
+        return
+    for cache in (history_cache, summary_cache):
+        for key in cache.keys():
+            if key[0] == user_id:
+                cache.pop(key)
+
+def get_history_cache_stats():
+    """Return hit/miss/eviction counters of the history and summary caches"""
+    return {**history_cache.stats(), "summaries": summary_cache.stats()}
+
+async def upload_image_async(user_id, image_data, image_type):
+    """Upload an image without blocking the event loop (uses mock implementation)"""
+    return await mock_upload_image_async(user_id, image_data, image_type)
+
+async def get_thumbnail_url_async(image_url):
+    """URL of the stored thumbnail of an image, or None if it has none (uses mock implementation)"""
+    if not image_url:
         return None
+    return await asyncio.to_thread(mock_stored_thumbnail_url, image_url)
 
-def upload_image(user_id, image_data, image_type):
-    """Upload an image (uses mock implementation)"""
-    logger.info("Using mock storage for image uploads")
-    return mock_upload_image(user_id, image_data, image_type)
+async def read_image_async(user_id, image_id):
+    """Read back a stored image by its content hash (uses mock implementation)"""
+    return await asyncio.to_thread(mock_read_image, user_id, image_id)
 
 def get_chat_history(user_id, chat_id=None, limit=20):
     """Get chat history for a user"""
@@ -127,4 +305,136 @@ def get_chat_history(user_id, chat_id=None, limit=20):
             return [chat.to_dict() for chat in chats]
     except Exception as e:
         logger.error(f"Error getting chat history: {str(e)}")
-        return []
\ No newline at end of file
+        return []
+
+def get_recent_messages(user_id, chat_id, limit=50):
+    """Get the newest messages of a chat, returned oldest first"""
+    key = (user_id, chat_id)
+    entry = history_cache.get(key)
+    if entry and (entry["complete"] or len(entry["messages"]) >= limit):
+        return entry["messages"][-limit:]
+    
+    if not db:
+        logger.warning("Firestore not initialized, skipping get_recent_messages")
+        return []
+    
+    try:
+        fetch_limit = max(limit, HISTORY_CACHE_MESSAGES)
+        documents = db.collection(f"users/{user_id}/chats/{chat_id}/messages") \
+            .order_by("timestamp", direction=firestore.Query.DESCENDING) \
+            .limit(fetch_limit) \
+            .stream()
+        documents = list(reversed(list(documents)))
+        messages = [doc.to_dict() for doc in documents]
+        fetched = len(messages)
+        # Turns still in the write-behind queue are not in Firestore yet
+        messages = _merge_pending(user_id, chat_id, {doc.id for doc in documents}, messages)
+        
+        history_cache.set(key, {
+            "messages": messages[-HISTORY_CACHE_MESSAGES:],
+            "complete": fetched < fetch_limit and len(messages) <= HISTORY_CACHE_MESSAGES
+        })
+        return messages[-limit:]
+    except Exception as e:
+        logger.error(f"Error getting recent messages: {str(e)}")
+        return []
+
+def get_messages_after(user_id, chat_id, after=None, limit=200):
+    """Get messages of a chat newer than the given timestamp, oldest first"""
+    if not db:
+        logger.warning("Firestore not initialized, skipping get_messages_after")
+        return []
+    
+    try:
+        query = db.collection(f"users/{user_id}/chats/{chat_id}/messages")
+        if after is not None:
+            query = query.where("timestamp", ">", after)
+        messages = query \
+            .order_by("timestamp", direction=firestore.Query.ASCENDING) \
+            .limit(limit) \
+            .stream()
+        return [msg.to_dict() for msg in messages]
+    except Exception as e:
+        logger.error(f"Error getting messages: {str(e)}")
+        return []
+
+def get_chat_summary(user_id, chat_id):
+    """Get the rolling summary stored on a chat document, from the summary cache if possible"""
+    key = (user_id, chat_id)
+    cached = summary_cache.get(key)
+    if cached is not None:
+        return cached or None
+    
+    if not db:
+        return None
+    
+    try:
+        chat = db.collection(f"users/{user_id}/chats").document(chat_id).get()
+        data = chat.to_dict() if chat.exists else {}
+        if not data.get("summary"):
+            summary_cache.set(key, False)
+            return None
+        current = {
+            "summary": data["summary"],
+            "summary_until": data.get("summary_until")
+        }
+        summary_cache.set(key, current)
+        return current
+    except Exception as e:
+        logger.error(f"Error getting chat summary: {str(e)}")
+        return None
+
+def save_chat_summary(user_id, chat_id, summary, summary_until):
+    """Store the rolling summary and the timestamp of the last message it covers"""
+    if not db:
+        logger.warning("Firestore not initialized, skipping save_chat_summary")
+        return False
+    
+    try:
+        db.collection(f"users/{user_id}/chats").document(chat_id).set({
+            "summary": summary,
+            "summary_until": summary_until,
+            "summary_updated_at": firestore.SERVER_TIMESTAMP
+        }, merge=True)
+        summary_cache.set((user_id, chat_id), {"summary": summary, "summary_until": summary_until})
+        return True
+    except Exception as e:
+        logger.error(f"Error saving chat summary: {str(e)}")
+        return False
+
+def _encode_chat_cursor(chat):
+    """Opaque page cursor holding the (updated_at, id) of the last chat on a page"""
+    position = {"updated_at": chat["updated_at"].isoformat(), "id": chat["id"]}
+    return base64.urlsafe_b64encode(json.dumps(position).encode("utf-8")).decode("ascii")
+
+def _decode_chat_cursor(cursor):
+    position = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    return datetime.fromisoformat(position["updated_at"]), position["id"]
+
+def get_chat_list(user_id, limit=20, cursor=None):
+    """
+    Get a page of a user's chats, most recently active first
+    
+    Chats are ordered by updated_at with the document ID as a tie-breaker,
+    which the single-field index on updated_at serves. The cursor is the
+    (updated_at, id) of the last chat on a page, so paging is stable even
+    for chats whose IDs are not time-ordered. Returns (chats, next_cursor).
+    """
+    if not db:
+        logger.warning("Firestore not initialized, skipping get_chat_list")
+        return [], None
+    
+    try:
+        query = db.collection(f"users/{user_id}/chats") \
+            .order_by("updated_at", direction=firestore.Query.DESCENDING) \
+            .order_by(FieldPath.document_id(), direction=firestore.Query.DESCENDING)
+        if cursor:
+            updated_at, last_id = _decode_chat_cursor(cursor)
+            query = query.start_after({"updated_at": updated_at, FieldPath.document_id(): last_id})
+        
+        chats = [{"id": chat.id, **chat.to_dict()} for chat in query.limit(limit).stream()]
+        next_cursor = _encode_chat_cursor(chats[-1]) if len(chats) == limit else None
+        return chats, next_cursor
+    except Exception as e:
+        logger.error(f"Error getting chat list: {str(e)}")
+        return [], None
@@ -0,0 +1,57 @@
+import os
+import hashlib
+import logging
+
+from app.services import firebase_service
+from app.utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Processed images kept in memory so follow-up turns can refer to them by ID
+IMAGE_HANDLE_CACHE_SIZE = int(os.environ.get("IMAGE_HANDLE_CACHE_SIZE", "512"))
+IMAGE_HANDLE_CACHE_BYTES = int(os.environ.get("IMAGE_HANDLE_CACHE_BYTES", str(256 * 1024 * 1024)))
+IMAGE_HANDLE_TTL = float(os.environ.get("IMAGE_HANDLE_TTL", "3600"))
+
+# (user_id, chat_id, image_id) -> (image_bytes, media_type, image_url)
+image_handles = TTLCache(
+    maxsize=IMAGE_HANDLE_CACHE_SIZE,
+    ttl=IMAGE_HANDLE_TTL,
+    maxweight=IMAGE_HANDLE_CACHE_BYTES,
+    weigher=lambda handle: len(handle[0])
+)
+
+def put(user_id, chat_id, image_bytes, media_type, image_url=None):
+    """
+    Keep a processed image for this chat and return its ID
+    
+    The ID is the SHA-256 of the processed bytes, the same name the image is
+    stored under, so the stored copy can stand in after eviction.
+    """
+    image_id = hashlib.sha256(image_bytes).hexdigest()
+    image_handles.set((user_id, chat_id, image_id), (image_bytes, media_type, image_url))
+    return image_id
+
+async def get(user_id, chat_id, image_id):
+    """
+    Look up a processed image by ID
+    
+    Falls back to the user's stored copy when the handle has been evicted.
+    Returns (image_bytes, media_type, image_url) or None.
+    """
+    handle = image_handles.get((user_id, chat_id, image_id))
+    if handle:
+        return handle
+    
+    # Only content hashes are valid IDs; anything else can't name a stored file
+    if len(image_id) != 64 or any(c not in "0123456789abcdef" for c in image_id):
+        return None
+    
+    handle = await firebase_service.read_image_async(user_id, image_id)
+    if handle:
+        logger.info(f"Image handle {image_id[:12]} restored from storage")
+        image_handles.set((user_id, chat_id, image_id), handle)
+    return handle
+
+def get_image_store_stats():
+    """Return hit/miss/eviction counters of the image handle cache"""
+    return image_handles.stats()
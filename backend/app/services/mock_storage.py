@@ -1,19 +1,97 @@
 import os
-import base64
+import shutil
+import asyncio
+import hashlib
 import logging
-from datetime import datetime
+import tempfile
 from pathlib import Path
 
+from app.utils.image_utils import make_thumbnail, run_in_image_pool
+
 logger = logging.getLogger(__name__)
 
 # Create a directory to store uploaded images locally
 UPLOADS_DIR = Path(__file__).parent.parent.parent / "uploads"
 UPLOADS_DIR.mkdir(exist_ok=True)
 
+# Content-addressed blobs live under uploads/blobs/<aa>/<bb>/<sha256>.<ext>;
+# each user's uploads are hard links to them, so the link count of a blob is
+# its reference count and identical images are stored once.
+BLOBS_DIR = UPLOADS_DIR / "blobs"
+BLOBS_DIR.mkdir(exist_ok=True)
+
+# Thumbnails are stored as <sha256>.thumb.webp next to the image they preview
+THUMBNAIL_EXTENSION = "thumb.webp"
+
+def _extension(image_type):
+    extension = image_type.split('/')[-1]
+    return "jpg" if extension == "jpeg" else extension
+
+def _blob_path(digest, extension):
+    return BLOBS_DIR / digest[:2] / digest[2:4] / f"{digest}.{extension}"
+
+def thumbnail_url(image_url):
+    """URL of the pre-generated thumbnail for an uploaded image URL"""
+    if not image_url:
+        return None
+    base, _, _ = image_url.rpartition(".")
+    return f"{base}.{THUMBNAIL_EXTENSION}"
+
+def stored_thumbnail_url(image_url):
+    """thumbnail_url(image_url) if that thumbnail was actually made, else None"""
+    url = thumbnail_url(image_url)
+    if url and (UPLOADS_DIR / url.removeprefix("/uploads/")).exists():
+        return url
+    return None
+
+def _write_atomic(path, data):
+    """Write data to path via a temp file in the same directory and a rename"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+def _link(blob_path, link_path):
+    """Hard-link a user's file to a blob, copying if the filesystem has no hard links"""
+    try:
+        os.link(blob_path, link_path)
+    except FileExistsError:
+        # Same image already uploaded by this user
+        pass
+    except OSError:
+        shutil.copyfile(blob_path, link_path)
+
+def read_image(user_id, digest):
+    """
+    Read a user's stored image by its SHA-256
+    
+    Returns (image_bytes, mime_type, url) or None if the user has no such image.
+    """
+    user_dir = UPLOADS_DIR / user_id
+    for path in user_dir.glob(f"{digest}.*"):
+        if path.name.endswith(THUMBNAIL_EXTENSION):
+            continue
+        extension = path.suffix.lstrip(".")
+        mime_type = "image/jpeg" if extension == "jpg" else f"image/{extension}"
+        return path.read_bytes(), mime_type, f"/uploads/{user_id}/{path.name}"
+    return None
+
+def image_exists(digest, image_type):
+    """Check whether a blob with this SHA-256 is already stored"""
+    return _blob_path(digest, _extension(image_type)).exists()
+
 def upload_image(user_id, image_data, image_type):
     """
     Mock version of upload_image that saves files locally instead of Firebase Storage
     
+    Files are named by the SHA-256 of their content, so repeated uploads of
+    the same image return the same URL and don't store the bytes again.
+    
     Args:
         user_id: User ID
         image_data: Binary image data
@@ -23,22 +101,75 @@ def upload_image(user_id, image_data, image_type):
         Local URL to the saved image
     """
     try:
-        # Create user directory if it doesn't exist
-        user_dir = UPLOADS_DIR / user_id
-        user_dir.mkdir(exist_ok=True)
+        digest = hashlib.sha256(image_data).hexdigest()
+        extension = _extension(image_type)
         
-        # Generate unique filename
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        file_extension = image_type.split('/')[-1]
-        filename = f"{timestamp}.{file_extension}"
+        # Store the bytes once; the thumbnail is made by upload_image_async
+        blob_path = _blob_path(digest, extension)
+        if not blob_path.exists():
+            _write_atomic(blob_path, image_data)
+        thumbnail_path = _blob_path(digest, THUMBNAIL_EXTENSION)
         
-        # Save the file
-        file_path = user_dir / filename
-        with open(file_path, 'wb') as f:
-            f.write(image_data)
+        # Link the blobs, and the thumbnail if there already is one, into the user's directory
+        user_dir = UPLOADS_DIR / user_id
+        user_dir.mkdir(exist_ok=True)
+        filename = f"{digest}.{extension}"
+        _link(blob_path, user_dir / filename)
+        if thumbnail_path.exists():
+            _link(thumbnail_path, user_dir / f"{digest}.{THUMBNAIL_EXTENSION}")
         
         # Return a local URL
         return f"/uploads/{user_id}/{filename}"
     except Exception as e:
         logger.error(f"Error in mock upload_image: {str(e)}")
-        return None
\ No newline at end of file
+        return None
+
+def save_thumbnail(image_url, thumbnail):
+    """Store a thumbnail made elsewhere and link it next to the user's image"""
+    image_path = UPLOADS_DIR / image_url.removeprefix("/uploads/")
+    digest = image_path.name.partition(".")[0]
+    thumbnail_path = _blob_path(digest, THUMBNAIL_EXTENSION)
+    if not thumbnail_path.exists():
+        _write_atomic(thumbnail_path, thumbnail)
+    _link(thumbnail_path, image_path.parent / f"{digest}.{THUMBNAIL_EXTENSION}")
+
+async def upload_image_async(user_id, image_data, image_type):
+    """
+    Run upload_image in a worker thread
+    
+    A missing thumbnail is made in the image process pool rather than in
+    that thread; if that fails the image is stored without one.
+    """
+    image_url = await asyncio.to_thread(upload_image, user_id, image_data, image_type)
+    if image_url and not await asyncio.to_thread(stored_thumbnail_url, image_url):
+        try:
+            thumbnail = await run_in_image_pool(make_thumbnail, image_data)
+            await asyncio.to_thread(save_thumbnail, image_url, thumbnail)
+        except Exception as thumb_error:
+            logger.error(f"Error creating thumbnail: {str(thumb_error)}")
+    return image_url
+
+def delete_image(user_id, filename):
+    """
+    Remove a user's link to an image (and its thumbnail) and the blobs once
+    nothing links to them
+    
+    Returns True if the user's link existed.
+    """
+    digest, _, extension = filename.partition(".")
+    
+    existed = False
+    for ext in (extension, THUMBNAIL_EXTENSION):
+        try:
+            (UPLOADS_DIR / user_id / f"{digest}.{ext}").unlink()
+            existed = existed or ext == extension
+        except FileNotFoundError:
+            continue
+        
+        blob_path = _blob_path(digest, ext)
+        try:
+            if blob_path.stat().st_nlink <= 1:
+                blob_path.unlink()
+        except FileNotFoundError:
+            pass
+    return existed
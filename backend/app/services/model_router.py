@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import logging
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from app.utils.tokens import estimate_content_tokens
+
+logger = logging.getLogger(__name__)
+
+# Used when no rule matches
+DEFAULT_MODEL = os.environ.get("CLAUDE_DEFAULT_MODEL", "claude-3-sonnet-20240229")
+DEFAULT_MAX_TOKENS = int(os.environ.get("CLAUDE_DEFAULT_MAX_TOKENS", "4096"))
+FAST_MODEL = os.environ.get("CLAUDE_FAST_MODEL", "claude-3-haiku-20240307")
+
+# Operator rules as a JSON list, inline or from a file. Each rule is
+#   {"name": ..., "when": {...}, "models": [...], "max_tokens": N,
+#    "max_ttft": seconds, "max_latency": seconds}
+# "when" may hold min_prompt_tokens, max_prompt_tokens, has_image and hint;
+# the first rule whose conditions all hold is used. "models" are in order of
+# preference; for streaming calls a model is skipped while its recent p95
+# time to first token is above max_ttft, for non-streaming calls while its
+# p95 latency of a single whole attempt is above max_latency. Either bound
+# may be left out.
+ROUTING_RULES = os.environ.get("CLAUDE_ROUTING_RULES")
+ROUTING_RULES_FILE = os.environ.get("CLAUDE_ROUTING_RULES_FILE")
+
+# Samples needed before a model's latency is trusted, and how many are kept
+ROUTING_MIN_SAMPLES = int(os.environ.get("CLAUDE_ROUTING_MIN_SAMPLES", "10"))
+ROUTING_WINDOW = int(os.environ.get("CLAUDE_ROUTING_WINDOW", "200"))
+# Samples older than this many seconds are ignored. A model skipped for being
+# slow gets no new samples, so this is also how long it stays skipped before
+# it is tried again.
+ROUTING_SAMPLE_MAX_AGE = float(os.environ.get("CLAUDE_ROUTING_SAMPLE_MAX_AGE", "300"))
+
+DEFAULT_RULES = [
+    {"name": "hint_quality", "when": {"hint": "quality"}, "models": [DEFAULT_MODEL], "max_tokens": DEFAULT_MAX_TOKENS},
+    {"name": "hint_fast", "when": {"hint": "fast"}, "models": [FAST_MODEL], "max_tokens": 1024},
+    {"name": "image", "when": {"has_image": True}, "models": [DEFAULT_MODEL], "max_tokens": DEFAULT_MAX_TOKENS},
+    {
+        "name": "short_prompt",
+        "when": {"max_prompt_tokens": 300},
+        "models": [FAST_MODEL, DEFAULT_MODEL],
+        "max_tokens": DEFAULT_MAX_TOKENS,
+        "max_ttft": 2.0,
+        "max_latency": 20.0,
+    },
+    {
+        "name": "default",
+        "when": {},
+        "models": [DEFAULT_MODEL, FAST_MODEL],
+        "max_tokens": DEFAULT_MAX_TOKENS,
+        "max_ttft": 8.0,
+        "max_latency": 60.0,
+    },
+]
+
+def _load_rules() -> List[Dict[str, Any]]:
+    """Read operator rules, falling back to the defaults when they are missing or invalid"""
+    try:
+        if ROUTING_RULES_FILE:
+            with open(ROUTING_RULES_FILE) as f:
+                rules = json.load(f)
+        elif ROUTING_RULES:
+            rules = json.loads(ROUTING_RULES)
+        else:
+            return DEFAULT_RULES
+
+        if not isinstance(rules, list) or not all(isinstance(rule, dict) and rule.get("models") for rule in rules):
+            raise ValueError("rules must be a list of objects with a non-empty models list")
+        logger.info(f"Loaded {len(rules)} model routing rules")
+        return rules
+    except Exception as e:
+        logger.error(f"Invalid model routing rules, using defaults: {str(e)}")
+        return DEFAULT_RULES
+
+rules = _load_rules()
+
+class ModelStats:
+    """
+    Recent latencies of one model, split by streaming (TTFT) and
+    non-streaming calls; samples are (monotonic time, seconds)
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.ttft: "deque[tuple]" = deque(maxlen=ROUTING_WINDOW)
+        self.latency: "deque[tuple]" = deque(maxlen=ROUTING_WINDOW)
+
+    @staticmethod
+    def _p95(samples) -> Optional[float]:
+        cutoff = time.monotonic() - ROUTING_SAMPLE_MAX_AGE
+        recent = [seconds for recorded_at, seconds in samples if recorded_at >= cutoff]
+        if len(recent) < ROUTING_MIN_SAMPLES:
+            return None
+        recent.sort()
+        return recent[min(len(recent) - 1, int(0.95 * len(recent)))]
+
+    def p95(self, streaming: bool) -> Optional[float]:
+        return self._p95(self.ttft if streaming else self.latency)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "ttft_p95_seconds": self._p95(self.ttft),
+            "latency_p95_seconds": self._p95(self.latency),
+        }
+
+model_stats: Dict[str, ModelStats] = {}
+rule_hits: Dict[str, int] = {}
+
+def _stats_for(model: str) -> ModelStats:
+    if model not in model_stats:
+        model_stats[model] = ModelStats()
+    return model_stats[model]
+
+def prompt_tokens(system: Any, messages: List[Dict[str, Any]]) -> int:
+    """Estimated token count of the text in a request"""
+    return estimate_content_tokens(system) + sum(estimate_content_tokens(msg.get("content")) for msg in messages)
+
+def _matches(when: Dict[str, Any], tokens: int, has_image: bool, hint: Optional[str]) -> bool:
+    if "min_prompt_tokens" in when and tokens < when["min_prompt_tokens"]:
+        return False
+    if "max_prompt_tokens" in when and tokens > when["max_prompt_tokens"]:
+        return False
+    if "has_image" in when and has_image != when["has_image"]:
+        return False
+    if "hint" in when and hint != when["hint"]:
+        return False
+    return True
+
+def _pick_model(rule: Dict[str, Any], streaming: bool) -> str:
+    """First preferred model within the rule's latency bound for the call type, else the fastest one"""
+    models = rule["models"]
+    max_latency = rule.get("max_ttft" if streaming else "max_latency")
+    if max_latency is None or len(models) == 1:
+        return models[0]
+
+    observed = []
+    for model in models:
+        p95 = _stats_for(model).p95(streaming)
+        # A model without enough recent samples gets the benefit of the doubt
+        if p95 is None or p95 <= max_latency:
+            return model
+        observed.append((p95, model))
+    return min(observed)[1]
+
+def route(
+    system: Any,
+    messages: List[Dict[str, Any]],
+    has_image: bool = False,
+    hint: Optional[str] = None,
+    streaming: bool = False
+) -> Dict[str, Any]:
+    """Pick the model and max_tokens for a request; returns {"model", "max_tokens", "rule"}"""
+    tokens = prompt_tokens(system, messages)
+    for rule in rules:
+        if _matches(rule.get("when", {}), tokens, has_image, hint):
+            name = rule.get("name", "unnamed")
+            rule_hits[name] = rule_hits.get(name, 0) + 1
+            model = _pick_model(rule, streaming)
+            logger.info(f"Routed ~{tokens} prompt tokens to {model} by rule {name}")
+            return {"model": model, "max_tokens": rule.get("max_tokens", DEFAULT_MAX_TOKENS), "rule": name}
+
+    rule_hits["fallback"] = rule_hits.get("fallback", 0) + 1
+    return {"model": DEFAULT_MODEL, "max_tokens": DEFAULT_MAX_TOKENS, "rule": "fallback"}
+
+def record_latency(model: str, seconds: float):
+    """Record the total latency of a successful non-streaming call"""
+    stats = _stats_for(model)
+    stats.requests += 1
+    stats.latency.append((time.monotonic(), seconds))
+
+def record_ttft(model: str, seconds: float):
+    """Record the time to first token of a stream"""
+    stats = _stats_for(model)
+    stats.requests += 1
+    stats.ttft.append((time.monotonic(), seconds))
+
+def record_error(model: str):
+    _stats_for(model).errors += 1
+
+def get_routing_stats() -> Dict[str, Any]:
+    """Return rule hit counts and recent latencies per model"""
+    return {
+        "rules": dict(rule_hits),
+        "models": {model: stats.snapshot() for model, stats in model_stats.items()},
+    }
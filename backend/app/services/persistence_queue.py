@@ -0,0 +1,142 @@
+import os
+import random
+import asyncio
+import logging
+
+from app.services import firebase_service, summary_service
+
+logger = logging.getLogger(__name__)
+
+# Write-behind queue settings
+PERSIST_QUEUE_SIZE = int(os.environ.get("PERSIST_QUEUE_SIZE", "1000"))
+PERSIST_WORKERS = int(os.environ.get("PERSIST_WORKERS", "4"))
+PERSIST_MAX_ATTEMPTS = int(os.environ.get("PERSIST_MAX_ATTEMPTS", "5"))
+PERSIST_BACKOFF_BASE = float(os.environ.get("PERSIST_BACKOFF_BASE", "0.5"))
+PERSIST_BACKOFF_MAX = float(os.environ.get("PERSIST_BACKOFF_MAX", "10"))
+PERSIST_DRAIN_TIMEOUT = float(os.environ.get("PERSIST_DRAIN_TIMEOUT", "30"))
+
+_queue = None
+_workers = []
+# Turns committed outside the queue because it was full
+_overflow = set()
+
+persist_stats = {
+    "enqueued": 0,
+    "committed": 0,
+    "retries": 0,
+    "failed": 0,
+    "overflowed": 0,
+}
+
+def _ensure_started():
+    """Create the queue and worker pool on first use"""
+    global _queue
+    if _queue is None:
+        _queue = asyncio.Queue(maxsize=PERSIST_QUEUE_SIZE)
+    if not _workers:
+        for index in range(PERSIST_WORKERS):
+            _workers.append(asyncio.create_task(_worker(index)))
+
+def _prepare(user_id, chat_id, user_message, assistant_message, is_new_chat):
+    """Stamp the turn and make it visible to follow-up reads right away"""
+    message_ids, user_message, assistant_message = firebase_service.prepare_chat_turn(
+        user_id, chat_id, user_message, assistant_message, is_new_chat
+    )
+    persist_stats["enqueued"] += 1
+    return (user_id, chat_id, message_ids, user_message, assistant_message)
+
+async def enqueue_turn(user_id, chat_id, user_message, assistant_message, is_new_chat=False):
+    """
+    Queue a chat turn to be written to Firestore in the background
+    
+    The turn is added to the history cache immediately, so the next request
+    in this worker sees it even before the commit. Waits only if the queue
+    is full.
+    """
+    _ensure_started()
+    await _queue.put(_prepare(user_id, chat_id, user_message, assistant_message, is_new_chat))
+
+def enqueue_turn_nowait(user_id, chat_id, user_message, assistant_message, is_new_chat=False):
+    """
+    Queue a chat turn without waiting, for use in cancellation paths
+    
+    If the queue is full the turn is committed by a task of its own, with the
+    same retries as queued turns.
+    """
+    _ensure_started()
+    job = _prepare(user_id, chat_id, user_message, assistant_message, is_new_chat)
+    try:
+        _queue.put_nowait(job)
+    except asyncio.QueueFull:
+        logger.warning("Persistence queue full, committing turn directly")
+        persist_stats["overflowed"] += 1
+        task = asyncio.create_task(_persist(job))
+        _overflow.add(task)
+        task.add_done_callback(_overflow.discard)
+
+async def _commit_with_retry(user_id, chat_id, message_ids, user_message, assistant_message):
+    """Commit a turn, retrying with jittered exponential backoff"""
+    for attempt in range(1, PERSIST_MAX_ATTEMPTS + 1):
+        try:
+            await asyncio.to_thread(
+                firebase_service.commit_chat_turn, user_id, chat_id, message_ids, user_message, assistant_message
+            )
+            return True
+        except Exception as e:
+            if attempt == PERSIST_MAX_ATTEMPTS:
+                logger.error(f"Giving up saving chat {chat_id} after {attempt} attempts: {str(e)}")
+                return False
+            
+            delay = min(PERSIST_BACKOFF_MAX, PERSIST_BACKOFF_BASE * 2 ** (attempt - 1))
+            delay = random.uniform(delay / 2, delay)
+            persist_stats["retries"] += 1
+            logger.warning(f"Saving chat {chat_id} failed (attempt {attempt}), retrying in {delay:.2f}s: {str(e)}")
+            await asyncio.sleep(delay)
+
+async def _persist(job):
+    """Commit one turn and update the history cache and counters"""
+    user_id, chat_id, message_ids = job[:3]
+    try:
+        if await _commit_with_retry(*job):
+            persist_stats["committed"] += 1
+            logger.info(f"Saved messages to Firestore with chat_id: {chat_id}")
+            summary_service.schedule_summary(user_id, chat_id)
+        else:
+            persist_stats["failed"] += 1
+            # Don't keep serving messages that never reached Firestore
+            firebase_service.invalidate_history_cache(user_id, chat_id)
+    except Exception as e:
+        logger.error(f"Error persisting chat {chat_id}: {str(e)}")
+    finally:
+        firebase_service.forget_pending_turn(user_id, chat_id, message_ids)
+
+async def _worker(index):
+    """Take turns off the queue and commit them"""
+    while True:
+        job = await _queue.get()
+        try:
+            await _persist(job)
+        finally:
+            _queue.task_done()
+
+def get_persist_stats():
+    """Return queue depth and commit counters"""
+    return {
+        **persist_stats,
+        "queue_depth": _queue.qsize() if _queue else 0,
+    }
+
+async def shutdown():
+    """Wait for queued turns to be written, then stop the workers"""
+    if _queue is not None:
+        try:
+            await asyncio.wait_for(_queue.join(), timeout=PERSIST_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f"Persistence queue not drained on shutdown, {_queue.qsize()} turns lost")
+    if _overflow:
+        await asyncio.wait(set(_overflow), timeout=PERSIST_DRAIN_TIMEOUT)
+    
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
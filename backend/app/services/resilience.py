@@ -0,0 +1,307 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+import anthropic
+import httpx
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Retries of failed upstream calls
+RESILIENCE_MAX_ATTEMPTS = int(os.environ.get("RESILIENCE_MAX_ATTEMPTS", "4"))
+RESILIENCE_BACKOFF_BASE = float(os.environ.get("RESILIENCE_BACKOFF_BASE", "0.5"))
+RESILIENCE_BACKOFF_MAX = float(os.environ.get("RESILIENCE_BACKOFF_MAX", "8"))
+# A retry-after longer than this is not waited out; the request fails instead
+RESILIENCE_MAX_RETRY_AFTER = float(os.environ.get("RESILIENCE_MAX_RETRY_AFTER", "20"))
+
+# Retry budget: every call earns this fraction of a retry, so retries stay a
+# bounded share of traffic when the upstream is struggling
+RETRY_BUDGET_RATIO = float(os.environ.get("RESILIENCE_RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_MIN = float(os.environ.get("RESILIENCE_RETRY_BUDGET_MIN", "10"))
+RETRY_BUDGET_MAX = float(os.environ.get("RESILIENCE_RETRY_BUDGET_MAX", "100"))
+
+# Hedging: a second copy of a slow non-streaming call is sent once the first
+# has taken longer than this percentile of recent latencies
+HEDGE_ENABLED = os.environ.get("RESILIENCE_HEDGE", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.environ.get("RESILIENCE_HEDGE_PERCENTILE", "0.95"))
+HEDGE_MIN_SAMPLES = int(os.environ.get("RESILIENCE_HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MIN_DELAY = float(os.environ.get("RESILIENCE_HEDGE_MIN_DELAY", "1"))
+
+# Circuit breaker: consecutive upstream failures before failing fast, and how
+# long to fail fast before letting a probe request through
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("RESILIENCE_BREAKER_FAILURES", "5"))
+BREAKER_RESET_TIMEOUT = float(os.environ.get("RESILIENCE_BREAKER_RESET", "30"))
+
+# Error types Anthropic sends in the body, including mid-stream error events
+RETRYABLE_ERROR_TYPES = {"overloaded_error", "rate_limit_error", "api_error"}
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+resilience_stats = {
+    "calls": 0,
+    "retries": 0,
+    "budget_exhausted": 0,
+    "hedges": 0,
+    "hedge_wins": 0,
+    "short_circuited": 0,
+    "breaker_opened": 0,
+}
+
+class UpstreamUnavailable(Exception):
+    """Raised when Claude is overloaded or the circuit is open; retry_after is a hint in seconds"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+def _error_type(exc: Exception) -> Optional[str]:
+    body = getattr(exc, "body", None)
+    if isinstance(body, dict):
+        error = body.get("error")
+        if isinstance(error, dict):
+            return error.get("type")
+    return None
+
+def is_retryable(exc: Exception) -> bool:
+    """Whether a failed call may succeed if sent again unchanged"""
+    if isinstance(exc, (anthropic.APIConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(exc, anthropic.APIStatusError):
+        should_retry = exc.response.headers.get("x-should-retry")
+        if should_retry in ("true", "false"):
+            return should_retry == "true"
+        return exc.status_code in RETRYABLE_STATUS_CODES or _error_type(exc) in RETRYABLE_ERROR_TYPES
+    return False
+
+def retry_after(exc: Exception) -> Optional[float]:
+    """The wait the upstream asked for, from retry-after-ms or retry-after"""
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class RetryBudget:
+    """Token bucket that limits retries and hedges to a share of calls"""
+
+    def __init__(self, ratio: float, minimum: float, maximum: float):
+        self.ratio = ratio
+        self.maximum = maximum
+        self.balance = minimum
+
+    def deposit(self):
+        self.balance = min(self.maximum, self.balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.balance < 1:
+            resilience_stats["budget_exhausted"] += 1
+            return False
+        self.balance -= 1
+        return True
+
+class CircuitBreaker:
+    """
+    Closed -> open after consecutive failures, open -> half-open after a
+    timeout; in half-open one probe is let through and decides the state
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def before_call(self) -> bool:
+        """
+        Raise UpstreamUnavailable while the circuit is open
+
+        Returns True when the call is the half-open probe; the caller must
+        then call release_probe once the call is over, however it ended.
+        """
+        if self.state == "closed":
+            return False
+        remaining = self.opened_at + self.reset_timeout - time.monotonic()
+        if self.state == "open" and remaining <= 0:
+            self.state = "half_open"
+        if self.state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        resilience_stats["short_circuited"] += 1
+        raise UpstreamUnavailable("Claude API is unavailable", max(remaining, 1))
+
+    def record_success(self):
+        self.failures = 0
+        self.probing = False
+        if self.state != "closed":
+            logger.info("Circuit breaker closed")
+        self.state = "closed"
+
+    def release_probe(self):
+        """Free the probe slot; a probe that succeeded or failed has already freed it"""
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.threshold):
+            if self.state == "closed":
+                resilience_stats["breaker_opened"] += 1
+            logger.warning(f"Circuit breaker open after {self.failures} upstream failures")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+class LatencyTracker:
+    """Recent call latencies, for the hedging threshold"""
+
+    def __init__(self, size: int = 500):
+        self.samples: "deque[float]" = deque(maxlen=size)
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+budget = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN, RETRY_BUDGET_MAX)
+breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+latencies = LatencyTracker()
+
+def before_call(attempt: int = 0) -> bool:
+    """
+    Start an upstream attempt: check the breaker; first attempts earn retry budget
+
+    Returns whether the attempt is the breaker's half-open probe.
+    """
+    probe = breaker.before_call()
+    if attempt == 0:
+        budget.deposit()
+        resilience_stats["calls"] += 1
+    return probe
+
+def record_success(elapsed: Optional[float] = None):
+    breaker.record_success()
+    if elapsed is not None:
+        latencies.record(elapsed)
+
+def next_delay(exc: Exception, attempt: int) -> float:
+    """
+    Decide whether a failed attempt is retried
+
+    Returns how long to back off before the next attempt, or raises:
+    non-retryable errors are re-raised as they are, retryable ones that are
+    out of attempts, time or budget become UpstreamUnavailable.
+    """
+    if not is_retryable(exc):
+        # The upstream answered, so as far as the breaker is concerned it is healthy
+        if isinstance(exc, anthropic.APIStatusError):
+            breaker.record_success()
+        raise exc
+
+    breaker.record_failure()
+    asked = retry_after(exc)
+    # Full jitter keeps retrying clients from moving in lockstep
+    delay = random.uniform(0, min(RESILIENCE_BACKOFF_MAX, RESILIENCE_BACKOFF_BASE * 2 ** attempt))
+    if asked is not None:
+        delay = max(delay, asked)
+
+    hint = asked if asked is not None else delay
+    if attempt + 1 >= RESILIENCE_MAX_ATTEMPTS:
+        raise UpstreamUnavailable(f"Claude API is overloaded: {exc}", hint) from exc
+    if delay > RESILIENCE_MAX_RETRY_AFTER or breaker.state != "closed" or not budget.withdraw():
+        raise UpstreamUnavailable(f"Claude API is overloaded: {exc}", hint) from exc
+
+    resilience_stats["retries"] += 1
+    logger.warning(f"Retrying Claude call in {delay:.2f}s after: {exc}")
+    return delay
+
+async def _hedged(fn: Callable[[], Awaitable[T]]) -> T:
+    """Run fn, and a second copy if the first is slower than usual; first success wins"""
+    primary = asyncio.ensure_future(fn())
+    delay = latencies.percentile(HEDGE_PERCENTILE)
+    if delay is None:
+        return await primary
+
+    done, _ = await asyncio.wait({primary}, timeout=max(delay, HEDGE_MIN_DELAY))
+    if done or not budget.withdraw():
+        return await primary
+
+    resilience_stats["hedges"] += 1
+    logger.info(f"Hedging Claude call slower than {delay:.2f}s")
+    hedge = asyncio.ensure_future(fn())
+    pending = {primary, hedge}
+    try:
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        resilience_stats["hedge_wins"] += 1
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in (primary, hedge):
+            if not task.done():
+                task.cancel()
+
+async def call(fn: Callable[[], Awaitable[T]], hedge: bool = False) -> T:
+    """
+    Make an idempotent upstream call with retries, the circuit breaker and,
+    when enabled and asked for, hedging
+
+    fn must start a fresh request every time it is called.
+    """
+    attempt = 0
+    while True:
+        probe = before_call(attempt)
+        started = time.monotonic()
+        try:
+            if hedge and HEDGE_ENABLED:
+                result = await _hedged(fn)
+            else:
+                result = await fn()
+        except Exception as e:
+            delay = next_delay(e, attempt)
+        else:
+            record_success(time.monotonic() - started)
+            return result
+        finally:
+            # The probe slot must not stay taken when the probe was cancelled
+            # or ended in an error that says nothing about the upstream
+            if probe:
+                breaker.release_probe()
+        await asyncio.sleep(delay)
+        attempt += 1
+
+def get_resilience_stats() -> Dict[str, Any]:
+    """Return retry/hedge counters, the retry budget and the breaker state"""
+    return {
+        **resilience_stats,
+        "retry_budget": round(budget.balance, 2),
+        "breaker_state": breaker.state,
+        "consecutive_failures": breaker.failures,
+        "latency_p95_seconds": latencies.percentile(0.95),
+    }
@@ -0,0 +1,263 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import asyncio
+import threading
+import unicodedata
+from typing import Any, Dict, List, Optional
+
+from app.utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Opt-in: identical prompts are answered from the cache instead of the API
+RESPONSE_CACHE_ENABLED = os.environ.get("CLAUDE_RESPONSE_CACHE", "false").lower() == "true"
+# "memory" keeps responses in this worker only, "sqlite" also keeps them on disk
+RESPONSE_CACHE_BACKEND = os.environ.get("CLAUDE_RESPONSE_CACHE_BACKEND", "memory").lower()
+RESPONSE_CACHE_PATH = os.environ.get("CLAUDE_RESPONSE_CACHE_PATH", "response_cache.sqlite3")
+RESPONSE_CACHE_TTL = float(os.environ.get("CLAUDE_RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_SIZE = int(os.environ.get("CLAUDE_RESPONSE_CACHE_SIZE", "1000"))
+RESPONSE_CACHE_BYTES = int(os.environ.get("CLAUDE_RESPONSE_CACHE_BYTES", str(32 * 1024 * 1024)))
+# Rows kept in the SQLite backend; the least recently used are pruned beyond this
+RESPONSE_CACHE_DISK_ENTRIES = int(os.environ.get("CLAUDE_RESPONSE_CACHE_DISK_ENTRIES", "100000"))
+
+# Size of the chunks a cached response is replayed in when streaming
+REPLAY_CHUNK_CHARS = int(os.environ.get("CLAUDE_RESPONSE_CACHE_REPLAY_CHARS", "64"))
+
+response_cache_stats = {
+    "hits": 0,
+    "misses": 0,
+    "stores": 0,
+    "disk_hits": 0,
+}
+
+def _normalize_text(text: str) -> str:
+    """
+    Fold differences that don't change the prompt: Unicode form and
+    surrounding whitespace
+
+    Whitespace inside the text is kept, since indentation and line breaks
+    matter in code, YAML and tables.
+    """
+    return unicodedata.normalize("NFKC", text).strip()
+
+def _normalize_content(content: Any) -> List[Any]:
+    """
+    Reduce message content to what the model sees
+
+    Prompt cache markers are dropped and images are reduced to their media
+    type; the image itself is keyed by the image_key passed to make_key, so
+    its data is never copied or hashed here.
+    """
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+
+    parts = []
+    for block in content or []:
+        if block.get("type") == "text":
+            text = _normalize_text(block.get("text", ""))
+            if text:
+                parts.append(["text", text])
+        elif block.get("type") == "image":
+            parts.append(["image", block.get("source", {}).get("media_type")])
+    return parts
+
+def make_key(
+    model: str,
+    system: Any,
+    messages: List[Dict[str, Any]],
+    temperature: float,
+    max_tokens: int,
+    image_key: Optional[str] = None
+) -> str:
+    """
+    Build the cache key for a request from its normalized parameters
+
+    image_key identifies the request's image, normally the content hash
+    image_store names it by.
+    """
+    payload = {
+        "model": model,
+        "system": _normalize_content(system),
+        "messages": [[msg.get("role", "user"), _normalize_content(msg.get("content"))] for msg in messages],
+        "image": image_key,
+        "temperature": round(float(temperature), 3),
+        "max_tokens": max_tokens,
+    }
+    encoded = json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+class MemoryBackend:
+    """Responses kept in this worker, bounded by count and total size"""
+
+    def __init__(self, maxsize: int, maxbytes: int, ttl: float):
+        self.entries = TTLCache(
+            maxsize=maxsize,
+            ttl=ttl,
+            maxweight=maxbytes,
+            weigher=lambda response: len(response.get("content", "")) * 4
+        )
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return self.entries.get(key)
+
+    def set(self, key: str, response: Dict[str, Any], ttl: Optional[float] = None):
+        self.entries.set(key, response, ttl=ttl)
+
+    def stats(self) -> Dict[str, Any]:
+        return self.entries.stats()
+
+    def close(self):
+        self.entries.clear()
+
+class SQLiteBackend:
+    """
+    Responses kept in a SQLite file so they survive restarts
+
+    Placed behind a MemoryBackend; reads and writes are blocking and are run
+    in a thread by the caller.
+    """
+
+    def __init__(self, path: str, max_entries: int, ttl: float):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+        self._writes = 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key: str, response: Dict[str, Any], ttl: Optional[float] = None):
+        now = time.time()
+        expires_at = now + (ttl if ttl is not None else self.ttl)
+        value = json.dumps(response, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, expires_at, now)
+            )
+            self._writes += 1
+            # Prune now and then rather than on every write
+            if self._writes % 100 == 0:
+                self._prune(now)
+
+    def _prune(self, now: float):
+        """Drop expired rows and the least recently used rows over the limit"""
+        self._conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+        self._conn.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+        return {"path": self.path, "size": count, "maxsize": self.max_entries}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+_memory = None
+_disk = None
+
+def _init_backends():
+    """Create the configured backends; the disk one is optional"""
+    global _memory, _disk
+    _memory = MemoryBackend(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_BYTES, RESPONSE_CACHE_TTL)
+    if RESPONSE_CACHE_BACKEND == "sqlite":
+        try:
+            _disk = SQLiteBackend(RESPONSE_CACHE_PATH, RESPONSE_CACHE_DISK_ENTRIES, RESPONSE_CACHE_TTL)
+            logger.info(f"Response cache persisted to {RESPONSE_CACHE_PATH}")
+        except Exception as e:
+            logger.error(f"Failed to open response cache database: {str(e)}")
+            _disk = None
+
+if RESPONSE_CACHE_ENABLED:
+    _init_backends()
+
+async def get(key: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Return the cached response for key, checking memory before disk; a None key never hits"""
+    if not RESPONSE_CACHE_ENABLED or key is None:
+        return None
+
+    response = _memory.get(key)
+    if response is None and _disk is not None:
+        try:
+            response = await asyncio.to_thread(_disk.get, key)
+        except Exception as e:
+            logger.error(f"Response cache read failed: {str(e)}")
+            response = None
+        if response is not None:
+            response_cache_stats["disk_hits"] += 1
+            _memory.set(key, response)
+
+    if response is None:
+        response_cache_stats["misses"] += 1
+        return None
+    response_cache_stats["hits"] += 1
+    return response
+
+async def set(key: Optional[str], response: Dict[str, Any]):
+    """Store a completed response under key; responses without a key are not stored"""
+    if not RESPONSE_CACHE_ENABLED or key is None or not response.get("content"):
+        return
+
+    entry = {
+        "content": response["content"],
+        "model": response.get("model"),
+        "id": response.get("id"),
+    }
+    _memory.set(key, entry)
+    response_cache_stats["stores"] += 1
+    if _disk is not None:
+        try:
+            await asyncio.to_thread(_disk.set, key, entry)
+        except Exception as e:
+            logger.error(f"Response cache write failed: {str(e)}")
+
+def replay_chunks(content: str) -> List[str]:
+    """Split a cached response into chunks for a synthetic stream"""
+    return [content[i:i + REPLAY_CHUNK_CHARS] for i in range(0, len(content), REPLAY_CHUNK_CHARS)]
+
+def get_response_cache_stats() -> Dict[str, Any]:
+    """Return hit/miss counters and the state of each backend"""
+    if not RESPONSE_CACHE_ENABLED:
+        return {"enabled": False}
+
+    stats = {"enabled": True, **response_cache_stats, "memory": _memory.stats()}
+    if _disk is not None:
+        stats["disk"] = _disk.stats()
+    return stats
+
+def close():
+    """Close the disk backend"""
+    global _disk
+    if _disk is not None:
+        _disk.close()
+        _disk = None
@@ -0,0 +1,66 @@
+import os
+import asyncio
+import logging
+
+from app.services import claude_service, firebase_service
+
+logger = logging.getLogger(__name__)
+
+# Start compacting once a chat has this many messages not covered by its summary
+SUMMARY_TRIGGER_MESSAGES = int(os.environ.get("SUMMARY_TRIGGER_MESSAGES", "20"))
+
+# Newest messages left out of the summary so they are still sent verbatim
+SUMMARY_KEEP_RECENT = int(os.environ.get("SUMMARY_KEEP_RECENT", "8"))
+
+# Running compaction jobs keyed by (user_id, chat_id)
+_jobs = {}
+
+def schedule_summary(user_id, chat_id):
+    """
+    Start a background compaction job for a chat if one is not already running
+    
+    Called after a turn has been saved; the job runs outside the request path.
+    """
+    if user_id == "anonymous" or not chat_id:
+        return
+    
+    key = (user_id, chat_id)
+    if key in _jobs:
+        return
+    
+    task = asyncio.create_task(_summarize_chat(user_id, chat_id))
+    _jobs[key] = task
+    task.add_done_callback(lambda _: _jobs.pop(key, None))
+
+async def _summarize_chat(user_id, chat_id):
+    """Fold older unsummarized messages of a chat into its rolling summary"""
+    try:
+        current = await asyncio.to_thread(firebase_service.get_chat_summary, user_id, chat_id)
+        summary_until = current["summary_until"] if current else None
+        
+        messages = await asyncio.to_thread(
+            firebase_service.get_messages_after, user_id, chat_id, summary_until
+        )
+        if len(messages) < SUMMARY_TRIGGER_MESSAGES:
+            return
+        
+        to_fold = messages[:-SUMMARY_KEEP_RECENT]
+        summary = await claude_service.summarize_conversation(
+            to_fold,
+            previous_summary=current["summary"] if current else None
+        )
+        if not summary:
+            return
+        
+        await asyncio.to_thread(
+            firebase_service.save_chat_summary, user_id, chat_id, summary, to_fold[-1].get("timestamp")
+        )
+        logger.info(f"Summarized {len(to_fold)} messages of chat {chat_id}")
+    except Exception as e:
+        logger.error(f"Error summarizing chat {chat_id}: {str(e)}")
+
+async def shutdown():
+    """Cancel compaction jobs that are still running"""
+    for task in list(_jobs.values()):
+        task.cancel()
+    await asyncio.gather(*_jobs.values(), return_exceptions=True)
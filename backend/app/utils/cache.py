@@ -0,0 +1,123 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+class TTLCache:
+    """
+    Thread-safe, size-bounded LRU cache whose entries also expire after a TTL
+    
+    Keeps hit/miss/eviction counters so callers can expose them as stats.
+    With a weigher (e.g. len for bytes values) the cache is also bounded by
+    the total weight of its values.
+    """
+    
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: Optional[float] = None,
+        maxweight: Optional[int] = None,
+        weigher: Optional[Callable[[Any], int]] = None
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight
+        self.weigher = weigher
+        self.weight = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return the cached value for key, or default on a miss"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+    
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Return the cached value for key without touching LRU order or counters"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                return default
+            return value
+    
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """Store value under key, evicting the least recently used entries if full"""
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, expires_at)
+            if self.weigher:
+                self.weight += self.weigher(value)
+            while len(self._data) > self.maxsize or (
+                self.maxweight is not None and self.weight > self.maxweight and len(self._data) > 1
+            ):
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+    
+    def _remove(self, key: Hashable):
+        """Delete key and update the total weight; the lock must be held"""
+        value, _ = self._data.pop(key)
+        if self.weigher:
+            self.weight -= self.weigher(value)
+        return value
+    
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Remove key and return its value"""
+        with self._lock:
+            if key not in self._data:
+                return default
+            return self._remove(key)
+    
+    def keys(self):
+        """Return a snapshot of the cached keys"""
+        with self._lock:
+            return list(self._data.keys())
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+    
+    def __contains__(self, key: Hashable) -> bool:
+        return self.peek(key) is not None
+    
+    def __len__(self) -> int:
+        return len(self._data)
+    
+    def stats(self) -> Dict[str, int]:
+        """Return a snapshot of the cache counters"""
+        stats = {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+        if self.weigher:
+            stats["weight"] = self.weight
+            stats["maxweight"] = self.maxweight
+        return stats
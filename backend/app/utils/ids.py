@@ -0,0 +1,40 @@
+import os
+import time
+import threading
+
+# Crockford base32, which sorts lexicographically in the same order as the values
+_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+_lock = threading.Lock()
+_last_ms = 0
+_last_random = 0
+
+def _encode(value: int, length: int) -> str:
+    chars = []
+    for _ in range(length):
+        value, index = divmod(value, 32)
+        chars.append(_ALPHABET[index])
+    return "".join(reversed(chars))
+
+def ulid() -> str:
+    """
+    Generate a ULID: 48-bit millisecond timestamp + 80 random bits, 26 chars
+    
+    IDs sort by creation time. Within the same millisecond the random part is
+    incremented instead of redrawn, so IDs from one process stay strictly
+    increasing.
+    """
+    global _last_ms, _last_random
+    with _lock:
+        now_ms = int(time.time() * 1000)
+        if now_ms <= _last_ms:
+            now_ms = _last_ms
+            _last_random = (_last_random + 1) & ((1 << 80) - 1)
+            if _last_random == 0:
+                # Random part overflowed within one millisecond, borrow the next one
+                now_ms += 1
+                _last_random = int.from_bytes(os.urandom(10), "big")
+        else:
+            _last_random = int.from_bytes(os.urandom(10), "big")
+        _last_ms = now_ms
+        return _encode(now_ms, 10) + _encode(_last_random, 16)
@@ -1,96 +1,446 @@
+import os
 import base64
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
-from PIL import Image
+from PIL import Image, ImageOps
 import logging
 
 logger = logging.getLogger(__name__)
 
-def compress_image(image_data: str, max_size_kb: int = 4096) -> tuple:
+# Image work runs in a separate process pool so decoding and re-encoding
+# large images never blocks the event loop
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", str(min(4, os.cpu_count() or 1))))
+IMAGE_MAX_PENDING = int(os.environ.get("IMAGE_MAX_PENDING", "32"))
+IMAGE_TIMEOUT = float(os.environ.get("IMAGE_TIMEOUT", "10"))
+
+_executor = None
+_pending = 0
+
+# Claude's optimal image size: larger images are downscaled server-side
+CLAUDE_MAX_LONG_EDGE = int(os.environ.get("CLAUDE_MAX_LONG_EDGE", "1568"))
+CLAUDE_MAX_MEGAPIXELS = float(os.environ.get("CLAUDE_MAX_MEGAPIXELS", "1.15"))
+
+# Size normalized images are encoded down to
+IMAGE_TARGET_KB = int(os.environ.get("IMAGE_TARGET_KB", "1024"))
+
+# Info keys that mean an image carries metadata worth stripping
+IMAGE_METADATA_KEYS = ("exif", "xmp", "XML:com.adobe.xmp", "comment")
+
+# Largest accepted upload; BodySizeLimitMiddleware cuts off larger bodies
+# before Starlette has spooled all of them
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+
+# Totals for normalized images in this process
+image_stats = {
+    "images": 0,
+    "bytes_in": 0,
+    "bytes_out": 0,
+}
+
+# Long edge of the thumbnails stored next to uploaded images
+THUMBNAIL_SIZE = int(os.environ.get("THUMBNAIL_SIZE", "256"))
+
+JPEG_MAX_QUALITY = 85
+JPEG_MIN_QUALITY = 35
+
+LOSSY_FORMATS = ("JPEG", "WEBP")
+
+# Lossless images with more colors than this are treated as photos and go
+# straight to WebP
+PALETTE_MAX_COLORS = 256
+
+# Share of the byte budget quality and size estimates aim for, and how
+# steeply encoded size is assumed to grow with quality
+QUALITY_ESTIMATE_MARGIN = 0.9
+QUALITY_SIZE_EXPONENT = 1.5
+
+# Output format per source format; GIFs are sent as their first frame in PNG
+OUTPUT_FORMATS = {
+    "JPEG": "JPEG",
+    "MPO": "JPEG",
+    "WEBP": "WEBP",
+    "PNG": "PNG",
+    "GIF": "PNG",
+}
+
+FORMAT_MIME_TYPES = {
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+    "PNG": "image/png",
+    "GIF": "image/gif",
+}
+
+class ImageQueueFullError(Exception):
+    """Raised when too many images are already waiting for the process pool"""
+
+class ImagePoolUnavailableError(Exception):
+    """Raised when the image process pool broke and a new one failed as well"""
+
+class ImageTooLargeError(Exception):
+    """Raised when an upload exceeds MAX_UPLOAD_BYTES"""
+
+class UnsupportedImageError(Exception):
+    """Raised when uploaded bytes are not a JPEG, PNG, GIF or WebP image"""
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # Spawn rather than fork: the parent has Firebase/HTTP client threads running
+        _executor = ProcessPoolExecutor(
+            max_workers=IMAGE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _executor
+
+def _release_slot(loop, job):
+    """Done callback of an image job; runs in the pool's management thread"""
+    try:
+        loop.call_soon_threadsafe(_decrement_pending)
+    except RuntimeError:
+        # The loop is closed, so nothing else touches the counter
+        _decrement_pending()
+
+def _decrement_pending():
+    global _pending
+    _pending -= 1
+
+def _replace_broken_executor(broken):
+    """Shut down a pool whose worker died; the next _get_executor starts a new one"""
+    global _executor
+    if _executor is broken:
+        logger.warning("Image process pool is broken, starting a new one")
+        _executor = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+async def _run_once(func, args, timeout):
+    global _pending
+    loop = asyncio.get_running_loop()
+    executor = _get_executor()
+    try:
+        job = executor.submit(func, *args)
+        _pending += 1
+        job.add_done_callback(functools.partial(_release_slot, loop))
+        # Cancelling the wrapper cancels the job only if no worker has started it
+        return await asyncio.wait_for(asyncio.wrap_future(job), timeout=timeout or IMAGE_TIMEOUT)
+    except BrokenProcessPool:
+        _replace_broken_executor(executor)
+        raise
+
+async def run_in_image_pool(func, *args, timeout: float = None):
     """
-    Compress image if it's larger than max_size_kb
+    Run func(*args) in the image process pool
     
-    Args:
-        image_data: Base64 encoded image data
-        max_size_kb: Maximum size in KB (default 4MB)
-        
-    Returns:
-        Tuple of (compressed_base64_data, mime_type)
+    Raises ImageQueueFullError when IMAGE_MAX_PENDING jobs are already queued
+    or running, and asyncio.TimeoutError if the job takes longer than timeout.
+    A job that times out while running keeps its slot until the worker is
+    done with it; one that is still queued is cancelled. When a worker dies
+    the pool is replaced and the job is tried once more in the new one;
+    ImagePoolUnavailableError is raised if that fails too.
     """
+    if _pending >= IMAGE_MAX_PENDING:
+        raise ImageQueueFullError(f"{_pending} images already being processed")
+    
     try:
-        # Split the base64 string to get the actual data
-        header, encoded = image_data.split(",", 1)
-        mime_type = header.split(":")[1].split(";")[0]
-        
-        # Decode base64
-        binary_data = base64.b64decode(encoded)
-        
-        # Check size
-        current_size_kb = len(binary_data) / 1024
-        if current_size_kb <= max_size_kb:
-            # No need to compress
-            return encoded, mime_type
-            
-        # Open the image with PIL
-        img = Image.open(BytesIO(binary_data))
-        
-        # Calculate current dimensions
-        width, height = img.size
-        
-        # Try compression quality first for JPEG
-        if mime_type in ["image/jpeg", "image/jpg"]:
-            quality = 85  # Initial quality
-            output = BytesIO()
-            
-            while quality > 30:  # Don't go below quality 30
-                output = BytesIO()
-                img.save(output, format="JPEG", quality=quality)
-                if len(output.getvalue()) / 1024 <= max_size_kb:
-                    break
-                quality -= 10
-                
-            # If still too large, resize
-            if len(output.getvalue()) / 1024 > max_size_kb:
-                # Calculate new dimensions
-                scale_factor = (max_size_kb / (len(output.getvalue()) / 1024)) ** 0.5
-                new_width = int(width * scale_factor)
-                new_height = int(height * scale_factor)
-                
-                # Resize and save
-                img = img.resize((new_width, new_height), Image.LANCZOS)
-                output = BytesIO()
-                img.save(output, format="JPEG", quality=quality)
-                
-            # Return compressed data
-            compressed_data = base64.b64encode(output.getvalue()).decode("utf-8")
-            return compressed_data, "image/jpeg"
-            
-        # For PNG or other formats, try resizing
-        else:
-            # Calculate target size
-            scale_factor = (max_size_kb / current_size_kb) ** 0.5
-            if scale_factor >= 1:
-                # No need to resize
-                return encoded, mime_type
-                
-            # Resize the image
-            new_width = int(width * scale_factor)
-            new_height = int(height * scale_factor)
-            img = img.resize((new_width, new_height), Image.LANCZOS)
-            
-            # Save to BytesIO
-            output = BytesIO()
-            img_format = mime_type.split("/")[-1].upper()
-            img.save(output, format=img_format)
-            
-            # Return compressed data
-            compressed_data = base64.b64encode(output.getvalue()).decode("utf-8")
-            return compressed_data, mime_type
-            
-    except Exception as e:
-        logger.error(f"Error compressing image: {str(e)}")
-        # Return the original data if compression fails
-        if "," in image_data:
-            header, encoded = image_data.split(",", 1)
-            mime_type = header.split(":")[1].split(";")[0]
-            return encoded, mime_type
-        return image_data, "image/jpeg"
\ No newline at end of file
+        return await _run_once(func, args, timeout)
+    except BrokenProcessPool:
+        pass
+    try:
+        return await _run_once(func, args, timeout)
+    except BrokenProcessPool as e:
+        raise ImagePoolUnavailableError("Image process pool is unavailable") from e
+
+def get_image_pool_stats():
+    """Return the number of image jobs queued or running and normalization totals"""
+    return {
+        "pending": _pending,
+        "max_pending": IMAGE_MAX_PENDING,
+        "workers": IMAGE_WORKERS,
+        **image_stats,
+        "bytes_saved": image_stats["bytes_in"] - image_stats["bytes_out"],
+    }
+
+def shutdown_image_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+def target_dimensions(width: int, height: int) -> tuple:
+    """
+    Largest dimensions within Claude's optimal image size
+    
+    Claude downscales anything with a long edge above CLAUDE_MAX_LONG_EDGE or
+    more than CLAUDE_MAX_MEGAPIXELS, so there is no point sending more.
+    """
+    scale = min(
+        1.0,
+        CLAUDE_MAX_LONG_EDGE / max(width, height),
+        (CLAUDE_MAX_MEGAPIXELS * 1_000_000 / (width * height)) ** 0.5
+    )
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+def _open_for_size(binary_data: bytes) -> tuple:
+    """
+    Open an image already decoded close to the size it will be sent at
+    
+    For JPEGs, draft() lets the decoder scale by 1/2, 1/4 or 1/8 while
+    decoding, which is far cheaper than decoding at full size and resizing.
+    Returns (image, target_size).
+    """
+    img = Image.open(BytesIO(binary_data))
+    source_format = img.format
+    target = target_dimensions(*img.size)
+    
+    if source_format == "JPEG" and target != img.size:
+        img.draft("RGB", target)
+    
+    # Animated images: only the first frame is sent
+    img.seek(0)
+    
+    # Apply EXIF orientation before the metadata is dropped on re-encode
+    img = ImageOps.exif_transpose(img)
+    img.format = source_format
+    return img, target_dimensions(*img.size)
+
+def _resize(img: Image.Image, target: tuple) -> Image.Image:
+    """Resize to target, using reduce() for the integer part of large downscales"""
+    if img.size == target:
+        return img
+    
+    if img.mode not in ("RGB", "RGBA", "L", "LA"):
+        img = img.convert("RGBA" if "transparency" in img.info or img.mode in ("P", "PA") else "RGB")
+    
+    factor = min(img.width // target[0], img.height // target[1])
+    if factor >= 2:
+        img = img.reduce(factor)
+    return img.resize(target, Image.LANCZOS)
+
+def _encode(img: Image.Image, fmt: str, quality: int = None) -> bytes:
+    """Encode without metadata, except the color profile"""
+    output = BytesIO()
+    icc_profile = img.info.get("icc_profile")
+    if fmt == "JPEG":
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.save(output, format="JPEG", quality=quality, optimize=True, progressive=True, icc_profile=icc_profile)
+    elif fmt == "WEBP":
+        img.save(output, format="WEBP", quality=quality, method=4, icc_profile=icc_profile)
+    else:
+        img.save(output, format=fmt, icc_profile=icc_profile)
+    return output.getvalue()
+
+def _is_photographic(img: Image.Image) -> bool:
+    """
+    Whether an image has too many colors to compress well losslessly
+    
+    getcolors() gives up as soon as it has seen more than the limit, so this
+    is cheap next to an encode.
+    """
+    return img.mode not in ("1", "P") and img.getcolors(maxcolors=PALETTE_MAX_COLORS) is None
+
+def _estimate_quality(size: int, max_bytes: int) -> int:
+    """
+    Quality expected to bring a JPEG_MAX_QUALITY encode of size bytes within max_bytes
+    
+    Models encoded size as growing with quality ** QUALITY_SIZE_EXPONENT,
+    which most photos shrink faster than at lower qualities.
+    """
+    ratio = max_bytes * QUALITY_ESTIMATE_MARGIN / size
+    quality = int(JPEG_MAX_QUALITY * ratio ** (1 / QUALITY_SIZE_EXPONENT))
+    return max(JPEG_MIN_QUALITY, min(JPEG_MAX_QUALITY, quality))
+
+def _expected_size(size: int, quality: int) -> float:
+    """Size _estimate_quality's model expects at quality, from size at JPEG_MAX_QUALITY"""
+    return size * (quality / JPEG_MAX_QUALITY) ** QUALITY_SIZE_EXPONENT
+
+def _shrink(img: Image.Image, ratio: float) -> Image.Image:
+    """Downscale by the square root of ratio, so the pixel count falls by ratio"""
+    scale = min(1.0, ratio * QUALITY_ESTIMATE_MARGIN) ** 0.5
+    return _resize(img, (max(1, int(img.width * scale)), max(1, int(img.height * scale))))
+
+def _encode_to_size(img: Image.Image, fmt: str, max_bytes: int) -> tuple:
+    """
+    Encode img as fmt within max_bytes, normally with at most two encodes
+    
+    Lossy formats are encoded at JPEG_MAX_QUALITY; if that is too large the
+    second encode uses a quality estimated from how far over it was, on a
+    smaller image when even JPEG_MIN_QUALITY is not expected to fit.
+    Lossless formats are kept for graphics that fit; photographic images and
+    graphics that don't fit are encoded as WebP, which keeps transparency.
+    Only when the last encode is still too large is the image downscaled
+    once more. Returns (encoded_bytes, format).
+    """
+    encodes_left = 2
+    if fmt not in LOSSY_FORMATS:
+        if not _is_photographic(img):
+            data = _encode(img, fmt)
+            if len(data) <= max_bytes:
+                return data, fmt
+            encodes_left -= 1
+        fmt = "WEBP"
+    
+    quality = JPEG_MAX_QUALITY
+    data = _encode(img, fmt, quality)
+    encodes_left -= 1
+    
+    if len(data) > max_bytes and encodes_left:
+        quality = _estimate_quality(len(data), max_bytes)
+        expected = _expected_size(len(data), quality)
+        if expected > max_bytes:
+            img = _shrink(img, max_bytes / expected)
+        data = _encode(img, fmt, quality)
+    
+    if len(data) > max_bytes:
+        img = _shrink(img, max_bytes / len(data))
+        data = _encode(img, fmt, quality)
+        if len(data) > max_bytes:
+            logger.warning(f"Encoded image is still {len(data) // 1024}KB, above the {max_bytes // 1024}KB target")
+    return data, fmt
+
+def encode_for_claude(binary_data: bytes, max_size_kb: int = 4096) -> tuple:
+    """
+    Downscale and re-encode raw image bytes for Claude in a single pass
+    
+    Returns (encoded_bytes, mime_type).
+    """
+    img, target = _open_for_size(binary_data)
+    fmt = OUTPUT_FORMATS.get(img.format, "PNG")
+    img = _resize(img, target)
+    data, fmt = _encode_to_size(img, fmt, max_size_kb * 1024)
+    return data, FORMAT_MIME_TYPES[fmt]
+
+def make_thumbnail(binary_data: bytes, size: int = None) -> bytes:
+    """Small WebP preview of an image, for chat lists"""
+    size = size or THUMBNAIL_SIZE
+    img = Image.open(BytesIO(binary_data))
+    img.draft("RGB", (size, size))
+    img.seek(0)
+    img = ImageOps.exif_transpose(img)
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "transparency" in img.info or img.mode in ("P", "PA", "LA") else "RGB")
+    img.thumbnail((size, size), Image.LANCZOS, reducing_gap=2.0)
+    return _encode(img, "WEBP", 75)
+
+def parse_data_url(data_url: str) -> tuple:
+    """Split a base64 data URL into (raw_bytes, mime_type)"""
+    header, encoded = data_url.split(",", 1)
+    mime_type = header.split(":")[1].split(";")[0]
+    return base64.b64decode(encoded), mime_type
+
+def sniff_image_type(header: bytes) -> str:
+    """Detect the image MIME type from its first bytes, or None if it isn't a supported image"""
+    if header.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if header[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+async def check_upload(upload, max_bytes: int = None) -> tuple:
+    """
+    Check the size and type of an UploadFile that Starlette has already spooled
+    
+    Raises ImageTooLargeError if it is larger than max_bytes and
+    UnsupportedImageError if the magic bytes are not a supported image (the
+    client's content type is not trusted). Returns (file, mime_type), where
+    file is the upload's own spooled file, rewound, so the image is not
+    copied again.
+    """
+    max_bytes = max_bytes or MAX_UPLOAD_BYTES
+    size = upload.size if upload.size is not None else await asyncio.to_thread(_source_size, upload.file)
+    if size > max_bytes:
+        raise ImageTooLargeError(f"Upload exceeds {max_bytes} bytes")
+    
+    header = await upload.read(16)
+    await upload.seek(0)
+    mime_type = sniff_image_type(header)
+    if not mime_type:
+        raise UnsupportedImageError("Uploaded file is not a supported image")
+    return upload.file, mime_type
+
+def _source_size(source) -> int:
+    """Size of raw bytes or of a seekable binary file"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return len(source)
+    position = source.tell()
+    size = source.seek(0, os.SEEK_END)
+    source.seek(position)
+    return size
+
+def is_normalized(source, max_size_kb: int = None) -> tuple:
+    """
+    Check from the image header alone whether normalize_image would keep the image as-is
+    
+    source is raw bytes or a seekable binary file. Returns
+    (already_normalized, source_format). Pixels are not decoded, so this is
+    cheap enough to run on the event loop.
+    """
+    max_bytes = (max_size_kb or IMAGE_TARGET_KB) * 1024
+    is_file = not isinstance(source, (bytes, bytearray, memoryview))
+    try:
+        with Image.open(source if is_file else BytesIO(source)) as probe:
+            already_normalized = (
+                probe.format in ("JPEG", "PNG", "WEBP")
+                and target_dimensions(*probe.size) == probe.size
+                and getattr(probe, "n_frames", 1) == 1
+                and not any(key in probe.info for key in IMAGE_METADATA_KEYS)
+                and _source_size(source) <= max_bytes
+            )
+            return already_normalized, probe.format
+    finally:
+        if is_file:
+            source.seek(0)
+
+def normalize_image(binary_data: bytes, max_size_kb: int = None) -> tuple:
+    """
+    Bring any image to the size and format Claude actually uses
+    
+    Images are downscaled to Claude's optimal dimensions, re-encoded without
+    EXIF or other metadata, and large lossless images are transcoded to WebP.
+    Single-frame JPEG/PNG/WebP images that are already within the limits and
+    carry no metadata are returned unchanged without decoding them.
+    Returns (image_bytes, mime_type).
+    """
+    already_normalized, source_format = is_normalized(binary_data, max_size_kb)
+    if already_normalized:
+        return binary_data, FORMAT_MIME_TYPES[source_format]
+    
+    return encode_for_claude(binary_data, max_size_kb or IMAGE_TARGET_KB)
+
+async def normalize_image_async(source) -> tuple:
+    """
+    Awaitable normalize_image that runs in the image process pool
+    
+    source is raw bytes or a seekable binary file such as the one from
+    check_upload. Returns (image_bytes, mime_type, bytes_saved) and adds to
+    image_stats.
+    """
+    size_in = _source_size(source)
+    
+    # Images that need no work skip the pool, and with it two pickled copies.
+    # Files may have rolled over to disk, so they are probed and read in a thread.
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        already_normalized, source_format = is_normalized(source)
+        binary_data = source
+    else:
+        already_normalized, source_format = await asyncio.to_thread(is_normalized, source)
+        binary_data = await asyncio.to_thread(source.read)
+    if already_normalized:
+        normalized, mime_type = binary_data, FORMAT_MIME_TYPES[source_format]
+    else:
+        normalized, mime_type = await run_in_image_pool(normalize_image, binary_data)
+    
+    bytes_saved = size_in - len(normalized)
+    image_stats["images"] += 1
+    image_stats["bytes_in"] += size_in
+    image_stats["bytes_out"] += len(normalized)
+    logger.info(f"Normalized image: {size_in // 1024}KB -> {len(normalized) // 1024}KB ({mime_type})")
+    
+    return normalized, mime_type, bytes_saved
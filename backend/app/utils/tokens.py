@@ -0,0 +1,27 @@
+import re
+from functools import lru_cache
+from typing import Any
+
+# Words, numbers and individual punctuation marks each count roughly as a token
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+@lru_cache(maxsize=4096)
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens in text
+    
+    Long words are split into several tokens by Claude's tokenizer, so each
+    word is counted as one token per 4 characters. Results are cached since
+    the same history messages are estimated again on every turn.
+    """
+    if not text:
+        return 0
+    return sum(max(1, len(piece) // 4) for piece in _TOKEN_PATTERN.findall(text))
+
+def estimate_content_tokens(content: Any) -> int:
+    """Estimate the tokens of message or system content, a string or a list of blocks (text blocks only)"""
+    if isinstance(content, str):
+        return estimate_tokens(content)
+    if not content:
+        return 0
+    return sum(estimate_tokens(block.get("text", "")) for block in content)
@@ -0,0 +1,89 @@
+import json
+import logging
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+class _BodyTooLarge(Exception):
+    pass
+
+class BodySizeLimitMiddleware:
+    """
+    ASGI middleware that rejects request bodies over a per-path limit with 413
+    
+    A Content-Length above the limit is rejected before any of the body is
+    read. Bodies without one (chunked uploads) are counted as they arrive and
+    cut off as soon as they pass the limit, before the multipart parser has
+    spooled the rest. The parser turns that cut-off into a 400 of its own,
+    which is replaced with the 413.
+    """
+    
+    def __init__(self, app, limits: Dict[str, int]):
+        self.app = app
+        self.limits = limits
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("POST", "PUT", "PATCH"):
+            await self.app(scope, receive, send)
+            return
+        
+        limit = self.limits.get(scope["path"])
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+        
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            logger.warning(f"Rejected {scope['path']} body of {int(content_length)} bytes (limit {limit})")
+            await self._reject(send, limit)
+            return
+        
+        received = 0
+        too_large = False
+        
+        async def limited_receive():
+            nonlocal received, too_large
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    too_large = True
+                    raise _BodyTooLarge()
+            return message
+        
+        response_started = False
+        
+        async def limited_send(message):
+            nonlocal response_started
+            if too_large:
+                # Whatever the app answers to a cut-off body, the client gets a 413
+                if message["type"] == "http.response.start" and not response_started:
+                    response_started = True
+                    logger.warning(f"Rejected {scope['path']} body over {limit} bytes")
+                    await self._reject(send, limit)
+                return
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+        
+        try:
+            await self.app(scope, limited_receive, limited_send)
+        except _BodyTooLarge:
+            if not response_started:
+                logger.warning(f"Rejected {scope['path']} body over {limit} bytes")
+                await self._reject(send, limit)
+    
+    @staticmethod
+    async def _reject(send, limit):
+        body = json.dumps({"detail": f"Request body exceeds {limit} bytes"}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("ascii")),
+                (b"connection", b"close"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,67 @@
+"""
+Run bulk workloads through the Message Batches API
+
+Usage:
+    python batch_jobs.py submit <workload.jsonl> [--no-wait]
+    python batch_jobs.py resume <job_id> [--no-wait]
+    python batch_jobs.py status [<job_id>]
+    python batch_jobs.py cancel <job_id>
+
+Each workload line is a JSON object such as
+    {"custom_id": "caption-1", "message": "Describe this image", "image_path": "photo.jpg"}
+see app/services/batch_service.py for every field. Job state and results go
+to $BATCH_JOBS_DIR/<job_id>/; results.jsonl appears there once every batch
+has ended. An interrupted submit or resume carries on where it stopped when
+resumed; a batch creation whose response was lost is looked up rather than
+sent twice. Point ANTHROPIC_BASE_URL at fake_anthropic.py to try it locally.
+"""
+import sys
+import json
+import asyncio
+import argparse
+import logging
+
+from app.services import batch_service, claude_service
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Run bulk workloads through the Message Batches API")
+    commands = parser.add_subparsers(dest="command", required=True)
+    submit = commands.add_parser("submit", help="validate a JSONL workload and run it as a new job")
+    submit.add_argument("workload")
+    submit.add_argument("--no-wait", action="store_true", help="submit and return without waiting for results")
+    resume = commands.add_parser("resume", help="carry on with an interrupted job")
+    resume.add_argument("job_id")
+    resume.add_argument("--no-wait", action="store_true", help="poll once and return")
+    status = commands.add_parser("status", help="show one job, or all jobs")
+    status.add_argument("job_id", nargs="?")
+    cancel = commands.add_parser("cancel", help="cancel the batches of a job")
+    cancel.add_argument("job_id")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "submit":
+            job = batch_service.create_job(args.workload)
+            print(f"Created {job['job_id']}", file=sys.stderr)
+            job = await batch_service.run_job(job, wait=not args.no_wait)
+        elif args.command == "resume":
+            job = await batch_service.run_job(batch_service.load_job(args.job_id), wait=not args.no_wait)
+        elif args.command == "cancel":
+            job = await batch_service.cancel_job(batch_service.load_job(args.job_id))
+        elif args.job_id:
+            job = batch_service.load_job(args.job_id)
+        else:
+            for job in batch_service.list_jobs():
+                print(json.dumps(batch_service.summarize_job(job)))
+            return
+        print(json.dumps(batch_service.summarize_job(job), indent=2))
+    except batch_service.BatchJobError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        await claude_service.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    asyncio.run(main())
@@ -0,0 +1,177 @@
+"""
+Benchmark the single-pass image encoder against the old quality-stepping one
+
+Usage:
+    python bench_image_compress.py <directory of images> [max_size_kb]
+
+For every JPEG/PNG/WebP/GIF in the directory, both encoders run on the same
+data URL and the script prints time, output size and output dimensions.
+Images at or under max_size_kb are passed through untouched by both
+functions, so use a small max_size_kb (e.g. 256) to exercise the encoders
+on a corpus of ordinary photos.
+"""
+import sys
+import time
+import base64
+import logging
+from io import BytesIO
+from pathlib import Path
+from statistics import median
+from PIL import Image
+
+from app.utils.image_utils import encode_for_claude, parse_data_url
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+MIME_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".webp": "image/webp",
+    ".gif": "image/gif",
+}
+
+def legacy_compress_image(image_data: str, max_size_kb: int = 4096) -> tuple:
+    """
+    compress_image as it was before the single-pass encoder (kept for comparison)
+    
+    Compress image if it's larger than max_size_kb
+    
+    Args:
+        image_data: Base64 encoded image data
+        max_size_kb: Maximum size in KB (default 4MB)
+        
+    Returns:
+        Tuple of (compressed_base64_data, mime_type)
+    """
+    try:
+        # Split the base64 string to get the actual data
+        header, encoded = image_data.split(",", 1)
+        mime_type = header.split(":")[1].split(";")[0]
+        
+        # Decode base64
+        binary_data = base64.b64decode(encoded)
+        
+        # Check size
+        current_size_kb = len(binary_data) / 1024
+        if current_size_kb <= max_size_kb:
+            # No need to compress
+            return encoded, mime_type
+            
+        # Open the image with PIL
+        img = Image.open(BytesIO(binary_data))
+        
+        # Calculate current dimensions
+        width, height = img.size
+        
+        # Try compression quality first for JPEG
+        if mime_type in ["image/jpeg", "image/jpg"]:
+            quality = 85  # Initial quality
+            output = BytesIO()
+            
+            while quality > 30:  # Don't go below quality 30
+                output = BytesIO()
+                img.save(output, format="JPEG", quality=quality)
+                if len(output.getvalue()) / 1024 <= max_size_kb:
+                    break
+                quality -= 10
+                
+            # If still too large, resize
+            if len(output.getvalue()) / 1024 > max_size_kb:
+                # Calculate new dimensions
+                scale_factor = (max_size_kb / (len(output.getvalue()) / 1024)) ** 0.5
+                new_width = int(width * scale_factor)
+                new_height = int(height * scale_factor)
+                
+                # Resize and save
+                img = img.resize((new_width, new_height), Image.LANCZOS)
+                output = BytesIO()
+                img.save(output, format="JPEG", quality=quality)
+                
+            # Return compressed data
+            compressed_data = base64.b64encode(output.getvalue()).decode("utf-8")
+            return compressed_data, "image/jpeg"
+            
+        # For PNG or other formats, try resizing
+        else:
+            # Calculate target size
+            scale_factor = (max_size_kb / current_size_kb) ** 0.5
+            if scale_factor >= 1:
+                # No need to resize
+                return encoded, mime_type
+                
+            # Resize the image
+            new_width = int(width * scale_factor)
+            new_height = int(height * scale_factor)
+            img = img.resize((new_width, new_height), Image.LANCZOS)
+            
+            # Save to BytesIO
+            output = BytesIO()
+            img_format = mime_type.split("/")[-1].upper()
+            img.save(output, format=img_format)
+            
+            # Return compressed data
+            compressed_data = base64.b64encode(output.getvalue()).decode("utf-8")
+            return compressed_data, mime_type
+            
+    except Exception as e:
+        logger.error(f"Error compressing image: {str(e)}")
+
+
+def single_pass_compress_image(image_data: str, max_size_kb: int = 4096) -> tuple:
+    """The single-pass encoder behind the same interface as legacy_compress_image"""
+    binary_data, mime_type = parse_data_url(image_data)
+    if len(binary_data) / 1024 <= max_size_kb:
+        return image_data.split(",", 1)[1], mime_type
+    compressed, mime_type = encode_for_claude(binary_data, max_size_kb)
+    return base64.b64encode(compressed).decode("utf-8"), mime_type
+
+
+def run(func, data_url, max_size_kb):
+    start = time.perf_counter()
+    encoded, mime_type = func(data_url, max_size_kb)
+    elapsed = time.perf_counter() - start
+    output = base64.b64decode(encoded)
+    size = Image.open(BytesIO(output)).size
+    return elapsed, len(output), size, mime_type
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    
+    corpus = Path(sys.argv[1])
+    max_size_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    
+    files = sorted(p for p in corpus.iterdir() if p.suffix.lower() in MIME_TYPES)
+    if not files:
+        print(f"No images found in {corpus}")
+        sys.exit(1)
+    
+    results = {"legacy": [], "single-pass": []}
+    print(f"{'file':<32} {'input':>9} {'legacy':>22} {'single-pass':>22}")
+    for path in files:
+        raw = path.read_bytes()
+        data_url = f"data:{MIME_TYPES[path.suffix.lower()]};base64," + base64.b64encode(raw).decode("utf-8")
+        
+        row = []
+        for name, func in (("legacy", legacy_compress_image), ("single-pass", single_pass_compress_image)):
+            elapsed, size, dims, _ = run(func, data_url, max_size_kb)
+            results[name].append((elapsed, size))
+            row.append(f"{elapsed * 1000:7.0f}ms {size // 1024:6d}KB {dims[0]}x{dims[1]}")
+        print(f"{path.name[:32]:<32} {len(raw) // 1024:7d}KB {row[0]:>22} {row[1]:>22}")
+    
+    print()
+    for name, rows in results.items():
+        times = [elapsed for elapsed, _ in rows]
+        sizes = [size for _, size in rows]
+        print(
+            f"{name:<12} median {median(times) * 1000:.0f}ms, "
+            f"total {sum(times):.2f}s, output {sum(sizes) // 1024}KB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Measure peak Python memory of /api/chat requests that carry a data URL image
+
+Usage:
+    python bench_image_memory.py <image file> [<image file> ...]
+
+Each image is sent as a data URL to the real /api/chat endpoint, driven
+in-process through httpx's ASGI transport. Claude is answered by
+fake_anthropic.py running in a subprocess, so its memory is not counted,
+and the request is anonymous, so nothing is stored. tracemalloc sees the
+bytes/str copies made in Python: the request body, the parsed request, the
+decoded and normalized image, and the upstream payload. Pillow's pixel
+buffers are allocated outside of it.
+
+To compare two revisions, run the script from the backend directory of
+each one (copy it and fake_anthropic.py into an older tree that lacks
+them).
+"""
+import os
+import sys
+import time
+import base64
+import socket
+import asyncio
+import subprocess
+import tracemalloc
+from pathlib import Path
+from statistics import median
+
+from bench_image_compress import MIME_TYPES
+
+RUNS = 3
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for(port, server):
+    for _ in range(100):
+        if server.poll() is not None:
+            raise RuntimeError("fake_anthropic exited")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("fake_anthropic did not start")
+
+
+async def _peak(client, body):
+    """Peak traced memory above the baseline during one request, in bytes"""
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    response = await client.post("/api/chat", content=body, headers={"content-type": "application/json"})
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    response.raise_for_status()
+    return peak_bytes - baseline
+
+
+async def run(paths):
+    import httpx
+    from app.main import app
+    from app.utils import image_utils
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        print(f"{'file':<32} {'data URL':>10} {'peak':>10}")
+        for path in paths:
+            data_url = f"data:{MIME_TYPES[path.suffix.lower()]};base64," + base64.b64encode(path.read_bytes()).decode("ascii")
+            body = ('{"message": "Describe this image", "image_data": "' + data_url + '"}').encode("ascii")
+            del data_url
+
+            tracemalloc.start()
+            # The first request warms up imports, the image pool and the connection
+            await _peak(client, body)
+            peaks = [await _peak(client, body) for _ in range(RUNS)]
+            tracemalloc.stop()
+            print(f"{path.name[:32]:<32} {len(body) / 1024 / 1024:8.1f}MB {median(peaks) / 1024 / 1024:8.1f}MB")
+    image_utils.shutdown_image_pool()
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    port = _free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "fake_anthropic:app", "--port", str(port), "--log-level", "warning"],
+        cwd=Path(__file__).parent
+    )
+    try:
+        _wait_for(port, server)
+        os.environ["ANTHROPIC_API_KEY"] = "test"
+        os.environ["ANTHROPIC_BASE_URL"] = f"http://127.0.0.1:{port}"
+        # Every request comes from the same anonymous caller
+        os.environ["ADMISSION_USER_BURST"] = "1000"
+        asyncio.run(run([Path(name) for name in sys.argv[1:]]))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+Local stand-in for the Anthropic Messages and Message Batches APIs, for
+exercising the resilience layer and batch jobs without a real key or real
+outages
+
+Usage:
+    uvicorn fake_anthropic:app --port 8787
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8787 ANTHROPIC_API_KEY=test uvicorn app.main:app
+
+Replies echo the last user message, streamed or not. Batches end
+FAKE_BATCH_SECONDS after they are created; FAKE_FAILURE_RATE also applies to
+their individual requests, and FAKE_BATCH_LOST_RATE is the share of batch
+creations whose response never arrives (the batch is created, then the
+request hangs for FAKE_BATCH_LOST_SECONDS). Faults are injected with
+environment variables:
+    FAKE_FAILURE_RATE      share of requests answered with FAKE_FAILURE_STATUS
+    FAKE_FAILURE_STATUS    status of injected failures (default 529, overloaded)
+    FAKE_RETRY_AFTER       retry-after header sent with injected failures
+    FAKE_STREAM_ERROR_RATE share of streams that send an overloaded error event
+                           after the first token
+    FAKE_LATENCY           seconds before every response
+    FAKE_SLOW_RATE         share of requests that take FAKE_SLOW_LATENCY instead
+    FAKE_SLOW_LATENCY      latency of slow requests, for hedging
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import itertools
+from datetime import datetime, timedelta, timezone
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+FAILURE_RATE = float(os.environ.get("FAKE_FAILURE_RATE", "0"))
+FAILURE_STATUS = int(os.environ.get("FAKE_FAILURE_STATUS", "529"))
+RETRY_AFTER = os.environ.get("FAKE_RETRY_AFTER")
+STREAM_ERROR_RATE = float(os.environ.get("FAKE_STREAM_ERROR_RATE", "0"))
+LATENCY = float(os.environ.get("FAKE_LATENCY", "0"))
+SLOW_RATE = float(os.environ.get("FAKE_SLOW_RATE", "0"))
+SLOW_LATENCY = float(os.environ.get("FAKE_SLOW_LATENCY", "5"))
+BATCH_SECONDS = float(os.environ.get("FAKE_BATCH_SECONDS", "2"))
+BATCH_LOST_RATE = float(os.environ.get("FAKE_BATCH_LOST_RATE", "0"))
+BATCH_LOST_SECONDS = float(os.environ.get("FAKE_BATCH_LOST_SECONDS", "3600"))
+
+ERROR_TYPES = {
+    429: "rate_limit_error",
+    500: "api_error",
+    529: "overloaded_error",
+}
+
+app = FastAPI()
+_ids = itertools.count(1)
+stats = {"requests": 0, "failures": 0, "stream_errors": 0, "batches": 0, "lost_batch_responses": 0}
+batches = {}
+
+
+def _error(status, error_type=None):
+    error_type = error_type or ERROR_TYPES.get(status, "api_error")
+    return {"type": "error", "error": {"type": error_type, "message": f"Injected {error_type}"}}
+
+
+def _reply_text(body):
+    """Echo the last user text so callers can tell responses apart"""
+    content = body["messages"][-1]["content"]
+    if isinstance(content, list):
+        content = " ".join(block.get("text", "") for block in content if block.get("type") == "text")
+    return f"You said: {content}"
+
+
+def _message(body, text):
+    return {
+        "id": f"msg_fake_{next(_ids)}",
+        "type": "message",
+        "role": "assistant",
+        "model": body["model"],
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {"input_tokens": len(json.dumps(body["messages"])) // 4, "output_tokens": len(text.split(" "))},
+    }
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _stream(message, text):
+    yield _sse("message_start", {"type": "message_start", "message": {**message, "content": [], "stop_reason": None}})
+    yield _sse("content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+    words = text.split(" ")
+    for index, word in enumerate(words):
+        delta = word if index == len(words) - 1 else word + " "
+        yield _sse("content_block_delta", {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": delta}})
+        if index == 0 and random.random() < STREAM_ERROR_RATE:
+            stats["stream_errors"] += 1
+            yield _sse("error", _error(529))
+            return
+        await asyncio.sleep(0.01)
+    yield _sse("content_block_stop", {"type": "content_block_stop", "index": 0})
+    yield _sse("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None}, "usage": {"output_tokens": len(words)}})
+    yield _sse("message_stop", {"type": "message_stop"})
+
+
+@app.post("/v1/messages")
+async def messages(request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+
+    await asyncio.sleep(SLOW_LATENCY if random.random() < SLOW_RATE else LATENCY)
+
+    if random.random() < FAILURE_RATE:
+        stats["failures"] += 1
+        headers = {"retry-after": RETRY_AFTER} if RETRY_AFTER else None
+        return JSONResponse(_error(FAILURE_STATUS), status_code=FAILURE_STATUS, headers=headers)
+
+    text = _reply_text(body)
+    message = _message(body, text)
+    if body.get("stream"):
+        return StreamingResponse(_stream(message, text), media_type="text/event-stream")
+    return message
+
+
+def _batch_view(request, batch):
+    ended = batch["canceled"] or time.time() >= batch["created_at"] + BATCH_SECONDS
+    total = len(batch["requests"])
+    counts = {"processing": total, "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0}
+    if ended:
+        counts["processing"] = 0
+        for result in _batch_results(batch):
+            counts[result["result"]["type"]] += 1
+    created = datetime.fromtimestamp(batch["created_at"], timezone.utc)
+    return {
+        "id": batch["id"],
+        "type": "message_batch",
+        "processing_status": "ended" if ended else "in_progress",
+        "request_counts": counts,
+        "created_at": created.isoformat(),
+        "expires_at": (created + timedelta(hours=24)).isoformat(),
+        "ended_at": datetime.now(timezone.utc).isoformat() if ended else None,
+        "cancel_initiated_at": None,
+        "archived_at": None,
+        "results_url": f"{str(request.base_url).rstrip('/')}/v1/messages/batches/{batch['id']}/results" if ended else None,
+    }
+
+
+def _batch_results(batch):
+    """Results are decided once per batch so repeated downloads agree"""
+    if "results" not in batch:
+        results = []
+        for item in batch["requests"]:
+            if batch["canceled"]:
+                result = {"type": "canceled"}
+            elif random.random() < FAILURE_RATE:
+                result = {"type": "errored", "error": _error(FAILURE_STATUS)}
+            else:
+                result = {"type": "succeeded", "message": _message(item["params"], _reply_text(item["params"]))}
+            results.append({"custom_id": item["custom_id"], "result": result})
+        batch["results"] = results
+    return batch["results"]
+
+
+@app.post("/v1/messages/batches")
+async def create_batch(request: Request):
+    body = await request.json()
+    stats["batches"] += 1
+    batch = {"id": f"msgbatch_fake_{next(_ids)}", "requests": body["requests"], "created_at": time.time(), "canceled": False}
+    batches[batch["id"]] = batch
+    if random.random() < BATCH_LOST_RATE:
+        stats["lost_batch_responses"] += 1
+        await asyncio.sleep(BATCH_LOST_SECONDS)
+    return _batch_view(request, batch)
+
+
+@app.get("/v1/messages/batches")
+async def list_batches(request: Request):
+    """Every batch on one page, newest first"""
+    views = [_batch_view(request, batch) for batch in reversed(list(batches.values()))]
+    return {
+        "data": views,
+        "has_more": False,
+        "first_id": views[0]["id"] if views else None,
+        "last_id": views[-1]["id"] if views else None,
+    }
+
+
+@app.get("/v1/messages/batches/{batch_id}")
+async def retrieve_batch(batch_id: str, request: Request):
+    if batch_id not in batches:
+        return JSONResponse(_error(404, "not_found_error"), status_code=404)
+    return _batch_view(request, batches[batch_id])
+
+
+@app.post("/v1/messages/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str, request: Request):
+    batch = batches[batch_id]
+    if "results" not in batch:
+        batch["canceled"] = True
+    return _batch_view(request, batch)
+
+
+@app.get("/v1/messages/batches/{batch_id}/results")
+async def batch_results(batch_id: str):
+    lines = (json.dumps(result) + "\n" for result in _batch_results(batches[batch_id]))
+    return StreamingResponse(lines, media_type="application/binary")
+
+
+@app.get("/_stats")
+async def get_stats():
+    return stats
+
@@ -0,0 +1,24 @@
+import socket
+import threading
+import time
+
+import pytest
+import uvicorn
+
+import fake_anthropic
+
+
+@pytest.fixture(scope="module")
+def fake_url():
+    """Run fake_anthropic.py on a free port for the whole module"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(fake_anthropic.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    yield f"http://127.0.0.1:{port}"
+    server.should_exit = True
+    thread.join()
@@ -0,0 +1,142 @@
+import json
+import asyncio
+import time
+
+import anthropic
+import pytest
+
+import fake_anthropic
+from app.services import batch_service, claude_service
+
+
+@pytest.fixture
+def fake(fake_url, monkeypatch, tmp_path):
+    """A fresh fake server state, a client pointed at it and a jobs directory"""
+    fake_anthropic.batches.clear()
+    monkeypatch.setattr(fake_anthropic, "stats", {key: 0 for key in fake_anthropic.stats})
+    monkeypatch.setattr(fake_anthropic, "BATCH_SECONDS", 0.2)
+    monkeypatch.setattr(batch_service, "BATCH_JOBS_DIR", str(tmp_path / "jobs"))
+    monkeypatch.setattr(batch_service, "BATCH_POLL_INTERVAL", 0.05)
+    monkeypatch.setattr(batch_service, "BATCH_MAX_REQUESTS", 2)
+    monkeypatch.setattr(claude_service, "async_client", None)
+
+    def connect():
+        # A client per event loop, since each test step runs in its own loop
+        claude_service.async_client = anthropic.AsyncAnthropic(
+            api_key="test", base_url=fake_url, max_retries=0, timeout=1
+        )
+
+    return connect
+
+
+def _workload(tmp_path, count=5):
+    path = tmp_path / "workload.jsonl"
+    path.write_text("".join(json.dumps({"custom_id": f"item-{i}", "message": f"hello {i}"}) + "\n" for i in range(count)))
+    return str(path)
+
+
+def _run(fake, coroutine_fn):
+    async def main():
+        fake()
+        try:
+            return await coroutine_fn()
+        finally:
+            await claude_service.async_client.close()
+    return asyncio.run(main())
+
+
+def _results(job):
+    with open(job["results"]) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_submit_runs_a_job_to_completion(fake, tmp_path):
+    job = batch_service.create_job(_workload(tmp_path))
+    job = _run(fake, lambda: batch_service.run_job(job))
+
+    assert job["status"] == "completed"
+    assert len(job["chunks"]) == 3
+    assert fake_anthropic.stats["batches"] == 3
+    results = _results(job)
+    assert [record["custom_id"] for record in results] == [f"item-{i}" for i in range(5)]
+    assert all(record["status"] == "succeeded" for record in results)
+    assert results[0]["content"] == "You said: hello 0"
+
+
+def test_resume_picks_up_from_the_saved_state(fake, tmp_path):
+    job = batch_service.create_job(_workload(tmp_path))
+    job = _run(fake, lambda: batch_service.run_job(job, wait=False))
+    assert job["status"] == "running"
+
+    resumed = batch_service.load_job(job["job_id"])
+    resumed = _run(fake, lambda: batch_service.run_job(resumed))
+
+    assert resumed["status"] == "completed"
+    assert fake_anthropic.stats["batches"] == 3
+    assert len(_results(resumed)) == 5
+
+
+def test_cancel_collects_what_the_batches_got_done(fake, tmp_path, monkeypatch):
+    monkeypatch.setattr(fake_anthropic, "BATCH_SECONDS", 60)
+    job = batch_service.create_job(_workload(tmp_path))
+    job = _run(fake, lambda: batch_service.run_job(job, wait=False))
+
+    job = _run(fake, lambda: batch_service.cancel_job(batch_service.load_job(job["job_id"])))
+    assert job["status"] == "canceled"
+    job = _run(fake, lambda: batch_service.run_job(job))
+
+    assert job["completed_at"]
+    assert job["status"] == "canceled"
+    assert all(record["status"] == "canceled" for record in _results(job))
+
+
+def test_lost_create_response_is_reconciled_not_resubmitted(fake, tmp_path, monkeypatch):
+    monkeypatch.setattr(fake_anthropic, "BATCH_LOST_RATE", 1)
+    monkeypatch.setattr(fake_anthropic, "BATCH_LOST_SECONDS", 3)
+    job = batch_service.create_job(_workload(tmp_path))
+    with pytest.raises(batch_service.BatchJobError):
+        _run(fake, lambda: batch_service.run_job(job))
+
+    job = batch_service.load_job(job["job_id"])
+    assert job["chunks"] == []
+    assert job["submitting"]["count"] == 2
+    assert fake_anthropic.stats["batches"] == 1
+
+    monkeypatch.setattr(fake_anthropic, "BATCH_LOST_RATE", 0)
+    job = _run(fake, lambda: batch_service.run_job(job))
+
+    assert job["status"] == "completed"
+    assert "submitting" not in job
+    # The lost batch was adopted; only the two remaining chunks were created
+    assert fake_anthropic.stats["batches"] == 3
+    assert len(_results(job)) == 5
+
+
+def test_unconfirmed_submission_without_a_batch_is_sent_again(fake, tmp_path):
+    job = batch_service.create_job(_workload(tmp_path, count=2))
+    job["submitting"] = {"start": 0, "count": 2, "attempted_at": time.time()}
+    job = _run(fake, lambda: batch_service.run_job(job))
+
+    assert job["status"] == "completed"
+    assert fake_anthropic.stats["batches"] == 1
+    assert len(_results(job)) == 2
+
+
+def test_unconfirmed_submission_does_not_adopt_a_batch_of_other_requests(fake, tmp_path):
+    other = tmp_path / "other.jsonl"
+    other.write_text("".join(json.dumps({"custom_id": f"other-{i}", "message": "hi"}) + "\n" for i in range(2)))
+    stranger = batch_service.create_job(str(other), jobs_dir=str(tmp_path / "other_jobs"))
+    job = batch_service.create_job(_workload(tmp_path, count=2))
+
+    async def submit_both():
+        # A batch of the same size from elsewhere, created around the lost attempt
+        await batch_service._submit_remaining(stranger)
+        job["submitting"] = {"start": 0, "count": 2, "attempted_at": time.time()}
+        return await batch_service.run_job(job)
+
+    job = _run(fake, submit_both)
+
+    assert job["status"] == "completed"
+    assert job["chunks"][0]["batch_id"] != stranger["chunks"][0]["batch_id"]
+    assert fake_anthropic.stats["batches"] == 2
+    assert [record["custom_id"] for record in _results(job)] == ["item-0", "item-1"]
@@ -0,0 +1,34 @@
+import asyncio
+
+import anthropic
+import httpx
+
+import fake_anthropic
+from app.main import app
+from app.services import claude_service, resilience
+
+
+def test_overloaded_upstream_is_a_503_with_retry_after(fake_url, monkeypatch):
+    monkeypatch.setattr(fake_anthropic, "FAILURE_RATE", 1)
+    monkeypatch.setattr(fake_anthropic, "FAILURE_STATUS", 529)
+    monkeypatch.setattr(fake_anthropic, "RETRY_AFTER", "7")
+    # A fresh breaker and budget; the 7s retry-after is past what is waited out
+    monkeypatch.setattr(resilience, "budget", resilience.RetryBudget(0.2, 10, 100))
+    monkeypatch.setattr(resilience, "breaker", resilience.CircuitBreaker(3, 30))
+    monkeypatch.setattr(resilience, "RESILIENCE_MAX_RETRY_AFTER", 5)
+    monkeypatch.setattr(claude_service, "async_client", None)
+
+    async def main():
+        claude_service.async_client = anthropic.AsyncAnthropic(api_key="test", base_url=fake_url, max_retries=0)
+        try:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await client.post("/api/chat/stream", json={"message": "hello from the 529 test"})
+        finally:
+            await claude_service.async_client.close()
+
+    response = asyncio.run(main())
+
+    assert response.status_code == 503
+    assert float(response.headers["retry-after"]) == 7
+    assert fake_anthropic.stats["failures"] >= 1
@@ -0,0 +1,296 @@
+import time
+import asyncio
+
+import anthropic
+import httpx
+import pytest
+
+from app.services import resilience
+
+
+class FakeClock:
+    """Stands in for the time module so breaker timeouts pass instantly"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return time.time()
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(resilience, "time", fake)
+    return fake
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    """Give every test its own budget, breaker, latencies and counters"""
+    monkeypatch.setattr(resilience, "resilience_stats", {key: 0 for key in resilience.resilience_stats})
+    monkeypatch.setattr(resilience, "budget", resilience.RetryBudget(0.2, 10, 100))
+    monkeypatch.setattr(resilience, "breaker", resilience.CircuitBreaker(3, 30))
+    monkeypatch.setattr(resilience, "latencies", resilience.LatencyTracker())
+    monkeypatch.setattr(resilience, "RESILIENCE_BACKOFF_BASE", 0)
+    monkeypatch.setattr(resilience, "HEDGE_ENABLED", False)
+
+
+def _status_error(status, headers=None):
+    response = httpx.Response(status, headers=headers, request=httpx.Request("POST", "https://api.test/v1/messages"))
+    return anthropic.APIStatusError(f"status {status}", response=response, body=None)
+
+
+def _overloaded():
+    return _status_error(529)
+
+
+class Flaky:
+    """Async callable that raises the given errors in turn, then returns "ok" """
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+# Retry budget
+
+def test_budget_allows_minimum_then_refuses():
+    budget = resilience.RetryBudget(0.5, 2, 10)
+    assert budget.withdraw()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    assert resilience.resilience_stats["budget_exhausted"] == 1
+
+
+def test_budget_earns_a_fraction_per_call_up_to_the_maximum():
+    budget = resilience.RetryBudget(0.5, 0, 3)
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
+    for _ in range(100):
+        budget.deposit()
+    assert budget.balance == 3
+
+
+def test_call_retries_until_success():
+    fn = Flaky(_overloaded(), httpx.ConnectError("refused"))
+    assert asyncio.run(resilience.call(fn)) == "ok"
+    assert fn.calls == 3
+    assert resilience.resilience_stats["retries"] == 2
+
+
+def test_call_stops_retrying_when_the_budget_is_spent(monkeypatch):
+    monkeypatch.setattr(resilience, "budget", resilience.RetryBudget(0, 1, 1))
+    fn = Flaky(_overloaded(), _overloaded())
+    with pytest.raises(resilience.UpstreamUnavailable):
+        asyncio.run(resilience.call(fn))
+    assert fn.calls == 2
+    assert resilience.resilience_stats["budget_exhausted"] == 1
+
+
+def test_call_does_not_retry_client_errors():
+    fn = Flaky(_status_error(400))
+    with pytest.raises(anthropic.APIStatusError):
+        asyncio.run(resilience.call(fn))
+    assert fn.calls == 1
+    assert resilience.breaker.failures == 0
+
+
+def test_retry_after_header_is_honoured():
+    assert resilience.next_delay(_status_error(529, {"retry-after": "2"}), 0) == 2
+    assert resilience.next_delay(_status_error(529, {"retry-after-ms": "1500"}), 0) == 1.5
+
+
+def test_retry_after_beyond_the_limit_fails_fast():
+    with pytest.raises(resilience.UpstreamUnavailable) as raised:
+        resilience.next_delay(_status_error(529, {"retry-after": "600"}), 0)
+    assert raised.value.retry_after == 600
+
+
+# Circuit breaker
+
+def _trip(breaker):
+    for _ in range(breaker.threshold):
+        breaker.record_failure()
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = resilience.breaker
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    _trip(breaker)
+    assert breaker.state == "open"
+    with pytest.raises(resilience.UpstreamUnavailable) as raised:
+        breaker.before_call()
+    assert raised.value.retry_after == 30
+
+
+def test_breaker_lets_one_probe_through_after_the_timeout(clock):
+    breaker = resilience.breaker
+    _trip(breaker)
+    clock.advance(29)
+    with pytest.raises(resilience.UpstreamUnavailable):
+        breaker.before_call()
+    clock.advance(1)
+    assert breaker.before_call() is True
+    assert breaker.state == "half_open"
+    with pytest.raises(resilience.UpstreamUnavailable):
+        breaker.before_call()
+
+
+def test_successful_probe_closes_the_breaker(clock):
+    breaker = resilience.breaker
+    _trip(breaker)
+    clock.advance(30)
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.before_call() is False
+
+
+def test_failed_probe_reopens_the_breaker(clock):
+    breaker = resilience.breaker
+    _trip(breaker)
+    clock.advance(30)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.probing
+    clock.advance(29)
+    with pytest.raises(resilience.UpstreamUnavailable):
+        breaker.before_call()
+    clock.advance(1)
+    assert breaker.before_call() is True
+
+
+def test_probe_ending_in_an_unrelated_error_frees_the_probe_slot(clock):
+    breaker = resilience.breaker
+    _trip(breaker)
+    clock.advance(30)
+    with pytest.raises(ValueError):
+        asyncio.run(resilience.call(Flaky(ValueError("bad payload"))))
+    assert breaker.state == "half_open"
+    assert not breaker.probing
+    assert asyncio.run(resilience.call(Flaky())) == "ok"
+    assert breaker.state == "closed"
+
+
+def test_cancelled_probe_frees_the_probe_slot(clock):
+    breaker = resilience.breaker
+    _trip(breaker)
+    clock.advance(30)
+
+    async def hang():
+        await asyncio.sleep(10)
+
+    async def cancel_probe():
+        task = asyncio.ensure_future(resilience.call(hang))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_probe())
+    assert not breaker.probing
+
+
+def test_call_fails_fast_while_open(clock):
+    _trip(resilience.breaker)
+    fn = Flaky()
+    with pytest.raises(resilience.UpstreamUnavailable):
+        asyncio.run(resilience.call(fn))
+    assert fn.calls == 0
+    assert resilience.resilience_stats["short_circuited"] == 1
+
+
+# Hedging
+
+@pytest.fixture
+def hedging(monkeypatch):
+    monkeypatch.setattr(resilience, "HEDGE_ENABLED", True)
+    monkeypatch.setattr(resilience, "HEDGE_MIN_DELAY", 0.01)
+    for _ in range(resilience.HEDGE_MIN_SAMPLES):
+        resilience.latencies.record(0.01)
+
+
+class SlowThenFast:
+    """The first call hangs, later ones answer at once"""
+
+    def __init__(self):
+        self.calls = 0
+        self.cancelled = 0
+
+    async def __call__(self):
+        self.calls += 1
+        if self.calls == 1:
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                self.cancelled += 1
+                raise
+            return "slow"
+        return "fast"
+
+
+def test_slow_call_is_hedged_and_the_hedge_wins(hedging):
+    fn = SlowThenFast()
+    assert asyncio.run(resilience.call(fn, hedge=True)) == "fast"
+    assert fn.calls == 2
+    assert fn.cancelled == 1
+    assert resilience.resilience_stats["hedges"] == 1
+    assert resilience.resilience_stats["hedge_wins"] == 1
+
+
+def test_fast_call_is_not_hedged(hedging):
+    fn = Flaky()
+    assert asyncio.run(resilience.call(fn, hedge=True)) == "ok"
+    assert fn.calls == 1
+    assert resilience.resilience_stats["hedges"] == 0
+
+
+def test_no_hedge_without_enough_latency_samples(monkeypatch):
+    monkeypatch.setattr(resilience, "HEDGE_ENABLED", True)
+    fn = Flaky()
+    assert asyncio.run(resilience.call(fn, hedge=True)) == "ok"
+    assert resilience.resilience_stats["hedges"] == 0
+
+
+def test_hedges_spend_the_retry_budget(hedging, monkeypatch):
+    monkeypatch.setattr(resilience, "budget", resilience.RetryBudget(0, 0, 0))
+
+    async def slow():
+        await asyncio.sleep(0.05)
+        return "slow"
+
+    assert asyncio.run(resilience.call(slow, hedge=True)) == "slow"
+    assert resilience.resilience_stats["hedges"] == 0
+    assert resilience.resilience_stats["budget_exhausted"] == 1
+
+
+def test_hedge_failure_falls_back_to_the_primary(hedging):
+    calls = []
+
+    async def fn():
+        calls.append(None)
+        if len(calls) == 1:
+            await asyncio.sleep(0.05)
+            return "primary"
+        raise ValueError("hedge failed")
+
+    assert asyncio.run(resilience.call(fn, hedge=True)) == "primary"
+    assert resilience.resilience_stats["hedge_wins"] == 0
@@ -212,6 +212,7 @@ export const streamMessage = async (message, imageData = null, chatId = null, sy
     
     let chatIdFromStream = chatId;
     let contentAccumulated = '';
+    let streamError = null;
     
     try {
       while (true) {
@@ -250,6 +251,10 @@ export const streamMessage = async (message, imageData = null, chatId = null, sy
                 chatIdFromStream = data.chat_id;
               }
             }
+            else if (data.type === 'error') {
+              // The server could not finish the response
+              streamError = data.error;
+            }
           } catch (e) {
             console.error('Error parsing SSE:', e, 'Line:', line);
           }
@@ -260,6 +265,10 @@ export const streamMessage = async (message, imageData = null, chatId = null, sy
       throw error;
     }
     
+    if (streamError) {
+      throw new Error(streamError);
+    }
+    
     // Complete the stream
     if (onComplete) {
       onComplete(chatIdFromStream);